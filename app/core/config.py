@@ -66,9 +66,108 @@ class Settings(BaseSettings):
 
     EMBEDDER_BACKEND: str = "mock"  # insightface | facerecognition | mock
     EMBEDDING_DIM: int = 512
+    EMBEDDER_PRELOAD: bool = True    # cargar el modelo al arrancar (False = perezoso, p. ej. serverless)
+    EMBEDDER_WARMUP: bool = True     # inferencia dummy tras cargar el modelo
+    # insightface: solo se cargan los modelos de detección y reconocimiento del paquete
+    INSIGHTFACE_MODEL: str = "buffalo_l"
+    INSIGHTFACE_ROOT: str = "~/.insightface"
+    INSIGHTFACE_DET_MODEL: str = "det_10g.onnx"     # vacío = buscarlo por la forma del modelo
+    INSIGHTFACE_REC_MODEL: str = "w600k_r50.onnx"
+    INSIGHTFACE_DET_SIZE: int = 640                 # entrada del detector (múltiplo de 32; menos = más rápido)
+    INSIGHTFACE_DET_THRESH: float = 0.5
+    INSIGHTFACE_INT8: bool = False                  # variantes <modelo>.int8.onnx (app/scripts/quantize_models.py)
+    # Sesiones ONNX Runtime
+    ONNX_PROVIDERS: str = "CPUExecutionProvider"    # comma-separated, en orden de preferencia
+    ONNX_INTRA_OP_THREADS: int = 0                  # 0 = núcleos / INFERENCE_WORKERS
+    ONNX_INTER_OP_THREADS: int = 1
+    ONNX_GRAPH_OPTIMIZATION: str = "all"            # disable | basic | extended | all
     MATCH_THRESHOLD: float = 0.6  # cosine similarity threshold
 
-    MAX_UPLOAD_MB: int = 8
+    # Índice de la galería: flat (exacto) | ivf | hnsw
+    INDEX_BACKEND: str = "flat"
+    IVF_NLIST: int = 256       # listas del cuantizador grueso
+    IVF_NPROBE: int = 8        # listas recorridas por query (más = más recall, más latencia)
+    HNSW_M: int = 16           # vecinos por nodo
+    HNSW_EF_CONSTRUCTION: int = 100
+    HNSW_EF_SEARCH: int = 64   # más = más recall, más latencia
+
+    # Codec de la galería en memoria: float32 | float16 | int8 | pq
+    GALLERY_CODEC: str = "float32"
+    PQ_M: int = 64             # sub-vectores PQ (bytes por vector)
+    # Codec del vector persistido (formato binario empaquetado): float32 | float16 | int8
+    VECTOR_STORAGE_CODEC: str = "float32"
+
+    # Varias plantillas por cliente; agregación al buscar: max | mean | quality
+    TEMPLATE_AGGREGATION: str = "mean"
+    TEMPLATES_MAX_PER_CLIENT: int = 10
+
+    # Snapshot de la galería en disco compartido por los workers (vacío = desactivado)
+    GALLERY_SNAPSHOT_DIR: str = ""
+    GALLERY_SNAPSHOT_HEADROOM: float = 0.25  # filas libres (fracción) para altas sin copiar la matriz
+    GALLERY_DELTA_MAX_MB: float = 8.0        # al superarlo el delta log se compacta en un snapshot nuevo
+
+    # Coherencia de la galería entre instancias: none | firestore | delta | local
+    GALLERY_SYNC: str = "none"
+    GALLERY_SYNC_POLL_SECONDS: float = 0.5      # delta: cada cuánto leer el delta log
+    GALLERY_SYNC_CHECK_SECONDS: float = 5.0     # watchdog del feed
+    GALLERY_SYNC_MAX_LAG_SECONDS: float = 30.0  # atraso tolerado antes de forzar un resync
+    GALLERY_RESYNC_SECONDS: float = 0           # resync completo periódico (0 = nunca)
+
+    MAX_UPLOAD_MB: int = 8           # por imagen; 413 antes de leer el body
+    IMAGE_MAX_SIDE: int = 640        # lado máximo al decodificar (0 = resolución original)
+    MULTI_FACE_MIN_PX: int = 40      # /detect/image/multi: lado mínimo de una cara (px originales)
+    MULTI_FACE_MAX: int = 32         # /detect/image/multi: caras por imagen (las más grandes)
+    MULTI_FACE_MAX_SIDE: int = 1920  # /detect/image/multi: lado máximo al decodificar (0 = original)
+    # Cache de embeddings por hash del contenido (uploads repetidos no pasan por el modelo)
+    EMBED_CACHE_MB: float = 32               # presupuesto de memoria (0 = desactivado)
+    EMBED_CACHE_TTL_SECONDS: float = 600     # también aplica a las entradas "sin cara"
+
+    # /detect/stream: tracking de caras entre frames y debounce de detecciones
+    STREAM_TRACK_IOU: float = 0.3            # IoU mínimo para seguir una cara entre frames
+    STREAM_TRACK_MIN_SIM: float = 0.6        # similitud mínima con el embedding del track (con bbox, si hay embedding)
+    STREAM_TRACK_TTL_SECONDS: float = 2.0    # un track sin ver por este tiempo se cierra
+    STREAM_RETRY_SECONDS: float = 1.0        # reintento de un track no reconocido / re-verificación de uno reconocido
+    STREAM_DEBOUNCE_SECONDS: float = 300.0   # un cliente se registra a lo sumo una vez por ventana
+    MAX_BATCH_IMAGES: int = 64       # imágenes por request en endpoints batch
+    MAX_BATCH_UPLOAD_MB: int = 64    # body total de un request batch (todas sus imágenes)
+    EMBED_DECODE_WORKERS: int = 4    # hilos para decodificar imágenes en paralelo
+
+    # Ejecución fuera del event loop (503 cuando la cola está llena)
+    IO_WORKERS: int = 16             # hilos para el SDK de Firestore
+    IO_MAX_QUEUE: int = 256
+    INFERENCE_MODE: str = "thread"   # thread | process
+    INFERENCE_WORKERS: int = 2
+    INFERENCE_MAX_QUEUE: int = 32
+
+    # Registro de detecciones write-behind
+    DETECTION_LOG_ASYNC: bool = True          # False = escribir en el request (p. ej. serverless)
+    DETECTION_LOG_BATCH_SIZE: int = 200       # flush al juntar N eventos...
+    DETECTION_LOG_FLUSH_SECONDS: float = 1.0  # ...o cada N segundos
+    DETECTION_LOG_SPOOL: str = "detections.spool.jsonl"  # uno por proceso: <base>.<pid>.jsonl; vacío = sin spool
+    DETECTION_LOG_FSYNC: bool = False         # fsync por evento (sobrevive a cortes de luz)
+
+    # /reports leen los rollups diarios (asistencia_diaria); los días anteriores
+    # a la marca de cobertura (ver rollup_coverage) se recalculan desde las detecciones
+    REPORTS_USE_ROLLUPS: bool = True
+    REPORTS_MAX_RANGE_DAYS: int = 366
+
+    # Persistencia: firestore | local (SQLite + archivo de vectores mapeado, sin red)
+    STORAGE_BACKEND: str = "firestore"
+    LOCAL_STORE_DIR: str = "data"
+
+    # Rate limit: token bucket por API key (o IP); memory | mmap (compartido por los workers del host)
+    RATE_LIMIT_BACKEND: str = "memory"
+    RATE_LIMIT_PER_MINUTE: float = 60
+    RATE_LIMIT_BURST: float = 0             # capacidad del bucket (0 = RATE_LIMIT_PER_MINUTE)
+    RATE_LIMIT_MAX_KEYS: int = 65536        # buckets residentes (memory: LRU; mmap: slots del archivo)
+    RATE_LIMIT_FILE: str = "data/ratelimit.bin"
+    # costo en tokens por prefijo de ruta (sin API_PREFIX); 0 = sin límite, resto = 1
+    RATE_LIMIT_ROUTE_COSTS: str = ("/health=0,/ready=0,/metrics=0,/detect/vector=1,/detect/image=2,"
+                                   "/detect/image/batch=8,/clients/bulk-face-images=8")
+    RATE_LIMIT_KEY_RATES: str = ""          # por API key: "key1=600,key2=6000" (tokens por minuto)
+
+    # Métricas (GET /metrics, formato Prometheus)
+    METRICS_SERVER_TIMING: bool = False     # header Server-Timing con las fases de cada request
 
     ENCRYPT_VECTORS: bool = False
     ENCRYPTION_KEY: Optional[str] = None  # urlsafe base64 32-byte key
@@ -0,0 +1,132 @@
+import asyncio
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+from fastapi import HTTPException, status
+from .config import settings
+from . import metrics
+
+
+def _timed_call(fn: Callable, args: tuple, kwargs: dict):
+    # Corre dentro del worker (hilo o proceso): devuelve cuándo empezó de
+    # verdad para medir el tiempo de espera en cola. time.time() porque el
+    # reloj monotónico no es comparable entre procesos. Las fases medidas
+    # por `fn` vuelven con el resultado y las registra el proceso del request.
+    started = time.time()
+    with metrics.collect() as stages:
+        result = fn(*args, **kwargs)
+    return started, result, stages
+
+
+class BoundedExecutor:
+    """
+    Pool de workers con límite de trabajos en vuelo (ejecutando + en cola).
+    Si se supera, run() responde 503 en vez de encolar sin límite.
+    """
+
+    def __init__(self, name: str, factory: Callable[[], Executor], workers: int, max_queue: int):
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_inflight = self.workers + max(0, max_queue)
+        self._factory = factory
+        self._pool: Optional[Executor] = None
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _get_pool(self) -> Executor:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = self._factory()
+        return self._pool
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        with self._lock:
+            if self._inflight >= self.max_inflight:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail=f"Server busy ({self.name} queue full)",
+                    headers={"Retry-After": "1"},
+                )
+            self._inflight += 1
+            self.submitted += 1
+        submitted_at = time.time()
+        try:
+            loop = asyncio.get_running_loop()
+            started_at, result, stages = await loop.run_in_executor(self._get_pool(), _timed_call, fn, args, kwargs)
+            wait = max(0.0, started_at - submitted_at)
+            metrics.record_stage(f"{self.name}_queue", wait)
+            metrics.record_stages(stages)
+            with self._lock:
+                self.completed += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            return result
+        finally:
+            with self._lock:
+                self._inflight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_inflight": self.max_inflight,
+                "inflight": self._inflight,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "queue_wait_avg_ms": (self.wait_total / self.completed * 1000.0) if self.completed else 0.0,
+                "queue_wait_max_ms": self.wait_max * 1000.0,
+            }
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+def _inference_factory() -> Executor:
+    if settings.INFERENCE_MODE.lower().strip() == "process":
+        # spawn: no heredar sesiones ONNX ni el cliente de Firestore vía fork
+        return ProcessPoolExecutor(max_workers=settings.INFERENCE_WORKERS,
+                                   mp_context=multiprocessing.get_context("spawn"))
+    return ThreadPoolExecutor(max_workers=settings.INFERENCE_WORKERS, thread_name_prefix="inference")
+
+
+io_pool = BoundedExecutor(
+    "io",
+    lambda: ThreadPoolExecutor(max_workers=settings.IO_WORKERS, thread_name_prefix="firestore-io"),
+    settings.IO_WORKERS,
+    settings.IO_MAX_QUEUE,
+)
+inference_pool = BoundedExecutor("inference", _inference_factory, settings.INFERENCE_WORKERS, settings.INFERENCE_MAX_QUEUE)
+
+
+async def run_io(fn: Callable, *args, **kwargs) -> Any:
+    """Llamadas bloqueantes (SDK de Firestore) fuera del event loop."""
+    return await io_pool.run(fn, *args, **kwargs)
+
+
+async def run_inference(fn: Callable, *args, **kwargs) -> Any:
+    """
+    Decodificación + inferencia. En modo process `fn` debe ser una función de
+    módulo (picklable), p. ej. face_embedder.embed_images_task.
+    """
+    return await inference_pool.run(fn, *args, **kwargs)
+
+
+def stats() -> Dict[str, Any]:
+    return {"mode": settings.INFERENCE_MODE, "io": io_pool.stats(), "inference": inference_pool.stats()}
+
+
+def shutdown():
+    io_pool.shutdown()
+    inference_pool.shutdown()
@@ -0,0 +1,261 @@
+# app/core/metrics.py
+"""
+Métricas del proceso en el formato de texto de Prometheus (GET /metrics),
+sin dependencias: contadores, histogramas y gauges que se calculan al exportar.
+
+stage("decode") mide una fase del hot path: la observa en el histograma
+vectorai_stage_seconds y, con METRICS_SERVER_TIMING, la suma al header
+Server-Timing del request. En los workers del executor (hilos o procesos) las
+fases se juntan con collect() y las registra el proceso que atiende el
+request (ver core.executor), así que también funcionan con INFERENCE_MODE=process.
+
+Costo: una observación es un bisect y un lock (~1 µs).
+"""
+import bisect
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+from fastapi import Request
+from starlette.routing import Match
+from .config import settings
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_value(v: float) -> str:
+    if math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def lines(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.lines()]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, value: float = 1.0, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def lines(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_value(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # por serie: conteos por bucket (no acumulados; el último es +Inf), suma
+        self._series: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][i] += 1
+            series[1][0] += value
+
+    def lines(self) -> List[str]:
+        with self._lock:
+            items = [(k, list(c), s[0]) for k, (c, s) in self._series.items()]
+        out: List[str] = []
+        for key, counts, total in items:
+            acc = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                acc += n
+                le = 'le="%s"' % _fmt_value(bound)
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, key, le)} {acc}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {_fmt_value(total)}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {acc}")
+        return out
+
+
+GaugeValue = Union[float, Dict[LabelValues, float]]
+
+
+class Gauge(_Metric):
+    """Valor calculado al exportar: fn() devuelve un número o {valores de labels: número}."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Callable[[], GaugeValue], labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def lines(self) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception:
+            return []  # p. ej. la galería todavía no está cargada
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_value(v)}" for k, v in value.items()]
+
+
+REGISTRY: Dict[str, _Metric] = {}
+_registry_lock = threading.Lock()
+
+
+def _register(metric: _Metric) -> _Metric:
+    with _registry_lock:
+        # idempotente: reimportar un módulo no duplica series
+        return REGISTRY.setdefault(metric.name, metric)
+
+
+def counter(name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+    return _register(Counter(name, help, labels))  # type: ignore[return-value]
+
+
+def histogram(name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help, labels, buckets))  # type: ignore[return-value]
+
+
+def gauge(name: str, help: str, fn: Callable[[], GaugeValue], labels: Sequence[str] = ()) -> Gauge:
+    return _register(Gauge(name, help, fn, labels))  # type: ignore[return-value]
+
+
+def render() -> str:
+    with _registry_lock:
+        metrics = list(REGISTRY.values())
+    lines: List[str] = []
+    for m in metrics:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+# --------- fases del hot path ---------
+
+STAGE_SECONDS = histogram("vectorai_stage_seconds", "Time spent per request stage", ("stage",))
+HTTP_SECONDS = histogram("vectorai_http_request_seconds", "Request latency", ("method", "route"))
+HTTP_REQUESTS = counter("vectorai_http_requests_total", "Requests by status", ("method", "route", "status"))
+MATCH_RESULTS = counter("vectorai_match_results_total", "Detection outcomes", ("mode", "result"))
+
+# fases del request en curso (para Server-Timing)
+_request_stages: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar(
+    "request_stages", default=None)
+# fases juntadas dentro de un worker del executor
+_local = threading.local()
+
+
+def record_stage(name: str, seconds: float):
+    collector = getattr(_local, "stages", None)
+    if collector is not None:
+        collector.append((name, seconds))
+        return
+    STAGE_SECONDS.observe(seconds, stage=name)
+    current = _request_stages.get()
+    if current is not None:
+        current.append((name, seconds))
+
+
+def record_stages(stages: Sequence[Tuple[str, float]]):
+    for name, seconds in stages:
+        record_stage(name, seconds)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - t)
+
+
+@contextmanager
+def collect() -> Iterator[List[Tuple[str, float]]]:
+    """Junta las fases medidas en este hilo en vez de registrarlas (workers del executor)."""
+    previous = getattr(_local, "stages", None)
+    _local.stages = out = []
+    try:
+        yield out
+    finally:
+        _local.stages = previous
+
+
+def match_result(mode: str, result: str):
+    """result: matched | below_threshold | no_face | empty_gallery"""
+    MATCH_RESULTS.inc(mode=mode, result=result)
+
+
+def _server_timing(stages: List[Tuple[str, float]], total: float) -> str:
+    summed: Dict[str, float] = {}
+    for name, seconds in stages:
+        summed[name] = summed.get(name, 0.0) + seconds
+    parts = [f"{name.replace(':', '_')};dur={seconds * 1000.0:.2f}" for name, seconds in summed.items()]
+    parts.append(f"total;dur={total * 1000.0:.2f}")
+    return ", ".join(parts)
+
+
+def _route(request: Request) -> str:
+    # la plantilla de la ruta, no el path: los ids no multiplican las series
+    route = request.scope.get("route")
+    if route is None:
+        # rechazado antes del router (429, 413): se busca la ruta a mano
+        for candidate in getattr(request.app, "routes", ()):
+            if candidate.matches(request.scope)[0] == Match.FULL:
+                route = candidate
+                break
+    return getattr(route, "path", "unmatched")
+
+
+async def metrics_middleware(request: Request, call_next):
+    stages: List[Tuple[str, float]] = []
+    token = _request_stages.set(stages)
+    t = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        _request_stages.reset(token)
+    elapsed = time.perf_counter() - t
+    route = _route(request)
+    HTTP_SECONDS.observe(elapsed, method=request.method, route=route)
+    HTTP_REQUESTS.inc(method=request.method, route=route, status=str(response.status_code))
+    if settings.METRICS_SERVER_TIMING:
+        response.headers["Server-Timing"] = _server_timing(stages, elapsed)
+    return response
@@ -1,21 +1,277 @@
+"""
+Rate limit con token bucket por API key (o por IP si el request no trae una
+key conocida: de RATE_LIMIT_KEY_RATES o INTERNAL_SECRET).
+
+Cada identidad tiene un bucket de RATE_LIMIT_BURST tokens que se rellena a
+RATE_LIMIT_PER_MINUTE / 60 tokens por segundo (float: no se pierden
+fracciones). Cada ruta cuesta RATE_LIMIT_ROUTE_COSTS tokens (una imagen
+cuesta más que un vector; costo 0 = sin límite). En /detect/stream cada
+frame del WebSocket paga el costo de la ruta (take(), desde el router): el
+middleware http no ve los mensajes de un WebSocket.
+
+Backends (RATE_LIMIT_BACKEND):
+- memory: dict LRU en el proceso, a lo sumo RATE_LIMIT_MAX_KEYS claves
+- mmap:   tabla hash de tamaño fijo en un archivo mapeado (RATE_LIMIT_FILE),
+          compartida por todos los workers del host; el límite deja de
+          multiplicarse por la cantidad de workers
+
+Otro store (p. ej. Redis) solo necesita implementar RateLimitBackend.take.
+"""
+import hashlib
+import hmac
+import math
+import mmap
+import os
+import struct
+import threading
 import time
-from fastapi import Request, HTTPException, status
-from typing import Dict, Tuple
+from collections import OrderedDict
+from typing import Dict, List, Optional, Protocol, Tuple
+from fastapi import Request
+from starlette.requests import HTTPConnection
+from starlette.responses import JSONResponse
+from .config import settings
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - sin flock (Windows): un solo proceso
+    fcntl = None  # type: ignore
+
+
+def _refill_take(tokens: float, ts: float, cost: float, rate: float, burst: float,
+                 now: float) -> Tuple[bool, float, float]:
+    """Token bucket: (permitido, tokens que quedan, segundos hasta poder pagar `cost`)."""
+    tokens = min(burst, tokens + max(0.0, now - ts) * rate)
+    cost = min(cost, burst)  # un costo mayor que el bucket nunca pasaría
+    if tokens >= cost:
+        return True, tokens - cost, 0.0
+    return False, tokens, (cost - tokens) / rate if rate > 0 else math.inf
+
+
+class RateLimitBackend(Protocol):
+    def take(self, key: str, cost: float, rate: float, burst: float, now: float) -> Tuple[bool, float, float]: ...
+
+
+class MemoryBackend:
+    """Buckets en un OrderedDict: el menos usado sale primero al llegar a max_keys."""
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max(1, max_keys)
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def take(self, key: str, cost: float, rate: float, burst: float, now: float) -> Tuple[bool, float, float]:
+        with self._lock:
+            tokens, ts = self._buckets.get(key, (burst, now))
+            allowed, tokens, retry = _refill_take(tokens, ts, cost, rate, burst, now)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.max_keys:
+                # un bucket olvidado vuelve lleno: solo se pierde el castigo de un cliente inactivo
+                self._buckets.popitem(last=False)
+            return allowed, tokens, retry
+
+
+class MmapBackend:
+    """
+    Tabla hash de `slots` registros (hash u64, tokens f64, ts f64) en un
+    archivo mapeado. Sondeo lineal de PROBES slots: si no hay lugar se pisa
+    el bucket más viejo. Un registro inactivo por más de `idle_s` equivale a
+    un bucket lleno y se puede reutilizar. Exclusión: un lock del proceso
+    más un lock POSIX sobre el rango de slots sondeado (entre procesos).
+    """
+
+    RECORD = struct.Struct("<Qdd")
+    PROBES = 8
+
+    def __init__(self, path: str, slots: int):
+        self.path = path
+        self.slots = max(1, slots)
+        size = (self.slots + self.PROBES) * self.RECORD.size  # sin wrap-around al sondear
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._fd = self._open(path, size)
+        self._mm = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _open(path: str, size: int) -> int:
+        """
+        Abre la tabla; si no existe o tiene otro tamaño (cambió
+        RATE_LIMIT_MAX_KEYS: los buckets anteriores no sirven) se crea una
+        nueva en un archivo aparte y se reemplaza con os.replace. Nunca se
+        trunca un archivo que otro worker puede tener mapeado (SIGBUS al
+        leer más allá del final); los workers viejos siguen con el inode
+        anterior hasta reiniciar.
+        """
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(fd).st_size == size:
+            return fd
+        os.close(fd)
+        lock_fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)  # un solo worker crea la tabla
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(fd).st_size == size:  # otro worker ya la creó
+                return fd
+            os.close(fd)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                os.ftruncate(fd, size)  # archivo nuevo: solo crece, lleno de ceros
+                os.replace(tmp, path)
+            except BaseException:
+                os.close(fd)
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+                raise
+            return fd
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            os.close(lock_fd)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        # hash() de Python cambia entre procesos; 0 marca un slot vacío
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+    def take(self, key: str, cost: float, rate: float, burst: float, now: float) -> Tuple[bool, float, float]:
+        h = self._hash(key)
+        first = h % self.slots
+        rec = self.RECORD
+        start, length = first * rec.size, self.PROBES * rec.size
+        idle_s = burst / rate if rate > 0 else math.inf
+        with self._lock:
+            if fcntl is not None:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+            try:
+                slot, tokens, ts = None, burst, now
+                oldest, oldest_ts = first, math.inf
+                for i in range(first, first + self.PROBES):
+                    kh, t, s = rec.unpack_from(self._mm, i * rec.size)
+                    if kh == h:
+                        slot, tokens, ts = i, t, s
+                        break
+                    if kh == 0 or now - s >= idle_s:
+                        if slot is None:
+                            slot = i  # libre; se sigue buscando por si la clave está más adelante
+                    elif s < oldest_ts:
+                        oldest, oldest_ts = i, s
+                if slot is None:
+                    slot = oldest
+                allowed, tokens, retry = _refill_take(tokens, ts, cost, rate, burst, now)
+                rec.pack_into(self._mm, slot * rec.size, h, tokens, now)
+            finally:
+                if fcntl is not None:
+                    fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+            return allowed, tokens, retry
+
+
+BACKENDS = ("memory", "mmap")
+
+_backend: Optional[RateLimitBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> RateLimitBackend:
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = settings.RATE_LIMIT_BACKEND.lower().strip()
+                if name not in BACKENDS:
+                    raise ValueError(f"Unknown rate limit backend: {name}")
+                if name == "mmap":
+                    _backend = MmapBackend(settings.RATE_LIMIT_FILE, settings.RATE_LIMIT_MAX_KEYS)
+                else:
+                    _backend = MemoryBackend(settings.RATE_LIMIT_MAX_KEYS)
+    return _backend
+
+
+# --------- costos y límites ---------
+
+_parsed: Dict[str, Tuple[str, object]] = {}
+
+
+def _pairs(raw: str) -> Dict[str, float]:
+    """"a=1,b=2" -> {"a": 1.0, "b": 2.0}"""
+    out: Dict[str, float] = {}
+    for item in raw.split(","):
+        name, sep, value = item.strip().rpartition("=")
+        if sep and name:
+            out[name.strip()] = float(value)
+    return out
+
+
+def _cached(name: str, raw: str, build):
+    hit = _parsed.get(name)
+    if hit is None or hit[0] != raw:
+        hit = _parsed[name] = (raw, build(raw))
+    return hit[1]
+
+
+def route_cost(path: str) -> float:
+    """Costo del prefijo más largo de RATE_LIMIT_ROUTE_COSTS que coincide (1 si ninguno)."""
+    routes: List[Tuple[str, float]] = _cached(
+        "routes", settings.RATE_LIMIT_ROUTE_COSTS,
+        lambda raw: sorted(_pairs(raw).items(), key=lambda kv: len(kv[0]), reverse=True),
+    )
+    if path.startswith(settings.API_PREFIX):
+        path = path[len(settings.API_PREFIX):]
+    path = path.rstrip("/") or "/"
+    for prefix, cost in routes:
+        p = prefix.rstrip("/")
+        if path == p or path.startswith(p + "/"):
+            return cost
+    return 1.0
+
+
+def identity(conn: HTTPConnection) -> Tuple[str, float]:
+    """
+    (clave del bucket, tokens por minuto): por API key si es una conocida, si
+    no por IP. Una key cualquiera no abre un bucket propio: rotando keys
+    inventadas se saltearía el límite.
+    """
+    api_key = conn.headers.get("x-api-key")
+    if api_key:
+        rates: Dict[str, float] = _cached("keys", settings.RATE_LIMIT_KEY_RATES, _pairs)
+        if api_key in rates:
+            return f"key:{api_key}", rates[api_key]
+        if hmac.compare_digest(api_key.encode(), settings.INTERNAL_SECRET.encode()):
+            return f"key:{api_key}", settings.RATE_LIMIT_PER_MINUTE
+    ip = conn.client.host if conn.client else "anon"
+    return f"ip:{ip}", settings.RATE_LIMIT_PER_MINUTE
+
+
+def take(conn: HTTPConnection, cost: float) -> Tuple[bool, float, float]:
+    """Cobra `cost` tokens a la identidad de la conexión: (permitido, tokens que quedan, segundos de espera)."""
+    key, per_minute = identity(conn)
+    burst = settings.RATE_LIMIT_BURST or per_minute
+    return get_backend().take(key, cost, per_minute / 60.0, burst, time.time())
 
 
-_BUCKETS: Dict[str, Tuple[float, int]] = {}
-RATE = 60 # tokens per minute
-WINDOW = 60.0
+def retry_after(retry: float) -> int:
+    return max(1, math.ceil(retry)) if math.isfinite(retry) else 60
 
 
 async def rate_limit_middleware(request: Request, call_next):
-    ip = request.client.host if request.client else "anon"
-    now = time.monotonic()
-    refill_time, tokens = _BUCKETS.get(ip, (now, RATE))
-    delta = max(0.0, now - refill_time)
-    tokens = min(RATE, tokens + int(delta * (RATE / WINDOW)))
-    if tokens <= 0:
-        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Rate limit exceeded")
-    _BUCKETS[ip] = (now, tokens - 1)
+    cost = route_cost(request.url.path)
+    if cost <= 0:
+        return await call_next(request)
+    allowed, remaining, retry = take(request, cost)
+    if not allowed:
+        return JSONResponse(
+            status_code=429,
+            content={"detail": "Rate limit exceeded"},
+            headers={"Retry-After": str(retry_after(retry))},
+        )
     response = await call_next(request)
-    return response
\ No newline at end of file
+    response.headers["X-RateLimit-Remaining"] = str(int(remaining))
+    return response
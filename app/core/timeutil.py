@@ -2,4 +2,11 @@ from datetime import datetime, timezone
 
 
 def now_iso() -> str:
-    return datetime.now(timezone.utc).isoformat()
\ No newline at end of file
+    return datetime.now(timezone.utc).isoformat()
+
+
+def as_utc(dt: datetime) -> datetime:
+    # naive = UTC
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
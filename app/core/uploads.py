@@ -0,0 +1,144 @@
+# app/core/uploads.py
+"""
+Límite de tamaño de los uploads (MAX_UPLOAD_MB por imagen).
+
+UploadLimitMiddleware corta el request ANTES de que Starlette bufferee el
+multipart: rechaza por Content-Length y, si el body viene chunked, cuenta
+los bytes a medida que llegan y aborta con 413 al pasarse. En un multipart
+además sigue las partes con el mismo parser de Starlette (python-multipart)
+y corta apenas un archivo pasa MAX_UPLOAD_MB, sin esperar a que se spoolee
+entero. El total de un request batch se topa en MAX_BATCH_UPLOAD_MB.
+read_upload() verifica cada archivo ya parseado.
+"""
+from typing import Iterable, Optional
+from fastapi import HTTPException, UploadFile
+from starlette.responses import JSONResponse
+from .config import settings
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    try:
+        from multipart.multipart import MultipartParser, parse_options_header
+    except ImportError:  # sin python-multipart Starlette tampoco parsea formularios
+        MultipartParser = parse_options_header = None
+
+# holgura para los headers de cada parte del multipart
+PART_OVERHEAD = 64 * 1024
+
+
+def max_file_bytes() -> int:
+    return int(settings.MAX_UPLOAD_MB * 1024 * 1024)
+
+
+def _too_large(limit: int) -> str:
+    return f"Payload too large (limit {limit // (1024 * 1024)} MB)"
+
+
+class _PartCounter:
+    """Cuenta los bytes de cada parte de un multipart a medida que llega el body."""
+
+    def __init__(self, boundary: bytes, limit: int):
+        self.limit = limit
+        self.size = 0
+        self.exceeded = False
+        self._parser = MultipartParser(boundary, {"on_part_begin": self._begin, "on_part_data": self._data})
+
+    def _begin(self):
+        self.size = 0
+
+    def _data(self, data: bytes, start: int, end: int):
+        self.size += end - start
+        if self.size > self.limit:
+            self.exceeded = True
+
+    def feed(self, chunk: bytes) -> bool:
+        """False si alguna parte ya supera el límite."""
+        if self._parser is not None and chunk:
+            try:
+                self._parser.write(chunk)
+            except Exception:
+                # multipart mal formado: lo rechaza el parser de Starlette
+                self._parser = None
+        return not self.exceeded
+
+    @classmethod
+    def for_request(cls, headers: dict, limit: int) -> Optional["_PartCounter"]:
+        if MultipartParser is None:
+            return None
+        content_type, params = parse_options_header(headers.get(b"content-type", b""))
+        boundary = params.get(b"boundary")
+        if content_type != b"multipart/form-data" or not boundary:
+            return None
+        return cls(boundary, limit)
+
+
+class UploadLimitMiddleware:
+    """
+    Middleware ASGI (no BaseHTTPMiddleware: necesita envolver `receive`).
+    Las rutas en `batch_paths` admiten hasta MAX_BATCH_IMAGES imágenes.
+    """
+
+    def __init__(self, app, batch_paths: Iterable[str] = ()):
+        self.app = app
+        self.batch_paths = tuple(batch_paths)
+
+    def limit_for(self, path: str) -> int:
+        single = max_file_bytes() + PART_OVERHEAD
+        if not path.rstrip("/").endswith(self.batch_paths):
+            return single
+        total = int(settings.MAX_BATCH_UPLOAD_MB * 1024 * 1024)
+        return max(single, min(max(1, settings.MAX_BATCH_IMAGES) * single, total))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        limit = self.limit_for(scope["path"])
+        headers = dict(scope["headers"])
+        length = headers.get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > limit:
+            return await JSONResponse(status_code=413, content={"detail": _too_large(limit)})(scope, receive, send)
+
+        parts = _PartCounter.for_request(headers, max_file_bytes())
+        received = 0
+        started = rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] != "http.request":
+                return message
+            body = message.get("body", b"")
+            received += len(body)
+            if received > limit:
+                exceeded = limit
+            elif parts is not None and not parts.feed(body):
+                exceeded = max_file_bytes()
+            else:
+                return message
+            # 413 ya mismo; a la app le llega un disconnect y lo que
+            # intente responder después se descarta
+            rejected = True
+            if not started:
+                await JSONResponse(status_code=413, content={"detail": _too_large(exceeded)})(scope, receive, send)
+            return {"type": "http.disconnect"}
+
+        async def guarded_send(message):
+            nonlocal started
+            if rejected:
+                return
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        await self.app(scope, limited_receive, guarded_send)
+
+
+async def read_upload(file: UploadFile) -> bytes:
+    """Contenido de un archivo del multipart, con 413 si supera MAX_UPLOAD_MB."""
+    limit = max_file_bytes()
+    if file.size is not None and file.size > limit:
+        raise HTTPException(status_code=413, detail=_too_large(limit))
+    return await file.read()
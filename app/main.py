@@ -1,22 +1,80 @@
 
+import asyncio
+import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, PlainTextResponse
 from .core.config import settings
 from .core.ratelimit import rate_limit_middleware
-from .routers import clients, detect_vector, detect_image
+from .core.uploads import UploadLimitMiddleware
+from .core import executor, metrics
+from .routers import clients, detect_vector, detect_image, detect_stream
 from .routers import reports
+from .services import detection_log, embedding_cache, gallery_snapshot, gallery_sync
+from .services.gallery import get_gallery, gallery_loaded
+from .services.face_embedder import embedder_status, warm_up_task
 
 
+_T_IMPORT = time.perf_counter()
+_startup = {"ready": False, "phases_ms": {}, "embedder": None, "error": None}
 
 
-app = FastAPI(title="Face API", version="1.0.0", openapi_url=f"{settings.API_PREFIX}/openapi.json")
+async def _warm_up():
+    # Un warm-up por worker de inferencia (en modo process cada uno carga su modelo)
+    t = time.perf_counter()
+    try:
+        results = await asyncio.gather(*[
+            executor.run_inference(warm_up_task) for _ in range(executor.inference_pool.workers)
+        ])
+        _startup["embedder"] = results[0]
+        _startup["ready"] = True
+    except Exception as e:
+        _startup["error"] = str(e)
+    _startup["phases_ms"]["embedder_warmup_ms"] = (time.perf_counter() - t) * 1000.0
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _startup["phases_ms"]["app_init_ms"] = (time.perf_counter() - _T_IMPORT) * 1000.0
+    task = None
+    if settings.EMBEDDER_PRELOAD:
+        # en background: /health responde de inmediato, /ready espera al modelo
+        task = asyncio.create_task(_warm_up())
+    else:
+        _startup["ready"] = True
+    if gallery_snapshot.enabled() or settings.GALLERY_SYNC != "none":
+        # con snapshot cargar la galería cuesta milisegundos; el feed de
+        # cambios necesita la galería cargada antes de empezar
+        await executor.run_io(get_gallery)
+        gallery_sync.start()
+    if settings.DETECTION_LOG_ASYNC:
+        # re-envía lo que haya quedado en el spool de una ejecución anterior
+        detection_log.get_writer()
+    yield
+    if task is not None and not task.done():
+        task.cancel()
+    gallery_sync.shutdown()
+    detection_log.shutdown()
+    executor.shutdown()
+
+
+app = FastAPI(title="Face API", version="1.0.0", openapi_url=f"{settings.API_PREFIX}/openapi.json", lifespan=lifespan)
 
 
 # Rate limit
 app.middleware("http")(rate_limit_middleware)
 
 
+# Tamaño de los uploads (413 antes de bufferear el multipart)
+app.add_middleware(UploadLimitMiddleware, batch_paths=("/detect/image/batch", "/clients/bulk-face-images"))
+
+
+# Latencia por ruta y Server-Timing (registrado después: envuelve al rate limit
+# y al límite de uploads, así cuenta los 429 y los 413)
+app.middleware("http")(metrics.metrics_middleware)
+
+
 # CORS
 app.add_middleware(
 CORSMiddleware,
@@ -32,10 +90,82 @@ async def health():
     return {"ok": True}
 
 
+@app.get("/ready")
+async def ready():
+    # readiness probe: 503 hasta que el modelo esté cargado y calentado
+    body = {
+        **_startup,
+        "embedder": _startup["embedder"] or embedder_status(),
+        "phases_ms": dict(_startup["phases_ms"]),
+    }
+    return JSONResponse(status_code=200 if _startup["ready"] else 503, content=body)
+
+
+def _gallery_gauge():
+    if not gallery_loaded():
+        return {}
+    s = get_gallery().stats()
+    return {("rows",): s["size"], ("clients",): s["clients"], ("generation",): s["generation"],
+            ("rejected",): s["rejected"]}
+
+
+def _executor_gauge():
+    out = {}
+    for pool in (executor.io_pool, executor.inference_pool):
+        s = pool.stats()
+        out[(pool.name, "inflight")] = s["inflight"]
+        out[(pool.name, "rejected")] = s["rejected"]
+    return out
+
+
+def _embedding_cache_gauge():
+    s = embedding_cache.get_cache().stats()
+    return {("entries",): s["entries"], ("bytes",): s["bytes"]}
+
+
+def _detection_log_gauge():
+    return detection_log.pending()
+
+
+metrics.gauge("vectorai_gallery", "Resident gallery size", _gallery_gauge, ("field",))
+metrics.gauge("vectorai_executor", "Executor pool state", _executor_gauge, ("pool", "field"))
+metrics.gauge("vectorai_embedding_cache", "Embedding cache size", _embedding_cache_gauge, ("field",))
+metrics.gauge("vectorai_detection_log_pending", "Detections waiting to be written", _detection_log_gauge)
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/health/executor")
+async def executor_health():
+    # profundidad de cola, rechazos (503) y tiempo de espera en cola por pool
+    return executor.stats()
+
+
+@app.get("/health/detection-log")
+async def detection_log_health():
+    return detection_log.get_writer().stats() if settings.DETECTION_LOG_ASYNC else {"mode": "sync"}
+
+
+@app.get("/health/embedding-cache")
+async def embedding_cache_health():
+    return embedding_cache.get_cache().stats()
+
+
+@app.get("/health/gallery")
+async def gallery_health():
+    if not gallery_loaded():
+        return {"loaded": False, "sync": gallery_sync.stats()}
+    return {**get_gallery().stats(), "snapshot": gallery_snapshot.stats(), "sync": gallery_sync.stats()}
+
+
 # Mount routers
 app.include_router(clients.router, prefix=settings.API_PREFIX)
 app.include_router(detect_vector.router, prefix=settings.API_PREFIX)
 app.include_router(detect_image.router, prefix=settings.API_PREFIX)
+app.include_router(detect_stream.router, prefix=settings.API_PREFIX)
 app.include_router(reports.router, prefix=settings.API_PREFIX)
 
 
@@ -20,21 +20,86 @@ class ClientUpdate(BaseModel):
 
 class ClientOut(ClientBase):
     embedding_dim: Optional[int] = None
+    templates_count: int = 0
     detecciones_count: int = 0
     detecciones_recent: List[str] = Field(default_factory=list)
 
 
 class FaceVectorIn(BaseModel):
     vector: conlist(float, min_length=1)
+    quality: Optional[float] = Field(default=None, ge=0, le=1, description="Capture quality, used to rank templates")
+    meta: Dict[str, Any] = Field(default_factory=dict)
+    replace: bool = Field(default=False, description="Drop the client's previous templates")
+
+
+class TemplateOut(BaseModel):
+    id: str
+    quality: Optional[float] = None
+    captured_at: Optional[str] = None
+    meta: Dict[str, Any] = Field(default_factory=dict)
+    dim: Optional[int] = None
 
 
 class DetectByVectorIn(BaseModel):
     vector: conlist(float, min_length=1)
     threshold: Optional[float] = None
+    top_k: Optional[int] = Field(default=None, ge=1, le=50, description="Return the k best candidates")
+
+
+class MatchCandidate(BaseModel):
+    client_id: str
+    score: float
 
 
 class DetectResult(BaseModel):
     matched: bool
     client_id: Optional[str] = None
     score: Optional[float] = None
-    message: str
\ No newline at end of file
+    margin: Optional[float] = Field(default=None, description="Score gap between rank 1 and rank 2")
+    candidates: Optional[List[MatchCandidate]] = None
+    gallery_generation: Optional[int] = Field(default=None, description="Gallery version the match was computed against")
+    message: str
+
+
+class FaceMatch(BaseModel):
+    bbox: List[float] = Field(description="x1, y1, x2, y2 in original image pixels")
+    det_score: Optional[float] = None
+    matched: bool
+    client_id: Optional[str] = None
+    score: Optional[float] = None
+    margin: Optional[float] = Field(default=None, description="Score gap between rank 1 and rank 2")
+    candidates: Optional[List[MatchCandidate]] = None
+
+
+class MultiDetectResult(BaseModel):
+    faces: List[FaceMatch] = Field(default_factory=list)
+    matched_count: int = 0
+    gallery_generation: Optional[int] = Field(default=None, description="Gallery version the match was computed against")
+    message: str
+
+
+class StreamFace(BaseModel):
+    vector: conlist(float, min_length=1)
+    bbox: Optional[conlist(float, min_length=4, max_length=4)] = Field(default=None, description="[x1, y1, x2, y2]")
+
+
+class StreamFacesIn(BaseModel):
+    faces: List[StreamFace]
+
+
+class StreamTrack(BaseModel):
+    track_id: int
+    bbox: Optional[List[float]] = None
+    matched: bool
+    client_id: Optional[str] = None
+    score: Optional[float] = None
+    new: bool = Field(default=False, description="Identified on this frame")
+
+
+class StreamFrameResult(BaseModel):
+    frame: int
+    tracks: List[StreamTrack] = Field(default_factory=list)
+    embedded: int = Field(default=0, description="Faces that went through recognition on this frame")
+    logged: List[str] = Field(default_factory=list, description="Clients whose detection was recorded")
+    gallery_generation: Optional[int] = None
+    error: Optional[str] = None
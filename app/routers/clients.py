@@ -1,33 +1,85 @@
 
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, status
-from ..models.schemas import ClientCreate, ClientOut, ClientUpdate, FaceVectorIn
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Query, Response, status
+from ..models.schemas import ClientCreate, ClientOut, ClientUpdate, FaceVectorIn, TemplateOut
 from ..core.security import api_key_guard
+from ..core.uploads import read_upload
 from ..core.config import settings
-from ..services import firebase_client as fb
-from ..services.face_embedder import FaceEmbedder
-from typing import List
+from ..core.executor import run_io
+from ..services.storage import get_storage
+from ..services.face_embedder import normalize_vector
+from ..services import embedding_cache
+import os
+from typing import Any, Dict, List, Optional
 
 router = APIRouter(prefix="/clients", tags=["clients"])
 
 
-_embedder = FaceEmbedder()
+async def _save_vector(client_id: str, v: List[float], dim: int, quality: Optional[float] = None,
+                       meta: Optional[Dict[str, Any]] = None, replace: bool = False) -> Dict[str, Any]:
+    """Guarda el embedding como una plantilla más del cliente (ver services/templates)."""
+    try:
+        return await run_io(get_storage().add_client_template, client_id, v, dim, quality, meta, replace)
+    except ValueError as e:
+        # p. ej. dimensión distinta a la del archivo de vectores local
+        raise HTTPException(status_code=422, detail=str(e))
 
 
 @router.post("/", dependencies=[Depends(api_key_guard)], response_model=ClientOut)
 async def create_client(payload: ClientCreate):
-    fb.create_client(payload.model_dump())
-    data = fb.read_client(payload.id)
+    await run_io(get_storage().create_client, payload.model_dump())
+    data = await run_io(get_storage().read_client, payload.id)
     return data # type: ignore
 
 
 @router.get("/", dependencies=[Depends(api_key_guard)], response_model=List[ClientOut])
-async def list_clients(limit: int = 100):
-    return fb.list_clients(limit=limit)  # type: ignore
+async def list_clients(response: Response, limit: int = Query(100, ge=1, le=1000),
+                       start_after: Optional[str] = None):
+    """
+    Paginado por cursor: si la página viene llena, X-Next-Cursor trae el id
+    a pasar como `start_after` para pedir la siguiente.
+    """
+    page = await run_io(get_storage().list_clients, limit=limit, start_after=start_after)
+    if len(page) == limit:
+        response.headers["X-Next-Cursor"] = page[-1]["id"]
+    return page  # type: ignore
+
+
+@router.post("/bulk-face-images", dependencies=[Depends(api_key_guard)])
+async def bulk_face_images(files: List[UploadFile] = File(...), client_ids: List[str] = Form(default=[])):
+    """
+    Enrolamiento masivo: una imagen por cliente. `client_ids` va en el mismo
+    orden que `files`; si se omite se usa el nombre del archivo sin extensión.
+    """
+    if len(files) > settings.MAX_BATCH_IMAGES:
+        raise HTTPException(status_code=413, detail=f"At most {settings.MAX_BATCH_IMAGES} images per request")
+    if client_ids and len(client_ids) != len(files):
+        raise HTTPException(status_code=422, detail="client_ids must have one entry per file")
+    ids = client_ids or [os.path.splitext(f.filename or "")[0] for f in files]
+    if not all(ids):
+        raise HTTPException(status_code=422, detail="Missing client id for some files")
+    for f in files:
+        if not f.content_type or not f.content_type.startswith("image/"):
+            raise HTTPException(status_code=415, detail="Only image uploads are supported")
+    contents = [await read_upload(f) for f in files]
+    embs = await embedding_cache.embed_images(contents)
+    results = []
+    for cid, emb in zip(ids, embs):
+        if emb is None:
+            results.append({"client_id": cid, "ok": False, "detail": "No face detected in image"})
+            continue
+        v = normalize_vector(emb)
+        try:
+            saved = await _save_vector(cid, v, len(v))
+        except HTTPException as e:
+            results.append({"client_id": cid, "ok": False, "detail": e.detail})
+            continue
+        results.append({"client_id": cid, "ok": True, "embedding_dim": len(v), **saved})
+    return {"ok": all(r["ok"] for r in results), "results": results}
 
 
 @router.get("/{client_id}", dependencies=[Depends(api_key_guard)], response_model=ClientOut)
 async def get_client(client_id: str):
-    data = fb.read_client(client_id)
+    data = await run_io(get_storage().read_client, client_id)
     if not data:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Client not found")
     return data # type: ignore
@@ -35,31 +87,44 @@ async def get_client(client_id: str):
 
 @router.patch("/{client_id}", dependencies=[Depends(api_key_guard)])
 async def update_client(client_id: str, payload: ClientUpdate):
-    fb.update_client(client_id, {k: v for k, v in payload.model_dump(exclude_none=True).items()})
+    await run_io(get_storage().update_client, client_id, {k: v for k, v in payload.model_dump(exclude_none=True).items()})
     return {"ok": True}
 
 
 @router.delete("/{client_id}", dependencies=[Depends(api_key_guard)])
 async def remove_client(client_id: str):
-    fb.delete_client(client_id)
+    await run_io(get_storage().delete_client, client_id)
     return {"ok": True}
 
 
 @router.post("/{client_id}/face-vectors", dependencies=[Depends(api_key_guard)])
 async def set_vector(client_id: str, vec: FaceVectorIn):
-    v = _embedder.normalize_vector(vec.vector)
-    fb.set_client_vector(client_id, v, settings.EMBEDDING_DIM)
-    return {"ok": True, "embedding_dim": settings.EMBEDDING_DIM}
+    v = normalize_vector(vec.vector)
+    saved = await _save_vector(client_id, v, settings.EMBEDDING_DIM, vec.quality, vec.meta, vec.replace)
+    return {"ok": True, "embedding_dim": settings.EMBEDDING_DIM, **saved}
 
 
 @router.post("/{client_id}/face-image", dependencies=[Depends(api_key_guard)])
-async def set_vector_from_image(client_id: str, file: UploadFile = File(...)):
+async def set_vector_from_image(client_id: str, file: UploadFile = File(...),
+                                quality: Optional[float] = Query(None, ge=0, le=1), replace: bool = False):
     if not file.content_type or not file.content_type.startswith("image/"):
         raise HTTPException(status_code=415, detail="Only image uploads are supported")
-    content = await file.read()
-    emb = _embedder.embed_image(content)
+    content = await read_upload(file)
+    emb = await embedding_cache.embed_image(content)
     if emb is None:
         raise HTTPException(status_code=422, detail="No face detected in image")
-    v = _embedder.normalize_vector(emb)
-    fb.set_client_vector(client_id, v, len(v))
-    return {"ok": True, "embedding_dim": len(v)}
\ No newline at end of file
+    v = normalize_vector(emb)
+    saved = await _save_vector(client_id, v, len(v), quality, {"source": "image", "filename": file.filename}, replace)
+    return {"ok": True, "embedding_dim": len(v), **saved}
+
+
+@router.get("/{client_id}/templates", dependencies=[Depends(api_key_guard)], response_model=List[TemplateOut])
+async def list_templates(client_id: str):
+    return await run_io(get_storage().list_client_templates, client_id)  # type: ignore
+
+
+@router.delete("/{client_id}/templates/{template_id}", dependencies=[Depends(api_key_guard)])
+async def remove_template(client_id: str, template_id: str):
+    if not await run_io(get_storage().delete_client_template, client_id, template_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Template not found")
+    return {"ok": True}
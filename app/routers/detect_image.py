@@ -1,39 +1,139 @@
 
-from typing import Optional
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Request
+from typing import Dict, List, Optional, Tuple
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Request, Query
 from ..core.security import api_key_guard
+from ..core.uploads import read_upload
 from ..core.config import settings
-from ..models.schemas import DetectResult
-from ..services import firebase_client as fb
-from ..services.face_embedder import FaceEmbedder
-from ..services.matcher import best_match
+from ..core.executor import run_inference, run_io
+from ..core import metrics
+from ..models.schemas import DetectResult, FaceMatch, MatchCandidate, MultiDetectResult
+from ..services.face_embedder import embed_faces_task, normalize_vector
+from ..services import detection_log, embedding_cache
+from ..services.gallery import get_gallery
+from ..services.matcher import margin
 
 
 router = APIRouter(prefix="/detect/image", tags=["detect-image"])
-_embedder = FaceEmbedder()
 
 
-async def _all_candidates(limit: int = 1000):
-    return fb.list_clients(limit=limit)
+def _check_image(file: UploadFile):
+    if not file.content_type or not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=415, detail="Only image uploads are supported")
+
+
+def _source(req: Request, mode: str):
+    return {"path": str(req.url.path), "ip": req.client.host if req.client else None, "mode": mode}
+
+
+async def _to_result(req: Request, ranked: List[Tuple[str, float]], thr: float, top_k: Optional[int],
+                     generation: Optional[int] = None) -> DetectResult:
+    if not ranked:
+        metrics.match_result("image", "empty_gallery")
+        return DetectResult(matched=False, gallery_generation=generation, message="No clients registered yet")
+    client_id, score = ranked[0]
+    metrics.match_result("image", "matched" if score >= thr else "below_threshold")
+    extra = {
+        "gallery_generation": generation,
+        "margin": margin(ranked),
+        "candidates": [MatchCandidate(client_id=c, score=s) for c, s in ranked[:top_k]] if top_k else None,
+    }
+    if score >= thr:
+        await detection_log.record(client_id, score, source=_source(req, "image"))
+        return DetectResult(matched=True, client_id=client_id, score=score, message="Face recognized", **extra)
+    else:
+        return DetectResult(matched=False, message="Face not found (below threshold)", **extra)
 
 
 @router.post("/", dependencies=[Depends(api_key_guard)], response_model=DetectResult)
-async def detect_by_image(req: Request, file: UploadFile = File(...), threshold:  Optional[float] = None):
-    if not file.content_type or not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=415, detail="Only image uploads are supported")
-    content = await file.read()
-    emb = _embedder.embed_image(content)
+async def detect_by_image(req: Request, file: UploadFile = File(...), threshold:  Optional[float] = None,
+                          top_k: Optional[int] = Query(default=None, ge=1, le=50)):
+    _check_image(file)
+    content = await read_upload(file)
+    emb = await embedding_cache.embed_image(content)
     if emb is None:
+        metrics.match_result("image", "no_face")
         return DetectResult(matched=False, message="No face detected in image")
-    q = _embedder.normalize_vector(emb)
-    cands = await _all_candidates()
-    match = best_match(q, cands)
+    q = normalize_vector(emb)
+    gallery = await run_io(get_gallery)
+    try:
+        ranked = await run_io(gallery.search, q, k=max(top_k or 1, 2))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return await _to_result(req, ranked, threshold or settings.MATCH_THRESHOLD, top_k, gallery.generation)
+
+
+@router.post("/batch", dependencies=[Depends(api_key_guard)], response_model=List[DetectResult])
+async def detect_by_image_batch(req: Request, files: List[UploadFile] = File(...), threshold: Optional[float] = None,
+                                top_k: Optional[int] = Query(default=None, ge=1, le=50)):
+    """Varias imágenes en un multipart; resultados en el mismo orden que `files`."""
+    if len(files) > settings.MAX_BATCH_IMAGES:
+        raise HTTPException(status_code=413, detail=f"At most {settings.MAX_BATCH_IMAGES} images per request")
+    for f in files:
+        _check_image(f)
+    contents = [await read_upload(f) for f in files]
+    embs = await embedding_cache.embed_images(contents)
+    found = [i for i, e in enumerate(embs) if e is not None]
+    ranked_all: List[List[Tuple[str, float]]] = []
+    generation: Optional[int] = None
+    if found:
+        gallery = await run_io(get_gallery)
+        try:
+            ranked_all = await run_io(gallery.search_batch, [embs[i] for i in found], k=max(top_k or 1, 2))
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        generation = gallery.generation
+    ranked_by_pos = dict(zip(found, ranked_all))
     thr = threshold or settings.MATCH_THRESHOLD
-    if match is None:
-        return DetectResult(matched=False, message="No clients registered yet")
-    client_id, score = match
-    if score >= thr:
-        fb.log_detection(client_id, score, source={"path": str(req.url.path), "ip": req.client.host if req.client else None, "mode": "image"})
-        return DetectResult(matched=True, client_id=client_id, score=score, message="Face recognized")
-    else:
-        return DetectResult(matched=False, message="Face not found (below threshold)")
\ No newline at end of file
+    results: List[DetectResult] = []
+    for i, emb in enumerate(embs):
+        if emb is None:
+            metrics.match_result("image", "no_face")
+            results.append(DetectResult(matched=False, message="No face detected in image"))
+        else:
+            results.append(await _to_result(req, ranked_by_pos[i], thr, top_k, generation))
+    return results
+
+
+@router.post("/multi", dependencies=[Depends(api_key_guard)], response_model=MultiDetectResult)
+async def detect_faces_in_image(req: Request, file: UploadFile = File(...), threshold: Optional[float] = None,
+                                top_k: Optional[int] = Query(default=None, ge=1, le=50)):
+    """
+    Todas las caras de la imagen (p. ej. una fila en la puerta), no solo la
+    más grande: un solo match batched contra la galería y un solo write con
+    las detecciones. Un cliente que aparece en dos caras cuenta una vez.
+    """
+    _check_image(file)
+    content = await read_upload(file)
+    faces = await run_inference(embed_faces_task, content)
+    if not faces:
+        metrics.match_result("multi", "no_face")
+        return MultiDetectResult(message="No face detected in image")
+    gallery = await run_io(get_gallery)
+    try:
+        ranked_all = await run_io(gallery.search_batch, [f["embedding"] for f in faces], k=max(top_k or 1, 2))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    thr = threshold or settings.MATCH_THRESHOLD
+    results: List[FaceMatch] = []
+    best: Dict[str, float] = {}
+    for face, ranked in zip(faces, ranked_all):
+        m = FaceMatch(
+            bbox=face["bbox"],
+            det_score=face["det_score"],
+            matched=False,
+            margin=margin(ranked),
+            candidates=[MatchCandidate(client_id=c, score=s) for c, s in ranked[:top_k]] if top_k else None,
+        )
+        if ranked and ranked[0][1] >= thr:
+            m.matched, m.client_id, m.score = True, ranked[0][0], ranked[0][1]
+            best[m.client_id] = max(best.get(m.client_id, m.score), m.score)
+        metrics.match_result("multi", "matched" if m.matched else "below_threshold" if ranked else "empty_gallery")
+        results.append(m)
+    source = _source(req, "multi")
+    await detection_log.record_many([detection_log.make_event(c, s, source) for c, s in best.items()])
+    return MultiDetectResult(
+        faces=results,
+        matched_count=len(best),
+        gallery_generation=gallery.generation,
+        message=f"{len(best)} of {len(faces)} faces recognized",
+    )
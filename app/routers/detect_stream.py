@@ -0,0 +1,134 @@
+import json
+import time
+from typing import Any, Dict, List, Optional
+from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect
+from pydantic import ValidationError
+from ..core.security import api_key_guard
+from ..core.uploads import max_file_bytes
+from ..core.config import settings
+from ..core.executor import run_inference, run_io
+from ..core import metrics, ratelimit
+from ..models.schemas import StreamFace, StreamFacesIn, StreamFrameResult, StreamTrack
+from ..services.face_embedder import embed_faces_task
+from ..services import detection_log
+from ..services.gallery import get_gallery
+from ..services.tracker import FaceTracker, Track, debouncer
+
+
+router = APIRouter(prefix="/detect/stream", tags=["detect-stream"])
+
+
+async def _faces(message: Dict[str, Any], tracker: FaceTracker, now: float) -> List[Dict[str, Any]]:
+    """Caras de un mensaje: un frame binario (imagen) o JSON con vectores."""
+    if message.get("bytes") is not None:
+        content = message["bytes"]
+        if len(content) > max_file_bytes():
+            raise HTTPException(status_code=413, detail=f"Frame larger than {settings.MAX_UPLOAD_MB} MB")
+        # las caras que ya siguen un track reconocido solo se detectan, sin reconocimiento
+        return await run_inference(embed_faces_task, content, tracker.skip_boxes(now), settings.STREAM_TRACK_IOU)
+    try:
+        data = json.loads(message.get("text") or "")
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Expected an image frame or a JSON message")
+    try:
+        if isinstance(data, dict) and "faces" in data:
+            items = StreamFacesIn.model_validate(data).faces
+        else:
+            items = [StreamFace.model_validate(data)]
+    except ValidationError as e:
+        err = e.errors()[0]
+        loc = ".".join(str(p) for p in err["loc"])
+        raise HTTPException(status_code=422, detail=f"Invalid frame: {loc}: {err['msg']}" if loc else f"Invalid frame: {err['msg']}")
+    return [{"bbox": f.bbox, "embedding": f.vector} for f in items]
+
+
+async def _match(tracks: List[Track], now: float, thr: float, source: Dict[str, Any]) -> Dict[str, Any]:
+    """Compara contra la galería solo los tracks que lo necesitan, en un batch."""
+    pending = list({t.id: t for t in tracks if t.needs_match(now)}.values())
+    if not pending:
+        return {"new": set(), "logged": [], "generation": None}
+    gallery = await run_io(get_gallery)
+    try:
+        ranked_all = await run_io(gallery.search_batch, [t.query for t in pending], k=1)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    new, events = set(), []
+    for t, ranked in zip(pending, ranked_all):
+        t.tried_at = now
+        matched = bool(ranked) and ranked[0][1] >= thr
+        metrics.match_result("stream", "matched" if matched else "below_threshold" if ranked else "empty_gallery")
+        if not matched:
+            # un track reconocido que ya no se parece (p. ej. otra persona en su lugar) pierde la identidad
+            t.client_id = t.score = None
+            continue
+        client_id, t.score = ranked[0]
+        if client_id == t.client_id:
+            continue  # re-verificado
+        t.client_id = client_id
+        new.add(t.id)
+        if debouncer.allow(t.client_id, now):
+            events.append(detection_log.make_event(t.client_id, t.score, source))
+    await detection_log.record_many(events)
+    return {"new": new, "logged": [e["client_id"] for e in events], "generation": gallery.generation}
+
+
+@router.websocket("", dependencies=[Depends(api_key_guard)])
+async def detect_stream(ws: WebSocket, threshold: Optional[float] = None, camera: Optional[str] = None):
+    """
+    Stream de una cámara. Cada mensaje es un frame: binario (JPEG/PNG) o
+    texto JSON con embeddings ya calculados, {"vector": [...]} o
+    {"faces": [{"vector": [...], "bbox": [x1, y1, x2, y2]}]}.
+
+    Las caras se siguen entre frames y cada track se compara contra la galería
+    a lo sumo una vez cada STREAM_RETRY_SECONDS (los reconocidos se
+    re-verifican); la detección se registra al reconocerlo, con debounce por cliente
+    (STREAM_DEBOUNCE_SECONDS). Por cada frame se responde un StreamFrameResult.
+    """
+    await ws.accept()
+    tracker = FaceTracker()
+    thr = threshold or settings.MATCH_THRESHOLD
+    source = {"path": ws.url.path, "ip": ws.client.host if ws.client else None, "mode": "stream", "camera": camera}
+    frame = 0
+    cost = ratelimit.route_cost(ws.url.path)
+    try:
+        while True:
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            frame += 1
+            now = time.monotonic()
+            # el middleware http no ve los frames: cada uno paga el costo de la ruta
+            if cost > 0:
+                allowed, _, retry = ratelimit.take(ws, cost)
+                if not allowed:
+                    error = f"Rate limit exceeded (retry after {ratelimit.retry_after(retry)}s)"
+                    await ws.send_json(StreamFrameResult(frame=frame, error=error).model_dump())
+                    continue
+            try:
+                faces = await _faces(message, tracker, now)
+                tracks = tracker.update(faces, now)
+                matched = await _match(tracks, now, thr, source)
+            except HTTPException as e:
+                # p. ej. 503 con la cola de inferencia llena: se descarta el frame
+                await ws.send_json(StreamFrameResult(frame=frame, error=str(e.detail)).model_dump())
+                continue
+            result = StreamFrameResult(
+                frame=frame,
+                tracks=[
+                    StreamTrack(
+                        track_id=t.id,
+                        bbox=t.bbox.tolist() if t.bbox is not None else None,
+                        matched=t.identified,
+                        client_id=t.client_id,
+                        score=t.score,
+                        new=t.id in matched["new"],
+                    )
+                    for t in tracks
+                ],
+                embedded=sum(1 for f in faces if f.get("embedding") is not None),
+                logged=matched["logged"],
+                gallery_generation=matched["generation"],
+            )
+            await ws.send_json(result.model_dump())
+    except WebSocketDisconnect:
+        pass
@@ -1,32 +1,40 @@
  
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, HTTPException, Request
 from ..core.security import api_key_guard
 from ..core.config import settings
-from ..models.schemas import DetectByVectorIn, DetectResult
-from ..services import firebase_client as fb
-from ..services.face_embedder import FaceEmbedder
-from ..services.matcher import best_match
+from ..core.executor import run_io
+from ..core import metrics
+from ..models.schemas import DetectByVectorIn, DetectResult, MatchCandidate
+from ..services.face_embedder import normalize_vector
+from ..services import detection_log
+from ..services.gallery import get_gallery
+from ..services.matcher import margin
 
 
 router = APIRouter(prefix="/detect/vector", tags=["detect-vector"])
-_embedder = FaceEmbedder()
-
-
-async def _all_candidates(limit: int = 1000):
-    return fb.list_clients(limit=limit)
 
 
 @router.post("/", dependencies=[Depends(api_key_guard)], response_model=DetectResult)
 async def detect_by_vector(req: Request, payload: DetectByVectorIn):
-    q = _embedder.normalize_vector(payload.vector)
-    cands = await _all_candidates()
-    match = best_match(q, cands)
+    q = normalize_vector(payload.vector)
+    gallery = await run_io(get_gallery)
+    try:
+        ranked = await run_io(gallery.search, q, k=max(payload.top_k or 1, 2))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
     thr = payload.threshold or settings.MATCH_THRESHOLD
-    if match is None:
-        return DetectResult(matched=False, message="No clients registered yet")
-    client_id, score = match
+    if not ranked:
+        metrics.match_result("vector", "empty_gallery")
+        return DetectResult(matched=False, gallery_generation=gallery.generation, message="No clients registered yet")
+    client_id, score = ranked[0]
+    extra = {
+        "gallery_generation": gallery.generation,
+        "margin": margin(ranked),
+        "candidates": [MatchCandidate(client_id=c, score=s) for c, s in ranked[:payload.top_k]] if payload.top_k else None,
+    }
+    metrics.match_result("vector", "matched" if score >= thr else "below_threshold")
     if score >= thr:
-        fb.log_detection(client_id, score, source={"path": str(req.url.path), "ip": req.client.host if req.client else None, "mode": "vector"})
-        return DetectResult(matched=True, client_id=client_id, score=score, message="Face recognized")
+        await detection_log.record(client_id, score, source={"path": str(req.url.path), "ip": req.client.host if req.client else None, "mode": "vector"})
+        return DetectResult(matched=True, client_id=client_id, score=score, message="Face recognized", **extra)
     else:
-        return DetectResult(matched=False, message="Face not found (below threshold)")
\ No newline at end of file
+        return DetectResult(matched=False, message="Face not found (below threshold)", **extra)
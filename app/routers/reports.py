@@ -1,13 +1,69 @@
 # app/routers/reports.py
-from fastapi import APIRouter, Depends
-from datetime import datetime, date, time
-from typing import Optional, List, Dict, Any
+import csv
+import io
+import json
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from datetime import datetime, date, time, timedelta
+from typing import Optional, List, Dict, Any, Iterator, Tuple
 from ..core.security import api_key_guard
-from ..services import firebase_client as fb
+from ..core.config import settings
+from ..core.executor import run_io
+from ..services.storage import get_storage
 
 router = APIRouter(prefix="/reports", tags=["reports"])
 
 
+def _first_arrivals(target_date: date) -> Tuple[Dict[str, Dict[str, Any]], int]:
+    """
+    Una pasada en streaming sobre las detecciones del día (consulta por rango en
+    Firestore): primera llegada por persona + total de eventos, sin armar la lista.
+    Corre en el pool de I/O porque el stream bloquea.
+    """
+    first_by_person: Dict[str, Dict[str, Any]] = {}
+    total = 0
+    for det in get_storage().iter_detections_for_date(target_date):
+        total += 1
+        cid = det["client_id"]
+        ts = det["timestamp"]
+        if cid not in first_by_person or ts < first_by_person[cid]["timestamp"]:
+            first_by_person[cid] = {
+                "timestamp": ts,
+                "score": det.get("score"),
+            }
+    return first_by_person, total
+
+
+def _rollup_arrivals(target_date: date) -> Tuple[Dict[str, Dict[str, Any]], int]:
+    """Lo mismo que _first_arrivals pero desde los rollups: un documento por persona."""
+    first_by_person: Dict[str, Dict[str, Any]] = {}
+    total = 0
+    for r in get_storage().iter_rollups(target_date, target_date):
+        total += int(r.get("count") or 0)
+        first_by_person[r["client_id"]] = {
+            "timestamp": r["first_seen"],
+            "score": r.get("best_score"),
+            "name": r.get("name"),
+            "area": r.get("area"),
+        }
+    return first_by_person, total
+
+
+def _rollups_from() -> Optional[date]:
+    """Primer día que se puede leer de los rollups (None = ninguno)."""
+    if not settings.REPORTS_USE_ROLLUPS:
+        return None
+    return get_storage().rollup_coverage()
+
+
+def _arrivals(target_date: date) -> Tuple[Dict[str, Dict[str, Any]], int]:
+    since = _rollups_from()
+    if since is not None and target_date >= since:
+        return _rollup_arrivals(target_date)
+    # días anteriores a los rollups (o el día en que se activaron, que solo
+    # tiene la parte posterior): recalcular desde las detecciones
+    return _first_arrivals(target_date)
+
 
 @router.get("/late", dependencies=[Depends(api_key_guard)])
 async def late_report(day: Optional[str] = None, cutoff: str = "09:00"):
@@ -16,40 +72,32 @@ async def late_report(day: Optional[str] = None, cutoff: str = "09:00"):
     else:
         target_date = date.fromisoformat(day)
 
-    detections = fb.list_detections_for_date(target_date)
+    first_by_person, _ = await run_io(_arrivals, target_date)
 
     # Parsear cutoff
     h, m = cutoff.split(":")
     cutoff_dt = datetime.combine(target_date, time(hour=int(h), minute=int(m)))
 
-    first_by_person: Dict[str, Dict[str, Any]] = {}
-
-    for det in detections:
-        cid = det["client_id"]
-        ts = det["timestamp"]  # ya viene como datetime o string
-
-        if isinstance(ts, str):
-            ts = datetime.fromisoformat(ts)
-
-        if cid not in first_by_person or ts < first_by_person[cid]["timestamp"]:
-            first_by_person[cid] = {
-                "timestamp": ts,
-                "score": det.get("score"),
-            }
+    late_ids = [cid for cid, info in first_by_person.items()
+                if cid is not None and info["timestamp"] > cutoff_dt]
+    # el snapshot del rollup ya trae name/area; el resto en un solo get_all
+    missing = [cid for cid in late_ids if "name" not in first_by_person[cid]]
+    profiles = await run_io(get_storage().read_clients, missing, fields=["name", "meta"]) if missing else {}
 
     late: List[Dict[str, Any]] = []
-    for cid, info in first_by_person.items():
-        if cid is None:
-            continue
-        if info["timestamp"] > cutoff_dt:
-            client = fb.read_client(cid) or {}
-            late.append({
-                "client_id": cid,
-                "name": client.get("name"),
-                "area": (client.get("meta") or {}).get("area"),  # si guardas área en meta
-                "arrival_time": info["timestamp"].isoformat(),
-                "delay_minutes": int((info["timestamp"] - cutoff_dt).total_seconds() // 60),
-            })
+    for cid in late_ids:
+        info = first_by_person[cid]
+        if "name" in info:
+            client = {"name": info["name"], "meta": {"area": info["area"]}}
+        else:
+            client = profiles.get(cid, {})
+        late.append({
+            "client_id": cid,
+            "name": client.get("name"),
+            "area": (client.get("meta") or {}).get("area"),  # si guardas área en meta
+            "arrival_time": info["timestamp"].isoformat(),
+            "delay_minutes": int((info["timestamp"] - cutoff_dt).total_seconds() // 60),
+        })
 
     return {
         "date": target_date.isoformat(),
@@ -72,9 +120,9 @@ async def daily_summary(day: Optional[str] = None):
     else:
         target_date = date.fromisoformat(day)
 
-    detections = fb.list_detections_for_date(target_date)
+    first_by_person, total_events = await run_io(_arrivals, target_date)
 
-    if not detections:
+    if not total_events:
         return {
             "date": target_date.isoformat(),
             "total_events": 0,
@@ -82,26 +130,183 @@ async def daily_summary(day: Optional[str] = None):
             "avg_first_checkin": None,
         }
 
-    # Agrupar por persona para obtener la primera detección del día
-    from collections import defaultdict
-    first_by_person: Dict[str, datetime] = {}
-    for det in detections:
-        cid = det["client_id"]
-        ts = det["timestamp"]
-        if isinstance(ts, str):
-            ts = datetime.fromisoformat(ts)
-        if cid not in first_by_person or ts < first_by_person[cid]:
-            first_by_person[cid] = ts
-
     # Calcular promedio de hora de llegada
-    times = list(first_by_person.values())
+    times = [info["timestamp"] for info in first_by_person.values()]
     avg_ts = datetime.fromtimestamp(
         sum(t.timestamp() for t in times) / len(times)
     )
 
     return {
         "date": target_date.isoformat(),
-        "total_events": len(detections),
+        "total_events": total_events,
         "unique_people": len(first_by_person),
         "avg_first_checkin": avg_ts.isoformat(),
     }
+
+
+# --------- rangos de fechas ---------
+
+RANGE_COLUMNS = {
+    "day_client": ["day", "client_id", "name", "area", "first_seen", "last_seen", "count", "best_score"],
+    "day": ["day", "total_events", "unique_people", "avg_first_checkin"],
+    "client": ["client_id", "name", "area", "days_present", "total_events", "first_seen", "last_seen", "best_score"],
+}
+MEDIA_TYPES = {"json": "application/json", "ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def _rows_from_detections(first_day: date, last_day: date) -> Iterator[Dict[str, Any]]:
+    """
+    Una sola pasada por las detecciones del rango (vienen ordenadas por `at`):
+    se agrega por cliente el día en curso y se emite al cambiar de día, así que
+    la memoria depende de la gente de un día, no del largo del rango.
+    """
+    start = datetime.combine(first_day, time.min)
+    end = datetime.combine(last_day + timedelta(days=1), time.min)
+    current_day: Optional[str] = None
+    by_client: Dict[str, Dict[str, Any]] = {}
+    for det in get_storage().iter_detections(start, end):
+        ts = det["timestamp"]
+        day = ts.date().isoformat()
+        if day != current_day:
+            yield from _with_profiles(by_client)
+            current_day, by_client = day, {}
+        cid = det["client_id"]
+        score = det.get("score")
+        r = by_client.get(cid)
+        if r is None:
+            by_client[cid] = {"day": day, "client_id": cid, "name": None, "area": None,
+                              "first_seen": ts, "last_seen": ts, "count": 1, "best_score": score}
+            continue
+        r["first_seen"] = min(r["first_seen"], ts)
+        r["last_seen"] = max(r["last_seen"], ts)
+        r["count"] += 1
+        if score is not None and (r["best_score"] is None or score > r["best_score"]):
+            r["best_score"] = score
+    yield from _with_profiles(by_client)
+
+
+def _with_profiles(by_client: Dict[str, Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    # name/area de las personas de un día con un solo get_all
+    profiles = get_storage().read_clients(list(by_client), fields=["name", "meta"]) if by_client else {}
+    for cid, r in by_client.items():
+        p = profiles.get(cid) or {}
+        r["name"] = p.get("name")
+        r["area"] = (p.get("meta") or {}).get("area")
+        yield r
+
+
+def _rows_from_rollups(first_day: date, last_day: date) -> Iterator[Dict[str, Any]]:
+    """
+    Días cubiertos por los rollups (ver rollup_coverage) desde los rollups; los
+    anteriores, con una pasada por las detecciones. El orden por día se mantiene.
+    """
+    since = get_storage().rollup_coverage()
+    if since is None or since > last_day:
+        yield from _rows_from_detections(first_day, last_day)
+        return
+    if first_day < since:
+        yield from _rows_from_detections(first_day, since - timedelta(days=1))
+    for r in get_storage().iter_rollups(max(first_day, since), last_day):
+        yield {k: r.get(k) for k in RANGE_COLUMNS["day_client"]}
+
+
+def _by_day(rows: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    # las filas llegan ordenadas por día: se emite cada día al terminar
+    current: Optional[Dict[str, Any]] = None
+    firsts: List[float] = []
+    for r in rows:
+        if current is None or r["day"] != current["day"]:
+            if current is not None:
+                yield _close_day(current, firsts)
+            current, firsts = {"day": r["day"], "total_events": 0, "unique_people": 0}, []
+        current["total_events"] += int(r["count"] or 0)
+        current["unique_people"] += 1
+        firsts.append(r["first_seen"].timestamp())
+    if current is not None:
+        yield _close_day(current, firsts)
+
+
+def _close_day(day: Dict[str, Any], firsts: List[float]) -> Dict[str, Any]:
+    day["avg_first_checkin"] = datetime.fromtimestamp(sum(firsts) / len(firsts)) if firsts else None
+    return day
+
+
+def _by_client(rows: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    # un acumulador por cliente (acotado por la cantidad de empleados)
+    acc: Dict[str, Dict[str, Any]] = {}
+    for r in rows:
+        a = acc.get(r["client_id"])
+        if a is None:
+            acc[r["client_id"]] = {"client_id": r["client_id"], "name": r.get("name"), "area": r.get("area"),
+                                   "days_present": 1, "total_events": int(r["count"] or 0),
+                                   "first_seen": r["first_seen"], "last_seen": r["last_seen"],
+                                   "best_score": r.get("best_score")}
+            continue
+        a["days_present"] += 1
+        a["total_events"] += int(r["count"] or 0)
+        a["first_seen"] = min(a["first_seen"], r["first_seen"])
+        a["last_seen"] = max(a["last_seen"], r["last_seen"])
+        a["name"] = r.get("name") or a["name"]
+        a["area"] = r.get("area") or a["area"]
+        if r.get("best_score") is not None and (a["best_score"] is None or r["best_score"] > a["best_score"]):
+            a["best_score"] = r["best_score"]
+    yield from acc.values()
+
+
+def _jsonable(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: (v.isoformat() if isinstance(v, datetime) else v) for k, v in row.items()}
+
+
+def _encode(rows: Iterator[Dict[str, Any]], fmt: str, columns: List[str]) -> Iterator[str]:
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        for r in rows:
+            writer.writerow(_jsonable(r))
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate(0)
+        yield buf.getvalue()
+    elif fmt == "ndjson":
+        for r in rows:
+            yield json.dumps(_jsonable(r)) + "\n"
+    else:
+        # arreglo JSON emitido elemento a elemento
+        yield "["
+        for i, r in enumerate(rows):
+            yield ("," if i else "") + json.dumps(_jsonable(r))
+        yield "]"
+
+
+@router.get("/range", dependencies=[Depends(api_key_guard)])
+async def range_report(
+    date_from: date = Query(..., alias="from"),
+    date_to: date = Query(..., alias="to"),
+    group: str = Query("day_client", pattern="^(day_client|day|client)$"),
+    format: str = Query("json", pattern="^(json|ndjson|csv)$"),
+    source: Optional[str] = Query(None, pattern="^(rollups|detections)$"),
+):
+    """
+    Reporte de un rango de días en streaming:
+    - group=day_client: una fila por persona y día
+    - group=day: totales por día; group=client: totales por persona en el rango
+    - source: rollups (rápido, por defecto si REPORTS_USE_ROLLUPS; los días
+      anteriores a los rollups salen de las detecciones) o detections (una sola
+      pasada por las detecciones del rango)
+    """
+    if date_to < date_from:
+        raise HTTPException(status_code=422, detail="'to' must not be before 'from'")
+    if (date_to - date_from).days + 1 > settings.REPORTS_MAX_RANGE_DAYS:
+        raise HTTPException(status_code=422, detail=f"Range longer than {settings.REPORTS_MAX_RANGE_DAYS} days")
+    source = source or ("rollups" if settings.REPORTS_USE_ROLLUPS else "detections")
+    rows = (_rows_from_rollups if source == "rollups" else _rows_from_detections)(date_from, date_to)
+    if group == "day":
+        rows = _by_day(rows)
+    elif group == "client":
+        rows = _by_client(rows)
+    # iterador síncrono: Starlette lo consume en su threadpool, fuera del event loop
+    body = _encode(rows, format, RANGE_COLUMNS[group])
+    filename = f"attendance_{date_from.isoformat()}_{date_to.isoformat()}_{group}.{format}"
+    return StreamingResponse(body, media_type=MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'inline; filename="{filename}"'})
@@ -0,0 +1,43 @@
+# app/scripts/backfill_detections.py
+"""
+Backfill de detecciones viejas que solo tienen `ts` (string ISO):
+agrega `at` (timestamp nativo) y `day` para que entren en las consultas
+por rango de iter_detections().
+
+    python -m app.scripts.backfill_detections            # aplica
+    python -m app.scripts.backfill_detections --dry-run  # solo cuenta
+"""
+import argparse
+from ..services import firebase_client as fb
+
+
+def backfill(dry_run: bool = False) -> dict:
+    updated = skipped = 0
+    batch = fb.db().batch()
+    ops = 0
+    for doc in fb.iter_detections_missing_at():
+        ts = (doc.to_dict() or {}).get("ts")
+        try:
+            fields = fb.detection_fields(ts, 0.0)
+        except Exception:
+            skipped += 1
+            continue
+        updated += 1
+        if dry_run:
+            continue
+        batch.update(doc.reference, {"at": fields["at"], "day": fields["day"]})
+        ops += 1
+        if ops >= fb.BATCH_MAX_OPS:
+            batch.commit()
+            batch = fb.db().batch()
+            ops = 0
+    if ops:
+        batch.commit()
+    return {"updated": updated, "skipped": skipped, "dry_run": dry_run}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add native `at`/`day` fields to old detection documents")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    print(backfill(dry_run=args.dry_run))
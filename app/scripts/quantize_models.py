@@ -0,0 +1,140 @@
+# app/scripts/quantize_models.py
+"""
+Genera las variantes int8 (<modelo>.int8.onnx) del detector y del
+reconocedor de insightface, que se usan con INSIGHTFACE_INT8=true:
+
+    python -m app.scripts.quantize_models --images fotos/      # estática (recomendada)
+    python -m app.scripts.quantize_models                       # dinámica, sin calibración
+
+Estática: corre el pipeline fp32 sobre las imágenes de --images, guarda las
+entradas reales de cada modelo (blobs del detector, caras alineadas del
+reconocedor) y calibra con ellas; pesos int8 por canal en formato QDQ, que
+en CPUs con VNNI/AVX-512 usa los kernels enteros. Dinámica: solo cuantiza
+pesos; en redes convolucionales suele ganar poco. Medir la diferencia con
+python -m benchmarks.quantization antes de activarlo.
+
+Necesita el paquete onnx (lo instala insightface).
+"""
+import argparse
+import glob
+import os
+import tempfile
+from typing import Any, Dict, List, Optional
+import numpy as np
+from ..core.config import settings
+from ..services import onnx_models
+
+IMAGE_PATTERNS = ("*.jpg", "*.jpeg", "*.png", "*.bmp", "*.webp")
+
+
+def list_images(directory: str) -> List[str]:
+    out: List[str] = []
+    for pattern in IMAGE_PATTERNS:
+        out.extend(glob.glob(os.path.join(directory, "**", pattern), recursive=True))
+    return sorted(out)
+
+
+class _Recorder:
+    """Envuelve una InferenceSession y guarda los inputs de cada run()."""
+
+    def __init__(self, session, limit: int):
+        self._session = session
+        self.limit = limit
+        self.feeds: List[Dict[str, np.ndarray]] = []
+
+    def run(self, output_names, input_feed, run_options=None):
+        if len(self.feeds) < self.limit:
+            self.feeds.append({k: np.array(v, copy=True) for k, v in input_feed.items()})
+        return self._session.run(output_names, input_feed, run_options)
+
+    def __getattr__(self, name: str):
+        return getattr(self._session, name)
+
+
+def calibration_feeds(images: List[str], limit: int) -> Dict[str, List[Dict[str, np.ndarray]]]:
+    """Entradas reales de cada modelo fp32 al procesar `images`."""
+    from ..services.face_embedder import FaceEmbedder
+    settings.EMBEDDER_BACKEND, settings.INSIGHTFACE_INT8 = "insightface", False
+    emb = FaceEmbedder()
+    recorders = {}
+    for task, model in emb.models.items():
+        recorders[task] = model.session = _Recorder(model.session, limit)
+    for path in images:
+        with open(path, "rb") as f:
+            emb.embed_images([f.read()])
+        if all(len(r.feeds) >= limit for r in recorders.values()):
+            break
+    return {task: r.feeds for task, r in recorders.items()}
+
+
+class _Reader:
+    """CalibrationDataReader sobre una lista de feeds ya grabados."""
+
+    def __init__(self, feeds: List[Dict[str, np.ndarray]]):
+        self._it = iter(feeds)
+
+    def get_next(self) -> Optional[Dict[str, np.ndarray]]:
+        return next(self._it, None)
+
+
+def _preprocess(src: str, workdir: str) -> str:
+    # inferencia de shapes + optimización previa, recomendada antes de cuantizar
+    try:
+        from onnxruntime.quantization.shape_inference import quant_pre_process
+        out = os.path.join(workdir, os.path.basename(src))
+        quant_pre_process(src, out, skip_symbolic_shape=True)
+        return out
+    except Exception:
+        return src
+
+
+def quantize(src: str, dst: str, feeds: Optional[List[Dict[str, np.ndarray]]], method: str = "minmax") -> Dict[str, Any]:
+    from onnxruntime.quantization import (CalibrationMethod, QuantFormat, QuantType,
+                                          quantize_dynamic, quantize_static)
+    with tempfile.TemporaryDirectory() as workdir:
+        model = _preprocess(src, workdir)
+        if feeds:
+            quantize_static(
+                model, dst, _Reader(feeds),
+                quant_format=QuantFormat.QDQ,
+                activation_type=QuantType.QUInt8,
+                weight_type=QuantType.QInt8,
+                per_channel=True,
+                calibrate_method={"minmax": CalibrationMethod.MinMax,
+                                  "entropy": CalibrationMethod.Entropy,
+                                  "percentile": CalibrationMethod.Percentile}[method],
+            )
+        else:
+            quantize_dynamic(model, dst, weight_type=QuantType.QInt8, per_channel=True)
+    return {
+        "model": os.path.basename(src),
+        "output": os.path.basename(dst),
+        "mode": "static" if feeds else "dynamic",
+        "calibration_inputs": len(feeds or []),
+        "mb_fp32": round(os.path.getsize(src) / 2 ** 20, 1),
+        "mb_int8": round(os.path.getsize(dst) / 2 ** 20, 1),
+    }
+
+
+def run(images_dir: Optional[str], limit: int, method: str) -> List[Dict[str, Any]]:
+    paths = onnx_models.resolve(onnx_models.model_dir())
+    feeds: Dict[str, List[Dict[str, np.ndarray]]] = {}
+    if images_dir:
+        images = list_images(images_dir)
+        if not images:
+            raise SystemExit(f"No images in {images_dir}")
+        feeds = calibration_feeds(images, limit)
+        empty = [task for task in paths if not feeds.get(task)]
+        if empty:
+            raise SystemExit(f"No calibration inputs for {', '.join(empty)}: are there faces in {images_dir}?")
+    return [quantize(path, onnx_models.int8_path(path), feeds.get(task), method) for task, path in paths.items()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build int8 variants of the insightface detection/recognition models")
+    parser.add_argument("--images", help="calibration images (static quantization); omit for dynamic")
+    parser.add_argument("--limit", type=int, default=200, help="calibration inputs per model")
+    parser.add_argument("--method", choices=("minmax", "entropy", "percentile"), default="minmax")
+    args = parser.parse_args()
+    for result in run(args.images, args.limit, args.method):
+        print(result)
@@ -0,0 +1,67 @@
+# app/scripts/rebuild_rollups.py
+"""
+Reconstruye los rollups diarios (asistencia_diaria) desde las detecciones,
+p. ej. para el historial anterior a los rollups o tras un backfill. Si el
+rango llega hasta el primer día cubierto (ver rollup_coverage), la marca se
+mueve a `first_day` y /reports lee esos días de los rollups:
+
+    python -m app.scripts.rebuild_rollups 2024-01-01 2024-03-31
+"""
+import argparse
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Any, Dict, Tuple
+from ..services import firebase_client as fb
+
+
+def rebuild(first_day: date, last_day: date) -> dict:
+    start = datetime.combine(first_day, time.min)
+    end = datetime.combine(last_day + timedelta(days=1), time.min)
+    agg: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for det in fb.iter_detections(start, end):
+        key = (det["timestamp"].date().isoformat(), det["client_id"])
+        epoch = det["timestamp"].replace(tzinfo=timezone.utc).timestamp()
+        r = agg.setdefault(key, {"first_seen": epoch, "last_seen": epoch, "count": 0, "best_score": float("-inf")})
+        r["first_seen"] = min(r["first_seen"], epoch)
+        r["last_seen"] = max(r["last_seen"], epoch)
+        r["count"] += 1
+        r["best_score"] = max(r["best_score"], float(det.get("score") or 0.0))
+
+    profiles = {}
+    ids = sorted({cid for _, cid in agg})
+    for snap in fb.db().get_all([fb.get_client_doc(cid) for cid in ids], field_paths=["name", "meta"]):
+        if snap.exists:
+            profiles[snap.id] = snap.to_dict() or {}
+
+    batch = fb.db().batch()
+    ops = 0
+    for (day, cid), r in agg.items():
+        p = profiles.get(cid, {})
+        # set sin merge: reemplaza el rollup con el valor recalculado
+        batch.set(fb.rollup_doc(day, cid), {
+            "day": day,
+            "client_id": cid,
+            **r,
+            "name": p.get("name"),
+            "area": (p.get("meta") or {}).get("area"),
+        })
+        ops += 1
+        if ops >= fb.BATCH_MAX_OPS:
+            batch.commit()
+            batch = fb.db().batch()
+            ops = 0
+    if ops:
+        batch.commit()
+    # si el rango llega hasta la marca de cobertura, los reportes ya pueden leer estos días de los rollups
+    since = fb.rollup_coverage()
+    if since is None or first_day <= since <= last_day + timedelta(days=1):
+        fb.set_rollup_coverage(first_day if since is None else min(first_day, since))
+    return {"rollups": len(agg), "from": first_day.isoformat(), "to": last_day.isoformat(),
+            "complete_from": (fb.rollup_coverage() or first_day).isoformat()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild daily attendance rollups from raw detections")
+    parser.add_argument("first_day", type=date.fromisoformat)
+    parser.add_argument("last_day", type=date.fromisoformat)
+    args = parser.parse_args()
+    print(rebuild(args.first_day, args.last_day))
@@ -0,0 +1,415 @@
+# app/services/detection_log.py
+"""
+Registro de detecciones write-behind.
+
+Los routers encolan eventos y responden sin esperar a Firestore; un hilo los
+agrupa y los escribe con batched writes cuando se junta DETECTION_LOG_BATCH_SIZE
+o pasan DETECTION_LOG_FLUSH_SECONDS. Cada evento se agrega antes a un spool
+local (JSONL) y se re-envía al arrancar si no se confirmó: entrega
+at-least-once. El spool es append-only: confirmar un lote agrega una línea
+{"ack": [ids]} (O(lote), no O(pendientes)), y el hilo escritor lo compacta
+cuando acumula SPOOL_COMPACT_ACKED confirmados. El id del evento es el id del documento en
+`detecciones` y el storage solo suma contador, recientes y rollup de los
+documentos que crea, así que un re-envío no cuenta dos veces.
+
+Cada proceso tiene su propio spool (<DETECTION_LOG_SPOOL sin extensión>.<pid>.jsonl)
+y lo mantiene bloqueado con flock mientras vive. Al arrancar, un proceso
+adopta los spools cuyo lock está libre (su dueño murió sin vaciarlos).
+
+Un lote que el storage rechaza por el contenido (p. ej. InvalidArgument) no
+se reintenta para siempre: se parte hasta aislar el evento culpable, que va
+al dead-letter (<...>.dead.jsonl) para revisarlo a mano.
+"""
+import glob
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from ..core.config import settings
+from ..core.timeutil import now_iso
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - sin flock (Windows): un solo proceso
+    fcntl = None  # type: ignore
+
+try:
+    from google.api_core import exceptions as _gexc
+    _REJECTED: Tuple[type, ...] = (_gexc.InvalidArgument, _gexc.FailedPrecondition, _gexc.OutOfRange)
+except ImportError:  # pragma: no cover - solo store local
+    _REJECTED = ()
+
+log = logging.getLogger(__name__)
+
+
+def make_event(client_id: str, score: float, source: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    return {
+        "id": uuid.uuid4().hex,
+        "client_id": client_id,
+        "ts": now_iso(),
+        "score": float(score),
+        "source": source or {},
+    }
+
+
+def is_permanent(exc: BaseException) -> bool:
+    """Errores que no se arreglan reintentando el mismo lote (datos inválidos, no red)."""
+    return isinstance(exc, _REJECTED + (ValueError, TypeError, KeyError, sqlite3.IntegrityError))
+
+
+def spool_file(base: str, pid: int) -> str:
+    root, ext = os.path.splitext(base)
+    return f"{root}.{pid}{ext or '.jsonl'}"
+
+
+def dead_letter_file(base: str) -> str:
+    root, ext = os.path.splitext(base)
+    return f"{root}.dead{ext or '.jsonl'}"
+
+
+def _lock(path: str, blocking: bool):
+    """flock exclusivo sobre `path` (se crea si falta); None si lo tiene otro proceso."""
+    while True:
+        f = open(path, "a+")
+        if fcntl is None:
+            return f
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            f.close()
+            return None
+        try:
+            # quien adoptó el spool borra el lock: el inodo bloqueado ya no es el del path
+            if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()
+        if not blocking:
+            return None
+
+
+def _unlock(f, remove: Optional[str] = None):
+    if remove:
+        try:
+            os.remove(remove)
+        except FileNotFoundError:
+            pass
+    f.close()  # cerrar libera el flock
+
+
+def _read_spool(path: str) -> List[Dict[str, Any]]:
+    """Eventos del spool sin confirmar: las líneas {"ack": [...]} quitan los ya escritos."""
+    events: Dict[str, Dict[str, Any]] = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # línea truncada por un crash a mitad de escritura
+                if "ack" in rec:
+                    for i in rec["ack"]:
+                        events.pop(i, None)
+                else:
+                    events[rec["id"]] = rec
+    except FileNotFoundError:
+        pass
+    return list(events.values())
+
+
+class DetectionWriter:
+    SPOOL_COMPACT_ACKED = 10_000  # confirmados en el spool antes de compactarlo
+
+    def __init__(self, write_fn: Callable[[List[Dict[str, Any]]], None], batch_size: int,
+                 flush_seconds: float, spool_path: Optional[str] = None, fsync: bool = False):
+        self._write_fn = write_fn
+        self.batch_size = max(1, batch_size)
+        self.flush_seconds = max(0.01, flush_seconds)
+        self.spool_base = spool_path or None
+        self.spool_path = spool_file(spool_path, os.getpid()) if spool_path else None
+        self.fsync = fsync
+        self._pending: List[Dict[str, Any]] = []   # aún no confirmados por Firestore
+        self._cond = threading.Condition()
+        # orden de locks: _spool_lock y después _cond
+        self._spool_lock = threading.Lock()
+        self._spool = None
+        self._spool_owner = None  # flock sobre <spool>.lock mientras el proceso vive
+        self._acked = 0           # confirmados desde la última compactación
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self.flushed = 0
+        self.batches = 0
+        self.failures = 0
+        self.dead_lettered = 0
+        self.adopted = 0
+        self.last_error: Optional[str] = None
+
+    # ---- spool ----
+
+    def _open_spool(self):
+        if self.spool_path:
+            self._spool = open(self.spool_path, "a", encoding="utf-8")
+
+    def _append_spool(self, events: List[Dict[str, Any]]):
+        if self._spool is None:
+            return
+        self._spool.write("".join(json.dumps(e) + "\n" for e in events))
+        self._spool.flush()
+        if self.fsync:
+            os.fsync(self._spool.fileno())
+
+    def _compact_spool(self):
+        """
+        Reescribe el spool con lo pendiente. Se arma fuera de _spool_lock (los
+        enqueue siguen); con el lock solo se copia lo agregado mientras tanto.
+        """
+        with self._spool_lock:
+            if self._spool is None:
+                return
+            with self._cond:
+                keep = list(self._pending)
+                self._acked = 0
+            self._spool.flush()
+            offset = os.path.getsize(self.spool_path)
+        tmp = self.spool_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write("".join(json.dumps(e) + "\n" for e in keep).encode())
+            with self._spool_lock:
+                self._spool.flush()
+                with open(self.spool_path, "rb") as src:
+                    src.seek(offset)
+                    f.write(src.read())
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+                self._spool.close()
+                os.replace(tmp, self.spool_path)
+                self._open_spool()
+
+    def _rewrite_spool(self, events: List[Dict[str, Any]]):
+        # deja en el spool solo lo pendiente (escritura atómica con os.replace)
+        if self._spool is None:
+            return
+        self._spool.close()
+        tmp = self.spool_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(e) + "\n" for e in events))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp, self.spool_path)
+        self._open_spool()
+
+    def _orphans(self) -> List[str]:
+        """Spools de otros procesos (y el spool compartido de versiones anteriores)."""
+        root, ext = os.path.splitext(self.spool_base)
+        ext = ext or ".jsonl"
+        own = re.compile(re.escape(os.path.basename(root)) + r"\.\d+" + re.escape(ext) + "$")
+        out = [p for p in glob.glob(glob.escape(root) + ".*" + ext)
+               if own.match(os.path.basename(p)) and p != self.spool_path]
+        if os.path.exists(self.spool_base):
+            out.append(self.spool_base)
+        return sorted(out)
+
+    def _adopt(self) -> Tuple[List[Dict[str, Any]], List[Tuple[str, Any]]]:
+        events: List[Dict[str, Any]] = []
+        claimed = []
+        for path in self._orphans():
+            owner = _lock(path + ".lock", blocking=False)
+            if owner is None:
+                continue  # su proceso sigue vivo
+            found = _read_spool(path)
+            if found:
+                log.info("Adopting %d detection events from %s", len(found), path)
+            events.extend(found)
+            claimed.append((path, owner))
+        return events, claimed
+
+    # ---- ciclo de vida ----
+
+    def start(self):
+        with self._spool_lock, self._cond:
+            if self._thread is not None:
+                return
+            claimed = []
+            if self.spool_path:
+                self._spool_owner = _lock(self.spool_path + ".lock", blocking=True)
+                # un spool con nuestro pid es de un proceso anterior que ya murió
+                pending = _read_spool(self.spool_path)
+                adopted, claimed = self._adopt()
+                self.adopted = len(adopted)
+                seen = set()
+                self._pending = [e for e in pending + adopted if not (e["id"] in seen or seen.add(e["id"]))]
+                if self._pending:
+                    log.info("Replaying %d spooled detection events", len(self._pending))
+            self._open_spool()
+            self._rewrite_spool(self._pending)
+            # recién ahora, con los eventos a salvo en nuestro spool
+            for path, owner in claimed:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                _unlock(owner, remove=path + ".lock")
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="detection-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        with self._cond:
+            if self._thread is None:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        self._thread = None
+        with self._spool_lock, self._cond:
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
+                if not self._pending:
+                    os.remove(self.spool_path)
+            if self._spool_owner is not None:
+                _unlock(self._spool_owner, remove=self.spool_path + ".lock" if not self._pending else None)
+                self._spool_owner = None
+
+    def enqueue(self, events: List[Dict[str, Any]]):
+        # el spool va fuera de _cond: el hilo escritor y stats() no esperan al disco
+        with self._spool_lock:
+            self._append_spool(events)
+            with self._cond:
+                self._pending.extend(events)
+                if len(self._pending) >= self.batch_size:
+                    self._cond.notify_all()
+
+    def _run(self):
+        backoff = 0.0
+        limit = self.batch_size  # se achica para aislar un evento rechazado
+        while True:
+            with self._cond:
+                if len(self._pending) < limit and not self._stopping:
+                    self._cond.wait(self.flush_seconds)
+                if self._stopping and (not self._pending or backoff):
+                    return
+                batch = list(self._pending[:limit])
+            if not batch:
+                continue
+            try:
+                self._write_fn(batch)
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                if is_permanent(e):
+                    if len(batch) > 1:
+                        limit = max(1, len(batch) // 2)
+                    else:
+                        self._dead_letter(batch, e)
+                    continue
+                log.warning("Detection flush failed (%d events kept): %s", len(batch), e)
+                backoff = min(30.0, (backoff * 2) or 0.5)
+                time.sleep(backoff)
+                continue
+            backoff = 0.0
+            limit = self.batch_size
+            self._done(batch)
+            with self._cond:
+                self.flushed += len(batch)
+                self.batches += 1
+
+    def _done(self, batch: List[Dict[str, Any]]):
+        ids = [e["id"] for e in batch]
+        with self._spool_lock:
+            self._append_spool([{"ack": ids}])
+            with self._cond:
+                done = set(ids)
+                self._pending = [e for e in self._pending if e["id"] not in done]
+                self._acked += len(ids)
+                compact = self._acked >= self.SPOOL_COMPACT_ACKED
+        if compact:
+            self._compact_spool()
+
+    def _dead_letter(self, batch: List[Dict[str, Any]], exc: Exception):
+        log.error("Detection event rejected by storage, moved to dead-letter: %s (%s)", batch[0].get("id"), exc)
+        if self.spool_base:
+            with open(dead_letter_file(self.spool_base), "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps({"event": e, "error": str(exc), "at": now_iso()}) + "\n" for e in batch))
+        self._done(batch)
+        with self._cond:
+            self.dead_lettered += len(batch)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "flushed": self.flushed,
+                "batches": self.batches,
+                "failures": self.failures,
+                "dead_lettered": self.dead_lettered,
+                "adopted": self.adopted,
+                "last_error": self.last_error,
+                "spool": self.spool_path,
+            }
+
+
+_writer: Optional[DetectionWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> DetectionWriter:
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                from .storage import get_storage
+                w = DetectionWriter(
+                    get_storage().write_detections,
+                    batch_size=settings.DETECTION_LOG_BATCH_SIZE,
+                    flush_seconds=settings.DETECTION_LOG_FLUSH_SECONDS,
+                    spool_path=settings.DETECTION_LOG_SPOOL,
+                    fsync=settings.DETECTION_LOG_FSYNC,
+                )
+                w.start()
+                _writer = w
+    return _writer
+
+
+def pending() -> int:
+    """Eventos encolados sin escribir; 0 si el writer todavía no existe (no lo crea)."""
+    w = _writer
+    return w.stats()["pending"] if w is not None else 0
+
+
+def shutdown():
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+
+async def record_many(events: List[Dict[str, Any]]) -> None:
+    """Encola eventos (modo async) o los escribe en un solo batch (modo sync)."""
+    if not events:
+        return
+    from ..core.executor import run_io
+    if settings.DETECTION_LOG_ASYNC:
+        writer = get_writer()
+        if writer.fsync:
+            # fsync por evento: fuera del event loop
+            await run_io(writer.enqueue, events)
+        else:
+            writer.enqueue(events)
+        return
+    from .storage import get_storage
+    await run_io(get_storage().write_detections, events)
+
+
+async def record(client_id: str, score: float, source: Optional[Dict[str, Any]] = None) -> str:
+    ev = make_event(client_id, score, source)
+    await record_many([ev])
+    return ev["ts"]
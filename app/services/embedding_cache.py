@@ -0,0 +1,186 @@
+# app/services/embedding_cache.py
+"""
+Cache de embeddings por contenido: hash de los bytes subidos -> embedding
+(o "sin cara"). Los kioscos reintentan el upload y el frontend manda el
+mismo frame a /detect/image y a /clients/{id}/face-image; con el cache la
+segunda vez no se decodifica ni se corre el modelo, ni siquiera se pasa
+por la cola del executor.
+
+LRU con TTL (EMBED_CACHE_TTL_SECONDS) y presupuesto de memoria
+(EMBED_CACHE_MB, 0 = desactivado). Vive en el proceso que atiende el
+request, así que también sirve con INFERENCE_MODE=process. Solo cubre el
+embedding de una cara por imagen (embed_image/embed_images); /detect/image/multi
+y el stream dependen de otros parámetros y no pasan por acá.
+"""
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from ..core.config import settings
+from ..core import metrics
+from ..core.executor import run_inference
+from .face_embedder import embed_image_task, embed_images_task
+
+# costo aproximado de una entrada además del vector (clave, tupla, nodo del dict)
+ENTRY_OVERHEAD = 200
+
+LOOKUPS = metrics.counter("vectorai_embedding_cache_total", "Embedding cache lookups", ("result",))
+
+_MISS = object()
+
+
+def content_key(content: bytes) -> bytes:
+    # blake2b: más rápido que sha256 en CPUs sin SHA-NI y sin dependencias extra
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+
+class EmbeddingCache:
+    """LRU + TTL con presupuesto en bytes. None guardado = imagen sin cara."""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max(0, max_bytes)
+        self.ttl = ttl
+        self._entries: "OrderedDict[bytes, Tuple[Optional[np.ndarray], float, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: bytes, now: Optional[float] = None) -> Any:
+        """Embedding (lista), None si la imagen no tenía cara, o _MISS."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] > self.ttl:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                LOOKUPS.inc(result="miss")
+                return _MISS
+            self._entries.move_to_end(key)
+            if entry[0] is None:
+                self.negative_hits += 1
+                LOOKUPS.inc(result="negative_hit")
+                return None
+            self.hits += 1
+            LOOKUPS.inc(result="hit")
+        return entry[0].tolist()
+
+    def put(self, key: bytes, embedding: Optional[List[float]], now: Optional[float] = None):
+        if not self.enabled:
+            return
+        vec = np.asarray(embedding, dtype=np.float32) if embedding is not None else None
+        size = ENTRY_OVERHEAD + (vec.nbytes if vec is not None else 0)
+        if size > self.max_bytes:
+            return
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (vec, now, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def _drop(self, key: bytes):
+        _, _, size = self._entries.pop(key)
+        self.bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+            }
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+# embeddings en curso por clave: dos uploads iguales a la vez corren el modelo una sola vez
+_inflight: Dict[bytes, "asyncio.Future[Optional[List[float]]]"] = {}
+
+
+def get_cache() -> EmbeddingCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache(int(settings.EMBED_CACHE_MB * 1024 * 1024), settings.EMBED_CACHE_TTL_SECONDS)
+    return _cache
+
+
+async def embed_image(content: bytes) -> Optional[List[float]]:
+    """Como run_inference(embed_image_task, content), pero pasando por el cache."""
+    cache = get_cache()
+    if not cache.enabled:
+        return await run_inference(embed_image_task, content)
+    key = content_key(content)
+    hit = cache.get(key)
+    if hit is not _MISS:
+        return hit
+    pending = _inflight.get(key)
+    if pending is not None:
+        # asyncio.wait no propaga el error (ni la cancelación) del otro request
+        await asyncio.wait({pending})
+        if not pending.cancelled():
+            return pending.result()
+    fut = _inflight[key] = asyncio.get_running_loop().create_future()
+    try:
+        emb = await run_inference(embed_image_task, content)
+    except BaseException:
+        fut.cancel()  # los que esperaban corren el modelo por su cuenta
+        raise
+    finally:
+        if _inflight.get(key) is fut:
+            del _inflight[key]
+    cache.put(key, emb)
+    fut.set_result(emb)
+    return emb
+
+
+async def embed_images(contents: List[bytes]) -> List[Optional[List[float]]]:
+    """Como run_inference(embed_images_task, contents): solo van al modelo las imágenes no cacheadas."""
+    cache = get_cache()
+    if not cache.enabled:
+        return await run_inference(embed_images_task, contents)
+    keys = [content_key(c) for c in contents]
+    out: List[Any] = [cache.get(k) for k in keys]
+    todo: Dict[bytes, List[int]] = {}
+    for i, (k, v) in enumerate(zip(keys, out)):
+        if v is _MISS:
+            todo.setdefault(k, []).append(i)  # repetidas dentro del batch: una vez
+    if todo:
+        firsts = [positions[0] for positions in todo.values()]
+        embs = await run_inference(embed_images_task, [contents[i] for i in firsts])
+        for (k, positions), emb in zip(todo.items(), embs):
+            cache.put(k, emb)
+            for i in positions:
+                out[i] = emb
+    return out
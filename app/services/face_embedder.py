@@ -1,13 +1,22 @@
 # app/services/face_embedder.py
 import io
-from typing import List, Optional
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 from PIL import Image
 import numpy as np
 from ..core.config import settings
+from ..core import metrics
+from .matcher import box_iou
+from . import onnx_models
 
 class FaceEmbedder:
     def __init__(self):
         self.backend = settings.EMBEDDER_BACKEND.lower().strip()
+        self._decode_pool: Optional[ThreadPoolExecutor] = None
+        self.timings: Dict[str, float] = {}  # ms por fase de arranque
+        self.info: Dict[str, Any] = {}        # modelos y sesión cargados (insightface)
         if self.backend == "insightface":
             self._init_insightface()
         elif self.backend == "facerecognition":
@@ -16,52 +25,298 @@ class FaceEmbedder:
             self.backend = "mock"
 
     def _init_insightface(self):
-        import insightface
+        t = time.perf_counter()
+        import insightface  # noqa: F401
         import onnxruntime  # noqa: F401
-        self.app = insightface.app.FaceAnalysis(name="buffalo_l")
-        self.app.prepare(ctx_id=0, det_size=(640, 640))
+        self.timings["import_ms"] = (time.perf_counter() - t) * 1000.0
+        t = time.perf_counter()
+        # solo detección + reconocimiento, con las sesiones de ONNX_* (ver onnx_models)
+        self.models, self.info = onnx_models.load_insightface()
+        self.timings["model_load_ms"] = (time.perf_counter() - t) * 1000.0
 
     def _init_facerecognition(self):
+        t = time.perf_counter()
         import face_recognition  # noqa: F401
+        self.timings["import_ms"] = (time.perf_counter() - t) * 1000.0
 
-    def embed_image(self, content: bytes) -> Optional[List[float]]:
+    def warm_up(self):
+        """
+        Inferencia de calentamiento: la primera ejecución de ONNX reserva
+        buffers y elige kernels, así que se paga aquí y no en el primer request.
+        """
+        t = time.perf_counter()
+        buf = io.BytesIO()
+        Image.new("RGB", (160, 160), (127, 127, 127)).save(buf, "JPEG")
+        self.embed_images([buf.getvalue()])
         if self.backend == "insightface":
-            img = Image.open(io.BytesIO(content)).convert("RGB")
-            arr = np.array(img)[:, :, ::-1]  # RGB->BGR
-            faces = self.app.get(arr)
-            if not faces:
-                return None
-            face = max(
-                faces,
-                key=lambda f: (f.bbox[2]-f.bbox[0])*(f.bbox[3]-f.bbox[1])
-            )
-            emb = face.normed_embedding.astype(float).tolist()
-            return emb
+            # la imagen dummy no tiene cara: forzar también el modelo de reconocimiento
+            rec = self.models["recognition"]
+            size = rec.input_size[0]
+            rec.get_feat([np.zeros((size, size, 3), dtype=np.uint8)])
+        self.timings["warmup_ms"] = (time.perf_counter() - t) * 1000.0
+
+    def _pool(self) -> ThreadPoolExecutor:
+        # PIL libera el GIL al decodificar, así que los hilos sí paralelizan
+        if self._decode_pool is None:
+            self._decode_pool = ThreadPoolExecutor(max_workers=max(1, settings.EMBED_DECODE_WORKERS),
+                                                   thread_name_prefix="img-decode")
+        return self._decode_pool
+
+    @staticmethod
+    def _open(content: bytes, mode: str, max_side: int) -> Tuple[Image.Image, float]:
+        """
+        Decodifica a lo sumo a `max_side` px de lado. Con JPEG, draft() hace
+        que el decoder escale por 1/2, 1/4 o 1/8 (DCT reducida): una foto de
+        12 MP nunca se decodifica completa. Devuelve también la escala
+        (px originales por px decodificado) para llevar bboxes al original.
+        """
+        img = Image.open(io.BytesIO(content))
+        width = img.size[0]
+        if max_side:
+            img.draft(mode, (max_side, max_side))
+            if max(img.size) > max_side:
+                img.thumbnail((max_side, max_side), Image.BILINEAR)
+        scale = width / img.size[0]
+        return (img if img.mode == mode else img.convert(mode)), scale
+
+    def _decode_scaled(self, content: bytes, max_side: Optional[int] = None) -> Tuple[np.ndarray, float]:
+        max_side = settings.IMAGE_MAX_SIDE if max_side is None else max_side
+        if self.backend == "insightface":
+            import cv2
+            img, scale = self._open(content, "RGB", max_side)
+            arr = np.array(img)
+            # RGB->BGR en el mismo buffer: sin la copia de [:, :, ::-1]
+            return cv2.cvtColor(arr, cv2.COLOR_RGB2BGR, dst=arr), scale
+        if self.backend == "facerecognition":
+            img, scale = self._open(content, "RGB", max_side)
+            return np.array(img), scale
+        # MOCK: gris 32x32
+        img, scale = self._open(content, "L", 32)
+        return np.asarray(img.resize((32, 32))).astype(np.float32), scale
+
+    def _decode(self, content: bytes) -> np.ndarray:
+        return self._decode_scaled(content)[0]
+
+    def _embed_insightface(self, images: List[np.ndarray]) -> List[Optional[List[float]]]:
+        """
+        Detección por imagen y reconocimiento en UN solo forward batched:
+        se alinea la cara más grande de cada imagen y todas las crops
+        van juntas al modelo de reconocimiento.
+        """
+        from insightface.utils import face_align
+        det = self.models["detection"]
+        rec = self.models["recognition"]
+        crops = []
+        owners = []
+        for i, arr in enumerate(images):
+            with metrics.stage("detect"):
+                bboxes, kpss = det.detect(arr, max_num=0, metric="default")
+            if bboxes is None or bboxes.shape[0] == 0 or kpss is None:
+                continue
+            areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+            j = int(np.argmax(areas))
+            crops.append(face_align.norm_crop(arr, landmark=kpss[j], image_size=rec.input_size[0]))
+            owners.append(i)
+        out: List[Optional[List[float]]] = [None] * len(images)
+        if crops:
+            with metrics.stage("recognize"):
+                feats = rec.get_feat(crops)
+            feats = feats / (np.linalg.norm(feats, axis=1, keepdims=True) + 1e-9)
+            for i, f in zip(owners, feats):
+                out[i] = f.astype(float).tolist()
+        return out
+
+    @staticmethod
+    def _pick(boxes: np.ndarray, min_px: float, skip: Optional[np.ndarray], skip_iou: float) -> Tuple[List[int], List[int]]:
+        """
+        Índices de las caras a devolver (lado >= min_px, las más grandes
+        primero) y, de esas, las que hay que embeber: las que no se solapan
+        con ninguna caja de `skip`.
+        """
+        sides = np.minimum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])
+        keep = [int(i) for i in np.argsort(-sides) if sides[i] >= min_px][:settings.MULTI_FACE_MAX]
+        if skip is None or not len(skip) or not keep:
+            return keep, keep
+        overlap = box_iou(boxes[keep], skip).max(axis=1)
+        return keep, [i for i, o in zip(keep, overlap) if o < skip_iou]
+
+    def _faces_insightface(self, arr: np.ndarray, min_px: float, skip: Optional[np.ndarray],
+                           skip_iou: float) -> List[Tuple[np.ndarray, Optional[float], Optional[List[float]]]]:
+        from insightface.utils import face_align
+        det = self.models["detection"]
+        rec = self.models["recognition"]
+        # el detector a la resolución decodificada (múltiplo de 32), no a
+        # INSIGHTFACE_DET_SIZE: si no, las caras chicas se reducen igual
+        side = max(settings.INSIGHTFACE_DET_SIZE, -(-max(arr.shape[:2]) // 32) * 32)
+        with metrics.stage("detect"):
+            bboxes, kpss = det.detect(arr, input_size=(side, side), max_num=0, metric="default")
+        if bboxes is None or bboxes.shape[0] == 0 or kpss is None:
+            return []
+        keep, embed = self._pick(bboxes[:, :4], min_px, skip, skip_iou)
+        feats: Dict[int, List[float]] = {}
+        if embed:
+            crops = [face_align.norm_crop(arr, landmark=kpss[i], image_size=rec.input_size[0]) for i in embed]
+            # todas las caras de la imagen en un solo forward
+            with metrics.stage("recognize"):
+                out = rec.get_feat(crops)
+            out = out / (np.linalg.norm(out, axis=1, keepdims=True) + 1e-9)
+            feats = {i: f.astype(float).tolist() for i, f in zip(embed, out)}
+        return [(bboxes[i, :4], float(bboxes[i, 4]), feats.get(i)) for i in keep]
 
+    def _faces_facerecognition(self, arr: np.ndarray, min_px: float, skip: Optional[np.ndarray],
+                               skip_iou: float) -> List[Tuple[np.ndarray, Optional[float], Optional[List[float]]]]:
+        import face_recognition
+        # (top, right, bottom, left) -> [x1, y1, x2, y2]
+        with metrics.stage("detect"):
+            locs = face_recognition.face_locations(arr)
+        if not locs:
+            return []
+        boxes = np.asarray([[l[3], l[0], l[1], l[2]] for l in locs], dtype=np.float32)
+        keep, embed = self._pick(boxes, min_px, skip, skip_iou)
+        with metrics.stage("recognize"):
+            encs = face_recognition.face_encodings(arr, known_face_locations=[locs[i] for i in embed]) if embed else []
+        feats = {i: e.astype(float).tolist() for i, e in zip(embed, encs)}
+        return [(boxes[i], None, feats.get(i)) for i in keep]
+
+    def embed_faces(self, content: bytes, skip_boxes: Optional[List[List[float]]] = None,
+                    skip_iou: float = 0.5) -> List[Dict[str, Any]]:
+        """
+        Todas las caras de la imagen con al menos MULTI_FACE_MIN_PX de lado
+        (en px de la imagen original), de la más grande a la más chica:
+        [{bbox: [x1, y1, x2, y2], det_score, embedding}]. Las bboxes vienen en
+        coordenadas de la imagen original aunque se haya decodificado reducida.
+        Las caras que se solapan (IoU >= skip_iou) con una de `skip_boxes`
+        solo se detectan: embedding=None, sin pasar por el reconocimiento.
+
+        Decodifica a MULTI_FACE_MAX_SIDE y no a IMAGE_MAX_SIDE: en una foto
+        grupal las caras chicas quedarían con pocos px para detectarlas y
+        para las crops del reconocimiento.
+        """
+        with metrics.stage("decode"):
+            arr, scale = self._decode_scaled(content, settings.MULTI_FACE_MAX_SIDE)
+        skip = np.asarray(skip_boxes, dtype=np.float32).reshape(-1, 4) if skip_boxes else None
+        min_px = settings.MULTI_FACE_MIN_PX / scale
+        if self.backend == "insightface":
+            faces = self._faces_insightface(arr, min_px, skip / scale if skip is not None else None, skip_iou)
         elif self.backend == "facerecognition":
+            faces = self._faces_facerecognition(arr, min_px, skip / scale if skip is not None else None, skip_iou)
+        else:
+            # MOCK: la imagen entera es una cara (solo se leen los headers para el tamaño)
+            with Image.open(io.BytesIO(content)) as img:
+                w, h = img.size
+            box = np.asarray([[0, 0, w, h]], dtype=np.float32)
+            keep, embed = self._pick(box, settings.MULTI_FACE_MIN_PX, skip, skip_iou)
+            faces = [(box[0], None, self._embed_one(arr) if embed else None)] if keep else []
+            scale = 1.0
+        return [
+            {"bbox": [round(float(c) * scale, 1) for c in bbox], "det_score": det_score, "embedding": emb}
+            for bbox, det_score, emb in faces
+        ]
+
+    def _embed_one(self, arr: np.ndarray) -> Optional[List[float]]:
+        if self.backend == "facerecognition":
             import face_recognition
-            img = face_recognition.load_image_file(io.BytesIO(content))
-            locs = face_recognition.face_locations(img)
+            with metrics.stage("detect"):
+                locs = face_recognition.face_locations(arr)
             if not locs:
                 return None
-            encs = face_recognition.face_encodings(img, known_face_locations=[locs[0]])
+            with metrics.stage("recognize"):
+                encs = face_recognition.face_encodings(arr, known_face_locations=[locs[0]])
             if not encs:
                 return None
             return encs[0].astype(float).tolist()
 
-        else:
-            # MOCK: convierte a gris 32x32 y usa los pixeles normalizados como embedding
-            img = Image.open(io.BytesIO(content)).convert("L").resize((32, 32))
-            arr = np.asarray(img).astype(np.float32)
-            vec = arr.flatten()
-            vec = vec / (np.linalg.norm(vec) + 1e-9)
-            want = settings.EMBEDDING_DIM
-            if vec.shape[0] < want:
-                pad = np.zeros((want - vec.shape[0],), dtype=np.float32)
-                vec = np.concatenate([vec, pad])
-            return vec[:want].astype(float).tolist()
+        # MOCK: usa los pixeles normalizados como embedding
+        vec = arr.flatten()
+        vec = vec / (np.linalg.norm(vec) + 1e-9)
+        want = settings.EMBEDDING_DIM
+        if vec.shape[0] < want:
+            pad = np.zeros((want - vec.shape[0],), dtype=np.float32)
+            vec = np.concatenate([vec, pad])
+        return vec[:want].astype(float).tolist()
+
+    def embed_image(self, content: bytes) -> Optional[List[float]]:
+        return self.embed_images([content])[0]
+
+    def embed_images(self, contents: List[bytes]) -> List[Optional[List[float]]]:
+        """
+        Embeddings de varias imágenes. Las imágenes se decodifican en paralelo;
+        con insightface el reconocimiento corre como un único batch ONNX.
+        Devuelve None en la posición de las imágenes sin cara.
+        """
+        if not contents:
+            return []
+        with metrics.stage("decode"):
+            if len(contents) == 1:
+                images = [self._decode(contents[0])]
+            else:
+                images = list(self._pool().map(self._decode, contents))
+        if self.backend == "insightface":
+            return self._embed_insightface(images)
+        return [self._embed_one(arr) for arr in images]
 
     def normalize_vector(self, v: List[float]) -> List[float]:
-        a = np.asarray(v, dtype=np.float32)
-        a = a / (np.linalg.norm(a) + 1e-9)
-        return a.astype(float).tolist()
+        return normalize_vector(v)
+
+
+def normalize_vector(v: List[float]) -> List[float]:
+    # No necesita el modelo: los routers la usan sin instanciar un embedder
+    a = np.asarray(v, dtype=np.float32)
+    a = a / (np.linalg.norm(a) + 1e-9)
+    return a.astype(float).tolist()
+
+
+# --------- registro del proceso ---------
+# Un único FaceEmbedder por proceso: el modelo se carga una sola vez, de forma
+# perezosa en el primer uso o desde el warm-up del lifespan (app/main.py).
+
+_shared: Optional[FaceEmbedder] = None
+_shared_lock = threading.Lock()
+_status: Dict[str, Any] = {"state": "idle", "backend": None, "models": None, "phases_ms": {}, "error": None}
+
+
+def get_embedder() -> FaceEmbedder:
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _status["state"] = "loading"
+                t = time.perf_counter()
+                try:
+                    emb = FaceEmbedder()
+                except Exception as e:
+                    _status.update(state="failed", error=str(e))
+                    raise
+                _status["phases_ms"].update(emb.timings)
+                _status["phases_ms"]["init_total_ms"] = (time.perf_counter() - t) * 1000.0
+                _status.update(state="ready", backend=emb.backend, models=emb.info or None, error=None)
+                _shared = emb
+    return _shared
+
+
+def embedder_status() -> Dict[str, Any]:
+    return {**_status, "phases_ms": dict(_status["phases_ms"])}
+
+
+# Tareas de módulo (picklables) para core.executor.run_inference: en modo
+# process cada worker crea su propio embedder la primera vez.
+
+def warm_up_task() -> Dict[str, Any]:
+    emb = get_embedder()
+    if settings.EMBEDDER_WARMUP and "warmup_ms" not in emb.timings:
+        emb.warm_up()
+        _status["phases_ms"]["warmup_ms"] = emb.timings["warmup_ms"]
+    return embedder_status()
+
+
+def embed_images_task(contents: List[bytes]) -> List[Optional[List[float]]]:
+    return get_embedder().embed_images(contents)
+
+
+def embed_image_task(content: bytes) -> Optional[List[float]]:
+    return get_embedder().embed_image(content)
+
+
+def embed_faces_task(content: bytes, skip_boxes: Optional[List[List[float]]] = None,
+                     skip_iou: float = 0.5) -> List[Dict[str, Any]]:
+    return get_embedder().embed_faces(content, skip_boxes, skip_iou)
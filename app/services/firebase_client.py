@@ -1,11 +1,18 @@
  
 import firebase_admin
 from firebase_admin import credentials, firestore
-from typing import Any, Dict, List, Optional
+from google.api_core.exceptions import AlreadyExists
+from google.cloud.firestore_v1.base_query import FieldFilter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from ..core.config import settings
-from ..core.timeutil import now_iso
+from ..core.timeutil import as_utc as _as_utc, now_iso
+from .gallery import notify_upsert, notify_remove
+from .matcher import l2_normalize
+from . import templates, vector_codec
 import json
-from datetime import datetime, date, time, timezone
+import uuid
+import numpy as np
+from datetime import datetime, date, time, timedelta, timezone
 
 
 _db = None
@@ -48,27 +55,51 @@ def db():
 
 
 def _enc_vector(vec: List[float]) -> Any:
+    """
+    Vector -> formato binario empaquetado (ver vector_codec.pack), guardado como
+    bytes en Firestore o como token Fernet {"enc": True, "v": ...} si se cifra.
+    """
+    blob = vector_codec.pack(vec, settings.VECTOR_STORAGE_CODEC)
     if _cipher is None:
-        return vec
-    blob = json.dumps(vec).encode()
+        return blob
     token = _cipher.encrypt(blob)
     return {"enc": True, "v": token.decode()}
 
 
 
 
-def _dec_vector(raw: Any) -> Optional[List[float]]:
-    if isinstance(raw, list):
-        return [float(x) for x in raw]
-    if isinstance(raw, dict) and raw.get("enc") and _cipher is not None:
-        try:
+def _dec_vector(raw: Any) -> Optional[np.ndarray]:
+    """
+    Devuelve un np.ndarray float32. Acepta el formato binario (plano o cifrado)
+    y las formas anteriores: lista JSON, JSON cifrado y {"codec", "data"}.
+    """
+    try:
+        if isinstance(raw, (bytes, bytearray)):
+            return vector_codec.unpack(raw)
+        if isinstance(raw, list):
+            return np.asarray(raw, dtype=np.float32)
+        if isinstance(raw, dict) and raw.get("enc"):
+            if _cipher is None:
+                return None
             data = _cipher.decrypt(raw["v"].encode())
-            return json.loads(data.decode())
-        except Exception:
-            return None
+            if raw.get("codec"):
+                return vector_codec.from_document(raw, data)
+            if vector_codec.is_packed(data):
+                return vector_codec.unpack(data)
+            return np.asarray(json.loads(data.decode()), dtype=np.float32)
+        if isinstance(raw, dict) and raw.get("codec"):
+            return vector_codec.from_document(raw)
+    except Exception:
+        return None
     return None
 
 
+def client_vector(data: Dict[str, Any]) -> Optional[np.ndarray]:
+    """Vector descifrado de un documento de cliente, o None si no tiene."""
+    raw = data.get("vector")
+    return _dec_vector(raw) if raw is not None else None
+
+
 COLL = "clientes"
 
 
@@ -95,19 +126,63 @@ def create_client(client: Dict[str, Any]):
 
 
 
-def read_client(client_id: str) -> Optional[Dict[str, Any]]:
-    snap = get_client_doc(client_id).get()
-    if not snap.exists:
-        return None
-    data = snap.to_dict()
-    vec = data.get("vector")
-    if vec is not None:
+# Campos del cliente sin el vector: lo que necesitan ClientOut y los reportes
+CLIENT_FIELDS = ["id", "name", "meta", "embedding_dim", "templates_count", "detecciones_count", "detecciones_recent"]
+GET_ALL_CHUNK = 300
+
+
+
+
+def _field_mask(fields: Optional[List[str]], include_vector: bool) -> List[str]:
+    mask = list(fields) if fields is not None else list(CLIENT_FIELDS)
+    if include_vector and "vector" not in mask:
+        mask.append("vector")
+    return mask
+
+
+
+
+def _client_from_snap(snap, include_vector: bool) -> Dict[str, Any]:
+    data = snap.to_dict() or {}
+    data.setdefault("id", snap.id)
+    vec = data.pop("vector", None)
+    if include_vector and vec is not None:
         data["vector"] = _dec_vector(vec)
     return data
 
 
 
 
+def read_client(client_id: str, fields: Optional[List[str]] = None,
+                include_vector: bool = False) -> Optional[Dict[str, Any]]:
+    snap = get_client_doc(client_id).get(field_paths=_field_mask(fields, include_vector))
+    if not snap.exists:
+        return None
+    return _client_from_snap(snap, include_vector)
+
+
+
+
+def read_clients(ids: List[str], fields: Optional[List[str]] = None,
+                 include_vector: bool = False) -> Dict[str, Dict[str, Any]]:
+    """
+    Lectura masiva con get_all (un round trip por bloque) y máscara de campos:
+    solo viaja lo pedido en `fields` (por defecto CLIENT_FIELDS, sin vector).
+    Devuelve {client_id: datos}; los ids inexistentes no aparecen.
+    """
+    unique = list(dict.fromkeys(i for i in ids if i))
+    mask = _field_mask(fields, include_vector)
+    out: Dict[str, Dict[str, Any]] = {}
+    for i in range(0, len(unique), GET_ALL_CHUNK):
+        refs = [get_client_doc(cid) for cid in unique[i:i + GET_ALL_CHUNK]]
+        for snap in db().get_all(refs, field_paths=mask):
+            if snap.exists:
+                out[snap.id] = _client_from_snap(snap, include_vector)
+    return out
+
+
+
+
 def update_client(client_id: str, fields: Dict[str, Any]):
     ref = get_client_doc(client_id)
     ref.set(fields, merge=True)
@@ -116,105 +191,495 @@ def update_client(client_id: str, fields: Dict[str, Any]):
 
 
 def delete_client(client_id: str):
-    get_client_doc(client_id).delete()
+    # las plantillas son una subcolección: Firestore no las borra con el cliente
+    batch = db().batch()
+    ops = 0
+    for doc in _templates(client_id).select([]).stream():
+        batch.delete(doc.reference)
+        ops += 1
+        if ops >= BATCH_MAX_OPS:
+            batch.commit()
+            batch = db().batch()
+            ops = 0
+    batch.delete(get_client_doc(client_id))
+    _bump_gallery_generation(batch)
+    batch.commit()
+    notify_remove(client_id)
+
+
+
+
+def list_clients(limit: int = 100, start_after: Optional[str] = None,
+                 fields: Optional[List[str]] = None, include_vector: bool = False) -> List[Dict[str, Any]]:
+    """
+    Una página de clientes ordenada por id de documento. Para la siguiente
+    página se pasa en start_after el id del último cliente recibido.
+    Los vectores solo se leen y descifran con include_vector=True.
+    """
+    q = db().collection(COLL).select(_field_mask(fields, include_vector)).order_by("__name__").limit(limit)
+    if start_after:
+        q = q.start_after({"__name__": start_after})
+    return [_client_from_snap(doc, include_vector) for doc in q.stream()]
 
 
 
 
-def list_clients(limit: int = 100) -> List[Dict[str, Any]]:
-    res = []
-    for doc in db().collection(COLL).limit(limit).stream():
-        item = doc.to_dict()
-        vec = item.get("vector")
-        if vec is not None:
-            item["vector"] = _dec_vector(vec)
-        res.append(item)
-    return res
+def iter_client_vectors() -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    Recorre TODA la colección (sin límite) leyendo solo el campo vector.
+    Se usa para cargar la galería residente una vez por proceso.
+    """
+    for doc in db().collection(COLL).select(["vector"]).stream():
+        raw = (doc.to_dict() or {}).get("vector")
+        if raw is None:
+            continue
+        vec = _dec_vector(raw)
+        if vec is not None and vec.size:
+            yield doc.id, vec
 
 
 
 
 def set_client_vector(client_id: str, vector: List[float], embedding_dim: int):
-    ref = get_client_doc(client_id)
-    ref.set({
+    batch = db().batch()
+    batch.set(get_client_doc(client_id), {
         "vector": _enc_vector(vector),
         "embedding_dim": embedding_dim,
     }, merge=True)
+    _bump_gallery_generation(batch)
+    batch.commit()
+    notify_upsert(client_id, vector)
+
+
+GALLERY_META = "galeria_meta"
+GENERATION_SHARDS = 8
+
+
+def _bump_gallery_generation(batch):
+    """
+    Cada cambio de vectores sube la generación de la galería (en el mismo
+    batch). Contador repartido en GENERATION_SHARDS documentos: un
+    enrolamiento masivo no satura las escrituras de un solo documento.
+    """
+    shard = db().collection(GALLERY_META).document(f"generation-{uuid.uuid4().int % GENERATION_SHARDS}")
+    batch.set(shard, {"n": firestore.Increment(1)}, merge=True)
+
+
+def gallery_generation() -> int:
+    """Suma de los shards: cambia con cada alta, cambio o baja de vectores en cualquier instancia."""
+    refs = [db().collection(GALLERY_META).document(f"generation-{i}") for i in range(GENERATION_SHARDS)]
+    return sum(int((snap.to_dict() or {}).get("n") or 0) for snap in db().get_all(refs) if snap.exists)
+
+
+TEMPLATE_COLL = "plantillas"
+
+
+def _templates(client_id: str):
+    return get_client_doc(client_id).collection(TEMPLATE_COLL)
+
+
+def _template_info(doc_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": doc_id,
+        "quality": data.get("quality"),
+        "captured_at": data.get("captured_at"),
+        "meta": data.get("meta") or {},
+        "dim": data.get("embedding_dim"),
+    }
+
+
+def _recompute(client_id: str, docs: Dict[str, Dict[str, Any]], dim: Optional[int],
+               extra_drop: Optional[List[str]] = None) -> Tuple[Optional[np.ndarray], List[str], List[str]]:
+    """
+    Elige las plantillas a conservar y reescribe el centroide (`vector` del
+    cliente) en un batch junto con el borrado de las descartadas.
+    """
+    infos = [_template_info(i, d) for i, d in docs.items()]
+    keep, drop = templates.select(infos, dim) if dim else ([], [i["id"] for i in infos])
+    drop = list(dict.fromkeys(drop + [i for i in (extra_drop or []) if i in docs]))
+    keep = [i for i in keep if i not in drop]
+    centroid = None
+    batch = db().batch()
+    for tid in drop:
+        batch.delete(_templates(client_id).document(tid))
+    if keep:
+        vecs = np.stack([_dec_vector(docs[i]["vector"]) for i in keep])
+        centroid = templates.aggregate(vecs, [docs[i].get("quality") for i in keep])
+        batch.set(get_client_doc(client_id), {
+            "vector": _enc_vector(centroid),
+            "embedding_dim": int(centroid.shape[0]),
+            "templates_count": len(keep),
+        }, merge=True)
+    else:
+        batch.set(get_client_doc(client_id), {"vector": firestore.DELETE_FIELD, "templates_count": 0}, merge=True)
+    _bump_gallery_generation(batch)
+    batch.commit()
+    return centroid, keep, drop
+
+
+LEGACY_TEMPLATE_ID = "legacy"
+
+
+def _seed_legacy_template(client_id: str) -> Optional[np.ndarray]:
+    """
+    Si el cliente tiene `vector` pero ninguna plantilla (enrolado antes de las
+    plantillas), guarda ese vector como plantilla legacy para que el primer
+    centroide lo incluya. Id fijo + create: dos altas concurrentes siembran una sola.
+    """
+    if _templates(client_id).limit(1).get():
+        return None
+    data = get_client_doc(client_id).get(field_paths=["vector", "embedding_dim"]).to_dict() or {}
+    vec = client_vector(data)
+    if vec is None or not vec.size:
+        return None
+    vec = l2_normalize(vec)
+    try:
+        _templates(client_id).document(LEGACY_TEMPLATE_ID).create({
+            "vector": _enc_vector(vec),
+            "quality": None,
+            "captured_at": None,
+            "meta": dict(templates.LEGACY_META),
+            "embedding_dim": int(data.get("embedding_dim") or vec.shape[0]),
+        })
+    except AlreadyExists:
+        return None
+    return vec
+
+
+def add_client_template(client_id: str, vector: List[float], embedding_dim: int, quality: Optional[float] = None,
+                        meta: Optional[Dict[str, Any]] = None, replace: bool = False) -> Dict[str, Any]:
+    """
+    Agrega una plantilla en clientes/{id}/plantillas (con calidad y metadatos
+    de captura), descarta las que sobran (ver templates.select) y recalcula el
+    centroide del cliente. replace=True descarta las anteriores (también el
+    vector suelto de antes de las plantillas; si no, pasa a plantilla legacy).
+    """
+    v = l2_normalize(np.asarray(vector, dtype=np.float32).ravel())
+    legacy = None if replace else _seed_legacy_template(client_id)
+    tid = uuid.uuid4().hex
+    _templates(client_id).document(tid).set({
+        "vector": _enc_vector(v),
+        "quality": quality,
+        "captured_at": now_iso(),
+        "meta": meta or {},
+        "embedding_dim": embedding_dim,
+    })
+    docs = {doc.id: doc.to_dict() or {} for doc in _templates(client_id).stream()}
+    previous = [i for i in docs if i != tid] if replace else []
+    centroid, keep, drop = _recompute(client_id, docs, embedding_dim, previous)
+    added = {i: vec for i, vec in ((tid, v), (LEGACY_TEMPLATE_ID, legacy)) if vec is not None and i in keep}
+    templates.publish(client_id, centroid, added, drop, seeded=legacy is not None)
+    return {"template_id": tid, "templates": len(keep), "dropped": drop}
+
+
+def list_client_templates(client_id: str) -> List[Dict[str, Any]]:
+    q = _templates(client_id).select(["quality", "captured_at", "meta", "embedding_dim"])
+    return [_template_info(doc.id, doc.to_dict() or {}) for doc in q.stream()]
+
+
+def delete_client_template(client_id: str, template_id: str) -> bool:
+    docs = {doc.id: doc.to_dict() or {} for doc in _templates(client_id).stream()}
+    if template_id not in docs:
+        return False
+    rest = [d for i, d in docs.items() if i != template_id]
+    # la dimensión la fija la plantilla más reciente que queda
+    newest = max(rest, key=lambda d: d.get("captured_at") or "", default=None)
+    centroid, _, drop = _recompute(client_id, docs, newest.get("embedding_dim") if newest else None, [template_id])
+    templates.publish(client_id, centroid, {}, drop)
+    return True
+
+
+def iter_client_templates() -> Iterator[Tuple[str, str, np.ndarray]]:
+    """(client_id, template_id, vector) de todas las plantillas, para la galería en modo max."""
+    for doc in db().collection_group(TEMPLATE_COLL).select(["vector"]).stream():
+        parent = doc.reference.parent.parent
+        raw = (doc.to_dict() or {}).get("vector")
+        vec = _dec_vector(raw) if raw is not None else None
+        if parent is not None and vec is not None and vec.size:
+            yield parent.id, doc.id, vec
+
+
+RECENT_MAX = 50
+BATCH_MAX_OPS = 450  # Firestore admite 500 operaciones por batch
+ROLLUP_COLL = "asistencia_diaria"
+
+
+
+
+def write_detections(events: List[Dict[str, Any]]):
+    """
+    Escribe varios eventos (ver detection_log.make_event) con un solo get_all
+    de los clientes afectados y batched writes, en vez de 3 round trips por evento.
+    Cada batch queda dentro del límite de Firestore aunque un cliente traiga
+    muchos eventos. El id del evento es el id del documento y los agregados (contador,
+    recientes y el rollup diario por (día, cliente), ver rollup_update()) solo
+    se aplican a los eventos cuyo documento se crea: reintentar no cuenta dos
+    veces (ver _commit_detections).
+    """
+    by_client: Dict[str, List[Dict[str, Any]]] = {}
+    for ev in events:
+        by_client.setdefault(ev["client_id"], []).append(ev)
+    refs = {cid: get_client_doc(cid) for cid in by_client}
+    recent: Dict[str, List[str]] = {}
+    profiles: Dict[str, Dict[str, Any]] = {}
+    for snap in db().get_all(list(refs.values()), field_paths=["detecciones_recent", "name", "meta"]):
+        if snap.exists:
+            data = snap.to_dict() or {}
+            recent[snap.id] = data.get("detecciones_recent") or []
+            profiles[snap.id] = data
+
+    ensure_rollup_coverage()
+    # el límite se controla antes de cada escritura: un cliente con muchos
+    # eventos (o de varios días) se reparte entre batches
+    chunk: List[Tuple[str, List[Dict[str, Any]]]] = []
+    ops = 0
+    for cid, evs in by_client.items():
+        piece: List[Dict[str, Any]] = []
+        days: set = set()
+        for ev in evs:
+            day = _as_utc(datetime.fromisoformat(ev["ts"])).date()
+            # detección + (doc del cliente si es la primera) + (rollup si el día es nuevo)
+            cost = 1 + (0 if piece else 1) + (0 if day in days else 1)
+            if ops + cost > BATCH_MAX_OPS:
+                if piece:
+                    chunk.append((cid, piece))
+                _commit_detections(chunk, refs, recent, profiles)
+                chunk, piece, days, ops = [], [], set(), 0
+                cost = 3
+            piece.append(ev)
+            days.add(day)
+            ops += cost
+        chunk.append((cid, piece))
+    if chunk:
+        _commit_detections(chunk, refs, recent, profiles)
+
+
+def _commit_detections(chunk: List[Tuple[str, List[Dict[str, Any]]]], refs: Dict[str, Any],
+                       recent: Dict[str, List[str]], profiles: Dict[str, Dict[str, Any]]):
+    """
+    Un batch: create() de cada detección más los agregados de su cliente.
+    create() falla si el documento ya existe (re-envío del spool, o un commit
+    que llegó pero cuya respuesta se perdió) y el batch es atómico: en ese
+    caso no se escribió nada, se descartan los eventos que ya estaban y se
+    vuelve a intentar con el resto.
+    """
+    while chunk:
+        batch = db().batch()
+        merged: Dict[str, List[str]] = {}
+        for cid, evs in chunk:
+            ref = refs[cid]
+            for ev in evs:
+                batch.create(ref.collection("detecciones").document(ev["id"]),
+                             detection_fields(ev["ts"], ev["score"], ev.get("source")))
+            merged[cid] = sorted(set(recent.get(cid, [])) | {ev["ts"] for ev in evs})[-RECENT_MAX:]
+            batch.set(ref, {
+                "detecciones_recent": merged[cid],
+                "detecciones_count": firestore.Increment(len(evs)),
+            }, merge=True)
+            by_day: Dict[str, List[Dict[str, Any]]] = {}
+            for ev in evs:
+                by_day.setdefault(_as_utc(datetime.fromisoformat(ev["ts"])).date().isoformat(), []).append(ev)
+            for day, day_evs in by_day.items():
+                batch.set(rollup_doc(day, cid), rollup_update(day, cid, day_evs, profiles.get(cid)), merge=True)
+        try:
+            batch.commit()
+        except AlreadyExists:
+            docs = [refs[cid].collection("detecciones").document(ev["id"]) for cid, evs in chunk for ev in evs]
+            written = {snap.id for snap in db().get_all(docs, field_paths=["ts"]) if snap.exists}
+            if not written:
+                raise
+            chunk = [(cid, [ev for ev in evs if ev["id"] not in written]) for cid, evs in chunk]
+            chunk = [(cid, evs) for cid, evs in chunk if evs]
+            continue
+        recent.update(merged)
+        return
+
+
+ROLLUP_META = ("asistencia_diaria_meta", "coverage")
+_coverage_checked = False
+
+
+def rollup_coverage() -> Optional[date]:
+    """
+    Primer día desde el que los rollups cubren todas las detecciones. Los
+    rollups se empezaron a escribir a mitad de un día: antes de esa fecha
+    hay que recalcular desde las detecciones (o correr rebuild_rollups).
+    """
+    snap = db().collection(ROLLUP_META[0]).document(ROLLUP_META[1]).get()
+    day = (snap.to_dict() or {}).get("complete_from") if snap.exists else None
+    return date.fromisoformat(day) if day else None
+
+
+def set_rollup_coverage(first_day: date):
+    db().collection(ROLLUP_META[0]).document(ROLLUP_META[1]).set({"complete_from": first_day.isoformat()})
+
+
+def ensure_rollup_coverage():
+    """
+    La primera vez que se escriben rollups queda marcado el día siguiente
+    como el primero completo. Una lectura por proceso; create() no pisa la
+    marca de otra instancia.
+    """
+    global _coverage_checked
+    if _coverage_checked:
+        return
+    ref = db().collection(ROLLUP_META[0]).document(ROLLUP_META[1])
+    if not ref.get().exists:
+        tomorrow = datetime.now(timezone.utc).date() + timedelta(days=1)
+        try:
+            ref.create({"complete_from": tomorrow.isoformat()})
+        except AlreadyExists:
+            pass
+    _coverage_checked = True
+
+
+
+
+def rollup_doc(day: str, client_id: str):
+    return db().collection(ROLLUP_COLL).document(f"{day}_{client_id}")
+
+
+
+
+def rollup_update(day: str, client_id: str, events: List[Dict[str, Any]],
+                  profile: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Rollup diario `asistencia_diaria/{day}_{client_id}`:
+      - first_seen / last_seen: epoch UTC (segundos) con transforms Minimum/Maximum
+      - count: Increment; best_score: Maximum
+      - name / area: copia desnormalizada del cliente al momento de la detección
+    Al ser transforms del servidor, no hace falta leer el rollup y es seguro
+    entre instancias que escriben a la vez.
+    """
+    epochs = [_as_utc(datetime.fromisoformat(ev["ts"])).timestamp() for ev in events]
+    fields: Dict[str, Any] = {
+        "day": day,
+        "client_id": client_id,
+        "first_seen": firestore.Minimum(min(epochs)),
+        "last_seen": firestore.Maximum(max(epochs)),
+        "count": firestore.Increment(len(events)),
+        "best_score": firestore.Maximum(max(float(ev["score"]) for ev in events)),
+    }
+    if profile is not None:
+        fields["name"] = profile.get("name")
+        fields["area"] = (profile.get("meta") or {}).get("area")
+    return fields
+
+
+
+
+def _rollup_from_doc(doc) -> Dict[str, Any]:
+    data = doc.to_dict() or {}
+    for key in ("first_seen", "last_seen"):
+        if isinstance(data.get(key), (int, float)):
+            # naive UTC, igual que timestamp en las detecciones
+            data[key] = datetime.fromtimestamp(data[key], tz=timezone.utc).replace(tzinfo=None)
+    return data
+
+
+
+
+def iter_rollups(first_day: date, last_day: date) -> Iterator[Dict[str, Any]]:
+    """Rollups de first_day a last_day (inclusive), ordenados por día."""
+    q = (
+        db().collection(ROLLUP_COLL)
+        .where(filter=FieldFilter("day", ">=", first_day.isoformat()))
+        .where(filter=FieldFilter("day", "<=", last_day.isoformat()))
+        .order_by("day")
+    )
+    for doc in q.stream():
+        yield _rollup_from_doc(doc)
 
 
 
 
 def log_detection(client_id: str, score: float, source: Optional[Dict[str, Any]] = None):
-    ts = now_iso()
-    ref = get_client_doc(client_id)
-    ref.collection("detecciones").document().set({
+    """Escritura síncrona de una detección (sin pasar por la cola write-behind)."""
+    from .detection_log import make_event
+    ev = make_event(client_id, score, source)
+    write_detections([ev])
+    return ev["ts"]
+
+def detection_fields(ts: str, score: float, source: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Documento de detección:
+      - ts: string ISO (se mantiene por compatibilidad)
+      - at: timestamp nativo (UTC), sobre el que se hacen las consultas por rango
+      - day: "YYYY-MM-DD" (UTC), clave de día para agrupar
+    """
+    at = _as_utc(datetime.fromisoformat(ts))
+    return {
         "ts": ts,
+        "at": at,
+        "day": at.date().isoformat(),
         "score": float(score),
         "source": source or {},
-    })
-    snap = ref.get()
-    base = []
-    if snap.exists:
-        base = snap.get("detecciones_recent") or []
-    base.append(ts)
-    if len(base) > 50:
-        base = base[-50:]
-    ref.set({
-        "detecciones_recent": base,
-        "detecciones_count": firestore.Increment(1),
-    }, merge=True)
-    return ts
+    }
 
-def list_detections_for_date(target_date: date) -> List[Dict[str, Any]]:
+
+
+
+def _detection_from_doc(doc) -> Optional[Dict[str, Any]]:
+    data = doc.to_dict() or {}
+    at = data.get("at")
+    if not isinstance(at, datetime):
+        # documento viejo sin "at" (ver app/scripts/backfill_detections.py)
+        try:
+            at = datetime.fromisoformat(data.get("ts"))
+        except Exception:
+            return None
+    # naive UTC, como siempre lo han usado los reportes
+    data["timestamp"] = _as_utc(at).replace(tzinfo=None)
+    parent_client_ref = doc.reference.parent.parent
+    data["client_id"] = parent_client_ref.id if parent_client_ref else None
+    return data
+
+
+
+
+def iter_detections(start: datetime, end: datetime) -> Iterator[Dict[str, Any]]:
     """
-    Devuelve todas las detecciones cuyo timestamp (ts) cae en el día target_date.
-    Lee todas las detecciones del collection_group 'detecciones' y filtra en Python.
-    Estructura esperada de cada detección:
-      - ts: string ISO (generado por now_iso())
-      - score: float
-      - source: dict
-    Además, agrega:
-      - client_id: id del cliente dueño de la detección
-      - timestamp: datetime parseado desde ts
+    Detecciones con start <= at < end (naive = UTC), en orden cronológico.
+    El filtro lo resuelve Firestore sobre el campo indexado `at` del
+    collection group (ver firestore.indexes.json); nada se materializa.
+    Cada detección trae además client_id y timestamp (datetime naive UTC).
     """
-    # Rango de fecha [start_dt, end_dt]
-    start_dt = datetime.combine(target_date, time.min)
-    end_dt = datetime.combine(target_date, time.max)
+    q = (
+        db().collection_group("detecciones")
+        .where(filter=FieldFilter("at", ">=", _as_utc(start)))
+        .where(filter=FieldFilter("at", "<", _as_utc(end)))
+        .order_by("at")
+    )
+    for doc in q.stream():
+        det = _detection_from_doc(doc)
+        if det is not None:
+            yield det
 
 
-    # Leemos TODO el collection_group 'detecciones' (sin filtros)
-    q = db().collection_group("detecciones")
 
-    results: List[Dict[str, Any]] = []
 
-    for doc in q.stream():
-        data = doc.to_dict()
-        ts_raw = data.get("ts")
-
-        # Parsear ts
-        if isinstance(ts_raw, str):
-            try:
-                ts_parsed = datetime.fromisoformat(ts_raw)
-            except Exception:
-                continue
-        else:
-            continue
+def iter_detections_for_date(target_date: date) -> Iterator[Dict[str, Any]]:
+    start = datetime.combine(target_date, time.min)
+    return iter_detections(start, start + timedelta(days=1))
 
-        # Normalizar a naive UTC (quitar tzinfo pero manteniendo la hora correcta)
-        if ts_parsed.tzinfo is not None:
-            ts_parsed = ts_parsed.astimezone(timezone.utc).replace(tzinfo=None)
 
-        # Filtrar por rango de fecha en Python (todos naive)
-        if not (start_dt <= ts_parsed <= end_dt):
-            continue
 
-        # Obtener client_id a partir del padre:
-        parent_client_ref = doc.reference.parent.parent
-        client_id = parent_client_ref.id if parent_client_ref else None
 
-        data["client_id"] = client_id
-        data["timestamp"] = ts_parsed
-        results.append(data)
+def list_detections_for_date(target_date: date) -> List[Dict[str, Any]]:
+    return list(iter_detections_for_date(target_date))
+
+
 
 
-    return results
\ No newline at end of file
+def iter_detections_missing_at(page_size: int = 500) -> Iterator[Any]:
+    """Documentos de detección sin campo `at` (para el backfill)."""
+    q = db().collection_group("detecciones").select(["ts", "at"]).order_by("__name__").limit(page_size)
+    last = None
+    while True:
+        page = list((q.start_after(last) if last is not None else q).stream())
+        if not page:
+            return
+        for doc in page:
+            if "at" not in (doc.to_dict() or {}):
+                yield doc
+        last = page[-1]
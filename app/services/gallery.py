@@ -0,0 +1,325 @@
+# app/services/gallery.py
+import logging
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+from ..core import metrics
+from .matcher import l2_normalize
+from . import gallery_snapshot, gallery_sync, templates
+from .vector_index import FlatIndex, build_index, make_index
+
+log = logging.getLogger(__name__)
+
+REJECTED = metrics.counter("vectorai_gallery_rejected_total", "Vectors left out of the gallery", ("reason",))
+
+
+class Gallery:
+    """
+    Galería residente de embeddings L2-normalizados, servida por el índice
+    configurado en INDEX_BACKEND (flat | ivf | hnsw). Cada fila es un cliente
+    o una plantilla de un cliente ("<client_id>/<template_id>", ver templates):
+    las búsquedas devuelven clientes, con el score de su mejor fila.
+    Se carga una sola vez desde el storage y luego se mantiene al día con
+    upsert()/remove() en vez de releer la colección en cada request.
+
+    El mantenimiento del índice (entrenar IVF/PQ, reconstruir HNSW) no corre
+    dentro de upsert/remove: un hilo arma el índice nuevo con una copia de las
+    filas, sin el lock, mientras el actual sigue sirviendo y recibiendo
+    cambios; esos cambios se anotan y se re-aplican al nuevo antes del swap.
+    """
+
+    def __init__(self, dim: Optional[int] = None, backend: Optional[str] = None):
+        self.dim = dim
+        self.backend = backend
+        self._lock = threading.RLock()
+        self._index = make_index(dim, backend) if dim else None
+        self._owned: Dict[str, Set[str]] = {}  # cliente -> filas
+        # sube con cada cambio aplicado; las respuestas de /detect lo exponen
+        self.generation = 0
+        # vectores descartados por dimensión: {dimensión: cantidad}
+        self.rejected: Dict[int, int] = {}
+        # cambios al índice mientras se reconstruye (None = no hay reconstrucción)
+        self._journal: Optional[List[Tuple[str, str, Optional[np.ndarray]]]] = None
+        self._bulk = False  # load(): el mantenimiento se hace al final, en el hilo que carga
+
+    def __len__(self) -> int:
+        return len(self._index) if self._index is not None else 0
+
+    @property
+    def index_kind(self) -> Optional[str]:
+        return self._index.kind if self._index is not None else None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            idx = self._index
+            return {
+                "size": len(idx) if idx is not None else 0,
+                "clients": len(self._owned),
+                "dim": self.dim,
+                "index": idx.kind if idx is not None else None,
+                "codec": idx.codec_name if idx is not None else None,
+                "bytes": idx.nbytes() if idx is not None else 0,
+                "generation": self.generation,
+                "rejected": sum(self.rejected.values()),
+                "rejected_dims": {str(d): n for d, n in self.rejected.items()},
+                "index_rebuilding": self._journal is not None,
+            }
+
+    def keys(self) -> List[str]:
+        """Todas las filas (client_ids y filas de plantilla)."""
+        with self._lock:
+            return [k for rows in self._owned.values() for k in rows]
+
+    def load(self, items: Iterable[Tuple[str, List[float]]]):
+        with self._lock:
+            self._bulk = True
+            try:
+                for cid, vec in items:
+                    self.upsert(cid, vec)
+            finally:
+                self._bulk = False
+            # la galería todavía no sirve: se entrena acá mismo
+            if self._index is not None and self._journal is None and self._index.maintenance_due():
+                self._index.maintain()
+
+    def _index_add(self, key: str, vec: np.ndarray):
+        self._index.add(key, vec)
+        if self._journal is not None:
+            self._journal.append(("add", key, vec))
+
+    def _index_remove(self, key: str) -> bool:
+        removed = self._index.remove(key)
+        if removed and self._journal is not None:
+            self._journal.append(("remove", key, None))
+        return removed
+
+    def _maintain(self):
+        """Con el lock tomado: si el índice lo pide, lo reconstruye en segundo plano."""
+        if self._bulk or self._journal is not None or self._index is None or not self._index.maintenance_due():
+            return
+        ids, vecs = self._index.items()
+        vecs = np.array(vecs, dtype=np.float32)  # copia: el hilo no lee el índice vivo
+        self._journal = []
+        threading.Thread(target=self._rebuild, args=(self._index, ids, vecs),
+                         name="gallery-index-rebuild", daemon=True).start()
+
+    def _rebuild(self, old, ids: List[str], vecs: np.ndarray):
+        try:
+            new = build_index(self.dim, self.backend, ids, vecs)
+        except Exception as e:
+            log.warning("Gallery index rebuild failed: %s", e)
+            with self._lock:
+                self._journal = None
+            return
+        with self._lock:
+            journal, self._journal = self._journal or [], None
+            if self._index is not old:
+                return
+            for op, key, vec in journal:
+                if op == "add":
+                    new.add(key, vec)
+                else:
+                    new.remove(key)
+            self._index = new
+            self._maintain()
+
+    def load_matrix(self, ids: List[str], matrix: np.ndarray):
+        """
+        Carga filas ya normalizadas (ids[i] -> matrix[i]). Con índice flat
+        float32 la matriz se usa tal cual, sin copiarla (ver gallery_snapshot).
+        """
+        with self._lock:
+            if self._index is None and matrix.shape[1]:
+                self.dim = int(matrix.shape[1])
+                self._index = make_index(self.dim, self.backend)
+            if isinstance(self._index, FlatIndex) and self._index.codec_name == "float32" and not len(self._index):
+                self._index.attach(ids, matrix)
+                for key in ids:
+                    self._owned.setdefault(templates.owner(key), set()).add(key)
+                self.generation += 1
+                return
+            self.load(zip(ids, matrix))
+
+    def upsert(self, key: str, vector: List[float]) -> bool:
+        v = np.asarray(vector, dtype=np.float32).ravel()
+        with self._lock:
+            if self._index is None:
+                self.dim = int(v.shape[0])
+                self._index = make_index(self.dim, self.backend)
+            if v.shape[0] != self.dim:
+                # vector de otra dimensión (otro backend): no es comparable
+                self._reject(key, int(v.shape[0]))
+                return False
+            client_id = templates.owner(key)
+            if key != client_id and self._index_remove(client_id):
+                # el cliente pasa de un vector suelto a plantillas
+                self._owned[client_id].discard(client_id)
+            self._index_add(key, l2_normalize(v))
+            self._owned.setdefault(client_id, set()).add(key)
+            self.generation += 1
+            self._maintain()
+            return True
+
+    def _reject(self, key: str, dim: int):
+        first = dim not in self.rejected
+        self.rejected[dim] = self.rejected.get(dim, 0) + 1
+        REJECTED.inc(reason="dimension")
+        # tras un cambio de backend pueden ser miles: aviso una vez por dimensión
+        log.log(logging.WARNING if first else logging.DEBUG,
+                "Vector for %s has dimension %d, gallery uses %d: not searchable until re-enrolled",
+                key, dim, self.dim)
+
+    def remove(self, key: str) -> bool:
+        """Quita una fila; con un client_id quita el cliente con todas sus plantillas."""
+        with self._lock:
+            if self._index is None:
+                return False
+            client_id = templates.owner(key)
+            rows = self._owned.get(client_id, set())
+            targets = [key] if key != client_id else list(rows | {key})
+            removed = [k for k in targets if self._index_remove(k)]
+            rows.difference_update(targets)
+            if not rows:
+                self._owned.pop(client_id, None)
+            if not removed:
+                return False
+            self.generation += 1
+            self._maintain()
+            return True
+
+    def search_batch(self, queries: np.ndarray, k: int = 1) -> List[List[Tuple[str, float]]]:
+        """Top-k clientes para un lote de queries (Q, D)."""
+        q = l2_normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        with self._lock:
+            if self._index is None or len(self._index) == 0:
+                return [[] for _ in range(q.shape[0])]
+            if q.shape[1] != self.dim:
+                raise ValueError(f"Vector dimension {q.shape[1]} does not match gallery dimension {self.dim}")
+            with metrics.stage("gallery_search"):
+                rows = self._index.search_batch(q, templates.search_width(k))
+        return [self._by_client(r, k) for r in rows]
+
+    @staticmethod
+    def _by_client(ranked: List[Tuple[str, float]], k: int) -> List[Tuple[str, float]]:
+        # las filas vienen ordenadas: la primera de cada cliente es su máximo
+        out: List[Tuple[str, float]] = []
+        seen: Set[str] = set()
+        for key, score in ranked:
+            cid = templates.owner(key)
+            if cid not in seen:
+                seen.add(cid)
+                out.append((cid, score))
+                if len(out) == k:
+                    break
+        return out
+
+    def search(self, query: List[float], k: int = 1) -> List[Tuple[str, float]]:
+        return self.search_batch(np.asarray(query, dtype=np.float32).reshape(1, -1), k)[0]
+
+    def best_match(self, query: List[float]) -> Optional[Tuple[str, float]]:
+        res = self.search(query, k=1)
+        return res[0] if res else None
+
+
+_gallery: Optional[Gallery] = None
+_load_lock = threading.Lock()
+_swap_lock = threading.Lock()
+# cambios recibidos mientras se reconstruye la galería (ver resync)
+_replay: Optional[List[Tuple[str, str, Optional[List[float]]]]] = None
+
+
+def _storage_generation() -> int:
+    from .storage import get_storage
+    return get_storage().gallery_generation()
+
+
+def _build_gallery(from_storage: bool = False) -> Gallery:
+    from .storage import get_storage
+    g = Gallery()
+
+    def items():
+        return templates.gallery_items(get_storage())
+
+    if gallery_snapshot.enabled() and not from_storage:
+        gallery_snapshot.load_into(g, items, _storage_generation)
+    else:
+        g.load(items())
+    return g
+
+
+def get_gallery() -> Gallery:
+    """Devuelve la galería del proceso, cargándola desde el storage la primera vez."""
+    global _gallery
+    if _gallery is None:
+        with _load_lock:
+            if _gallery is None:
+                _gallery = _build_gallery()
+    return _gallery
+
+
+def gallery_loaded() -> bool:
+    return _gallery is not None
+
+
+def loaded_keys() -> List[str]:
+    """Filas de la galería del proceso ([] si todavía no se cargó)."""
+    g = _gallery
+    return g.keys() if g is not None else []
+
+
+def resync(from_storage: bool = True) -> Gallery:
+    """
+    Reconstruye la galería y la reemplaza de una vez. Los cambios que llegan
+    durante la reconstrucción se vuelven a aplicar sobre la nueva.
+    """
+    global _gallery, _replay
+    with _load_lock:
+        with _swap_lock:
+            _replay = []
+        try:
+            g = _build_gallery(from_storage)
+        except Exception:
+            with _swap_lock:
+                _replay = None
+            raise
+        with _swap_lock:
+            for op, cid, vec in _replay:
+                _apply(g, op, cid, vec)
+            _replay = None
+            g.generation = max(g.generation, _gallery.generation if _gallery is not None else 0) + 1
+            _gallery = g
+    return g
+
+
+def _apply(g: Gallery, op: str, client_id: str, vector: Optional[List[float]]):
+    if op == "upsert":
+        g.upsert(client_id, vector)
+    else:
+        g.remove(client_id)
+
+
+def apply_change(op: str, client_id: str, vector: Optional[List[float]] = None):
+    """Cambio hecho por otro proceso o instancia (ver gallery_sync)."""
+    with _swap_lock:
+        if _replay is not None:
+            _replay.append((op, client_id, vector))
+        g = _gallery
+    if g is not None:
+        _apply(g, op, client_id, vector)
+
+
+# `key` es un client_id o una fila de plantilla (ver Gallery.upsert/remove)
+
+def notify_upsert(key: str, vector: List[float]):
+    gallery_snapshot.append_delta("upsert", key, vector, _storage_generation)
+    if gallery_sync.publish("upsert", key, vector):
+        return  # lo aplica el feed (bus local o delta log)
+    # Si la galería aún no se cargó, la próxima carga ya leerá el vector nuevo
+    apply_change("upsert", key, vector)
+
+
+def notify_remove(key: str):
+    gallery_snapshot.append_delta("remove", key, generation=_storage_generation)
+    if gallery_sync.publish("remove", key):
+        return
+    apply_change("remove", key)
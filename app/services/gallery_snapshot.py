@@ -0,0 +1,364 @@
+# app/services/gallery_snapshot.py
+"""
+Snapshot en disco de la galería, compartido por los workers de un host
+(se activa con GALLERY_SNAPSHOT_DIR):
+
+    manifest.json              snapshot vigente (se reemplaza atómicamente)
+    gallery.<v>.f32            matriz float32 (capacidad x dim), filas L2-normalizadas
+    gallery.<v>.ids.json       ids de las primeras `count` filas
+    gallery.<v>.delta.jsonl    altas/bajas de vectores posteriores al snapshot
+    .lock                      flock: exclusivo para escribir, compartido para leer
+
+Un worker nuevo abre la matriz con np.memmap (copy-on-write): las páginas que
+no modifica se comparten desde el page cache con los demás procesos, así que
+arrancar no cuesta leer Firestore ni copiar la galería. Después aplica el
+delta log. Cuando el delta crece más de GALLERY_DELTA_MAX_MB se compacta en
+un snapshot nuevo (versión + 1).
+
+El delta solo trae los cambios hechos en este host. Para no servir un
+snapshot viejo, el manifest guarda la generación del storage con la que se
+construyó (ver gallery_generation: sube con cada cambio de vectores en
+cualquier instancia) y cada entrada del delta la generación leída después de
+su cambio: los cambios de este host mantienen vigente el snapshot. Si al
+cargar el storage va por otra generación, la movió otra instancia y el
+snapshot se reconstruye desde el storage. (Un cambio de otra instancia entre
+el de este host y la lectura de la generación queda cubierto recién por el
+feed o el resync periódico.)
+"""
+import base64
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from ..core.config import settings
+from ..core.timeutil import now_iso
+from .matcher import l2_normalize
+from . import templates, vector_codec
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - sin flock (Windows): un solo proceso
+    fcntl = None  # type: ignore
+
+log = logging.getLogger(__name__)
+
+FORMAT = 1
+MANIFEST = "manifest.json"
+
+# estado del snapshot cargado en este proceso (ver stats())
+_state: Dict[str, Any] = {"version": None, "count": 0, "delta_applied": 0, "delta_offset": 0,
+                          "storage_generation": None, "rebuilt": None, "load_ms": None}
+_compacting = threading.Lock()
+
+
+def enabled() -> bool:
+    return bool(settings.GALLERY_SNAPSHOT_DIR)
+
+
+def _path(name: str) -> str:
+    return os.path.join(settings.GALLERY_SNAPSHOT_DIR, name)
+
+
+def _matrix_path(version: int) -> str:
+    return _path(f"gallery.{version}.f32")
+
+
+def _ids_path(version: int) -> str:
+    return _path(f"gallery.{version}.ids.json")
+
+
+def delta_path(version: int) -> str:
+    return _path(f"gallery.{version}.delta.jsonl")
+
+
+@contextmanager
+def locked(exclusive: bool):
+    os.makedirs(settings.GALLERY_SNAPSHOT_DIR, exist_ok=True)
+    with open(_path(".lock"), "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_manifest() -> Optional[Dict[str, Any]]:
+    try:
+        with open(_path(MANIFEST), encoding="utf-8") as f:
+            m = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return m if m.get("format") == FORMAT else None
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# --------- delta log ---------
+
+def _encode_vec(vec: np.ndarray) -> str:
+    return base64.b64encode(vector_codec.pack(vec)).decode()
+
+
+def _decode_vec(data: str) -> np.ndarray:
+    return vector_codec.unpack(base64.b64decode(data))
+
+
+def read_delta(version: int, offset: int = 0) -> Tuple[List[Dict[str, Any]], int]:
+    """Entradas desde `offset` (bytes) y el offset siguiente; ignora una última línea incompleta."""
+    entries: List[Dict[str, Any]] = []
+    try:
+        with open(delta_path(version), "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                e = json.loads(line)
+                if e["op"] == "upsert":
+                    e["vector"] = _decode_vec(e.pop("v"))
+                entries.append(e)
+    except FileNotFoundError:
+        pass
+    return entries, offset
+
+
+def append_delta(op: str, client_id: str, vector: Optional[List[float]] = None,
+                 generation: Optional[Callable[[], int]] = None):
+    """
+    Registra un cambio de vector en el delta del snapshot vigente, con la
+    generación del storage que ya lo incluye (`generation`, leída ahora).
+    """
+    if not enabled():
+        return
+    entry: Dict[str, Any] = {"op": op, "id": client_id, "at": now_iso()}
+    if generation is not None:
+        try:
+            entry["gen"] = generation()
+        except Exception as e:
+            # sin generación la próxima carga reconstruye: más lento, no incorrecto
+            log.warning("Could not read the storage generation: %s", e)
+    if op == "upsert":
+        entry["v"] = _encode_vec(l2_normalize(np.asarray(vector, dtype=np.float32).ravel()))
+    with locked(exclusive=True):
+        m = read_manifest()
+        # sin snapshot todavía: versión 0, se aplica al construir el primero
+        version = m["version"] if m else 0
+        with open(delta_path(version), "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+            size = f.tell()
+    if m is not None and size > settings.GALLERY_DELTA_MAX_MB * 1024 * 1024:
+        threading.Thread(target=_compact_quietly, name="gallery-compact", daemon=True).start()
+
+
+# --------- construcción ---------
+
+def _merge(ids: List[str], matrix: np.ndarray, entries: Iterable[Dict[str, Any]]) -> Tuple[List[str], np.ndarray]:
+    """Aplica el delta sobre (ids, matriz) y devuelve la galería resultante, compacta."""
+    # mismas reglas que Gallery.upsert/remove: quitar un client_id quita sus
+    # plantillas y una plantilla nueva reemplaza al vector suelto del cliente
+    latest: Dict[str, Optional[np.ndarray]] = {}
+    rows: Dict[str, set] = {}
+    for key in ids:
+        rows.setdefault(templates.owner(key), set()).add(key)
+    for e in entries:
+        key, cid = e["id"], templates.owner(e["id"])
+        if e["op"] == "upsert":
+            if key != cid:
+                latest[cid] = None
+            latest[key] = e["vector"]
+            rows.setdefault(cid, set()).add(key)
+        elif key == cid:
+            for k in rows.pop(cid, set()) | {cid}:
+                latest[k] = None
+        else:
+            latest[key] = None
+    keep = [i for i, key in enumerate(ids) if latest.get(key, True) is not None]
+    out_ids = [ids[i] for i in keep]
+    out = np.asarray(matrix[keep], dtype=np.float32)
+    dim = out.shape[1] if out_ids else None
+    pos = {key: i for i, key in enumerate(out_ids)}
+    new_ids, new_rows = [], []
+    for key, vec in latest.items():
+        if vec is None:
+            continue
+        if dim is None:
+            dim = len(vec)
+        if len(vec) != dim:
+            continue  # otra dimensión: igual que Gallery.upsert
+        if key in pos:
+            out[pos[key]] = vec
+        else:
+            new_ids.append(key)
+            new_rows.append(vec)
+    if new_rows:
+        out = np.concatenate([out.reshape(-1, dim), np.stack(new_rows).astype(np.float32)])
+    return out_ids + new_ids, out
+
+
+def _write_snapshot(version: int, ids: List[str], matrix: np.ndarray, previous: Optional[int],
+                    generation: Optional[int]) -> Dict[str, Any]:
+    # con el lock exclusivo tomado
+    count, dim = matrix.shape
+    # filas libres al final: las altas se escriben ahí sin copiar la matriz
+    capacity = count + max(64, int(count * settings.GALLERY_SNAPSHOT_HEADROOM))
+    out = np.zeros((capacity, dim), dtype=np.float32)
+    out[:count] = matrix
+    _write_atomic(_matrix_path(version), out.tobytes())
+    _write_atomic(_ids_path(version), json.dumps(ids).encode())
+    manifest = {
+        "format": FORMAT,
+        "version": version,
+        "dim": int(dim),
+        "count": int(count),
+        "capacity": int(capacity),
+        "dtype": "float32",
+        "aggregation": templates.mode(),
+        "storage_generation": generation,
+        "created_at": now_iso(),
+    }
+    _write_atomic(_path(MANIFEST), json.dumps(manifest).encode())
+    # los workers que ya mapearon la versión anterior la conservan hasta cerrar
+    for v in {previous, 0} - {None, version}:
+        for p in (_matrix_path(v), _ids_path(v), delta_path(v)):
+            if os.path.exists(p):
+                os.remove(p)
+    return manifest
+
+
+def _generation(m: Dict[str, Any], entries: Iterable[Dict[str, Any]]) -> Optional[int]:
+    """Generación del storage que reflejan snapshot + delta (la mayor: las entradas de varios workers se intercalan)."""
+    gens = [e["gen"] for e in entries if e.get("gen") is not None]
+    if m.get("storage_generation") is not None:
+        gens.append(m["storage_generation"])
+    return max(gens) if gens else None
+
+
+def _current(m: Optional[Dict[str, Any]], generation: Optional[int] = None) -> bool:
+    # un snapshot de otro modo de agregación tiene otras filas: no sirve; uno
+    # de otra generación del storage no vio cambios hechos en otras instancias
+    if m is None or m.get("aggregation") != templates.mode():
+        return False
+    return generation is None or _generation(m, read_delta(m["version"])[0]) == generation
+
+
+def build_from_storage(items: Callable[[], Iterable[Tuple[str, np.ndarray]]],
+                       generation: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Snapshot nuevo leyendo todos los vectores del storage (el primero, al
+    cambiar de modo o si el storage cambió). `generation` se lee antes que
+    `items`: un cambio hecho durante la lectura deja el snapshot desactualizado
+    y la próxima carga lo vuelve a construir.
+    """
+    with locked(exclusive=True):
+        m = read_manifest()
+        if _current(m, generation):
+            return m  # otro worker lo construyó mientras esperábamos el lock
+        ids, rows = [], []
+        for cid, vec in items():
+            v = l2_normalize(np.asarray(vec, dtype=np.float32).ravel())
+            if rows and len(v) != len(rows[0]):
+                continue  # otra dimensión: igual que Gallery.upsert
+            ids.append(cid)
+            rows.append(v)
+        matrix = np.stack(rows) if rows else np.zeros((0, settings.EMBEDDING_DIM), dtype=np.float32)
+        # cambios hechos durante la lectura (registrados en el delta vigente);
+        # el delta de un snapshot de otro modo de agregación trae otras filas
+        previous = m["version"] if m is not None else None
+        if m is None:
+            entries, _ = read_delta(0)
+            ids, matrix = _merge(list(ids), matrix, entries)
+        return _write_snapshot((previous or 0) + 1, ids, matrix, previous, generation)
+
+
+def compact() -> Optional[Dict[str, Any]]:
+    """Snapshot nuevo = snapshot vigente + su delta log."""
+    with locked(exclusive=True):
+        m = read_manifest()
+        if m is None:
+            return None
+        ids, matrix = _open(m)
+        entries, _ = read_delta(m["version"])
+        if not entries:
+            return m
+        ids, merged = _merge(ids, matrix[:m["count"]], entries)
+        del matrix
+        # la generación avanza con los cambios de este host (los del delta)
+        return _write_snapshot(m["version"] + 1, ids, merged, m["version"], _generation(m, entries))
+
+
+def _compact_quietly():
+    if not _compacting.acquire(blocking=False):
+        return
+    try:
+        compact()
+    except Exception as e:
+        log.warning("Gallery snapshot compaction failed: %s", e)
+    finally:
+        _compacting.release()
+
+
+# --------- carga ---------
+
+def _open(m: Dict[str, Any]) -> Tuple[List[str], np.ndarray]:
+    with open(_ids_path(m["version"]), encoding="utf-8") as f:
+        ids = json.load(f)
+    if not m["capacity"]:
+        return ids, np.zeros((0, m["dim"]), dtype=np.float32)
+    # "c" = copy-on-write: lo que se modifica queda privado del proceso
+    matrix = np.memmap(_matrix_path(m["version"]), dtype=np.float32, mode="c", shape=(m["capacity"], m["dim"]))
+    return ids, matrix
+
+
+def load_into(gallery, items: Callable[[], Iterable[Tuple[str, np.ndarray]]],
+              generation: Optional[Callable[[], int]] = None):
+    """
+    Carga `gallery` desde el snapshot y le aplica el delta log. Si no hay
+    snapshot, o el storage cambió desde que se construyó (`generation`), lo
+    reconstruye antes desde `items`.
+    """
+    t = time.perf_counter()
+    gen = generation() if generation is not None else None
+    with locked(exclusive=False):
+        rebuilt = not _current(read_manifest(), gen)
+    if rebuilt:
+        build_from_storage(items, gen)
+    with locked(exclusive=False):
+        m = read_manifest()
+        ids, matrix = _open(m)
+        entries, offset = read_delta(m["version"])
+    gallery.load_matrix(ids, matrix)
+    apply(gallery, entries)
+    _state.update(
+        version=m["version"],
+        count=m["count"],
+        delta_applied=len(entries),
+        delta_offset=offset,
+        storage_generation=_generation(m, entries),
+        rebuilt=rebuilt,
+        load_ms=(time.perf_counter() - t) * 1000.0,
+    )
+
+
+def apply(gallery, entries: Iterable[Dict[str, Any]]):
+    for e in entries:
+        if e["op"] == "upsert":
+            gallery.upsert(e["id"], e["vector"])
+        else:
+            gallery.remove(e["id"])
+
+
+def stats() -> Dict[str, Any]:
+    return dict(_state) if enabled() else {"enabled": False}
@@ -0,0 +1,361 @@
+# app/services/gallery_sync.py
+"""
+Coherencia de la galería entre procesos e instancias (GALLERY_SYNC):
+
+- none:      cada proceso solo ve sus propios cambios (más los de la carga inicial)
+- firestore: listener on_snapshot sobre `clientes` (y sobre las plantillas si
+             TEMPLATE_AGGREGATION=max); las altas/cambios/bajas de vectores
+             hechos en cualquier instancia llegan como deltas
+- delta:     sigue el delta log del snapshot en disco (GALLERY_SNAPSHOT_DIR):
+             coherencia entre los workers de un mismo host, sin red. Los
+             cambios propios también llegan por el log (catch_up al escribir)
+- local:     bus pub/sub en proceso. Es el stand-in de un bus compartido
+             (Redis, Pub/Sub...): basta otra clase con publish/subscribe
+
+Un watchdog fuerza un resync completo (gallery.resync) si el feed se cae o
+entrega cambios con más de GALLERY_SYNC_MAX_LAG_SECONDS de atraso.
+"""
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+from ..core.config import settings
+from . import templates
+
+log = logging.getLogger(__name__)
+
+MODES = ("none", "firestore", "delta", "local")
+
+
+def _mode() -> str:
+    return settings.GALLERY_SYNC.lower().strip()
+
+
+class LocalBus:
+    """Pub/sub en proceso: publish() entrega el evento a cada suscriptor."""
+
+    def __init__(self):
+        self._subs: List[Callable[[Dict[str, Any]], None]] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback: Callable[[Dict[str, Any]], None]):
+        with self._lock:
+            self._subs.append(callback)
+
+    def unsubscribe(self, callback: Callable[[Dict[str, Any]], None]):
+        with self._lock:
+            if callback in self._subs:
+                self._subs.remove(callback)
+
+    def publish(self, event: Dict[str, Any]):
+        with self._lock:
+            subs = list(self._subs)
+        for cb in subs:
+            cb(event)
+
+
+bus = LocalBus()
+
+
+def publish(op: str, client_id: str, vector: Optional[List[float]] = None) -> bool:
+    """
+    Publica un cambio hecho por este proceso. True si lo aplica un suscriptor
+    del bus; False si el que llama debe aplicarlo a su galería directamente.
+    """
+    feed = _feed
+    if feed is None:
+        return False
+    if _mode() == "local":
+        bus.publish({"op": op, "id": client_id, "vector": vector})
+        return True
+    if _mode() == "delta":
+        # el cambio ya está en el delta log (gallery.notify_*): leerlo ahora
+        # lo aplica una sola vez y en el orden del log, y el que escribió ve
+        # su cambio sin esperar al próximo poll
+        try:
+            feed.catch_up()
+        except Exception as e:
+            log.warning("Gallery delta catch-up failed: %s", e)
+            return False
+        return True
+    return False
+
+
+class _Feed:
+    name = "none"
+
+    def __init__(self):
+        self.events = 0
+        self.lag_s = 0.0
+        self.last_event_at: Optional[float] = None
+
+    def _received(self, op: str, client_id: str, vector=None, lag_s: float = 0.0):
+        from .gallery import apply_change
+        apply_change(op, client_id, vector)
+        self.events += 1
+        self.lag_s = lag_s
+        self.last_event_at = time.time()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def healthy(self) -> bool:
+        return True
+
+
+class LocalFeed(_Feed):
+    name = "local"
+
+    def _on_event(self, event: Dict[str, Any]):
+        self._received(event["op"], event["id"], event.get("vector"))
+
+    def start(self):
+        bus.subscribe(self._on_event)
+
+    def stop(self):
+        bus.unsubscribe(self._on_event)
+
+
+class FirestoreFeed(_Feed):
+    name = "firestore"
+
+    def __init__(self):
+        super().__init__()
+        self._watch = None
+        self._templates_watch = None
+        # el primer snapshot de cada listener trae la colección entera
+        self._initial = {"clients": True, "templates": True}
+        # huella del vector por cliente: los cambios de otros campos (p. ej.
+        # detecciones_count en cada detección) no tocan la galería
+        self._seen: Dict[str, int] = {}
+
+    @staticmethod
+    def _fingerprint(raw: Any) -> int:
+        if isinstance(raw, (bytes, bytearray)):
+            return hash(bytes(raw))
+        return hash(json.dumps(raw, sort_keys=True, default=str))
+
+    def _on_snapshot(self, docs, changes, read_time):
+        from . import firebase_client as fb
+        from .gallery import loaded_keys
+        lag = max(0.0, time.time() - read_time.timestamp()) if read_time is not None else 0.0
+        for change in changes:
+            doc = change.document
+            if change.type.name == "REMOVED":
+                if self._seen.pop(doc.id, None) is not None:
+                    self._received("remove", doc.id, lag_s=lag)
+                continue
+            data = doc.to_dict() or {}
+            raw = data.get("vector")
+            if raw is None:
+                continue
+            fp = self._fingerprint(raw)
+            if self._seen.get(doc.id) == fp:
+                continue
+            self._seen[doc.id] = fp
+            if data.get("templates_count") and templates.mode() == "max":
+                continue  # el vector es el centroide; las filas llegan por _on_templates
+            vec = fb.client_vector(data)
+            if vec is not None and vec.size:
+                self._received("upsert", doc.id, vec, lag_s=lag)
+        if self._initial["clients"]:
+            self._initial["clients"] = False
+            # clientes borrados en otra instancia antes de que este listener existiera
+            present = {doc.id for doc in docs if (doc.to_dict() or {}).get("vector") is not None}
+            for cid in {templates.owner(k) for k in loaded_keys()} - present:
+                self._seen.pop(cid, None)
+                self._received("remove", cid, lag_s=lag)
+        self.lag_s = lag
+
+    def _on_templates(self, docs, changes, read_time):
+        from . import firebase_client as fb
+        from .gallery import loaded_keys
+        lag = max(0.0, time.time() - read_time.timestamp()) if read_time is not None else 0.0
+        for change in changes:
+            doc = change.document
+            parent = doc.reference.parent.parent
+            if parent is None:
+                continue
+            key = templates.row_key(parent.id, doc.id)
+            if change.type.name == "REMOVED":
+                self._received("remove", key, lag_s=lag)
+                continue
+            # las plantillas no se modifican: solo interesan las altas
+            if change.type.name == "ADDED":
+                vec = fb.client_vector(doc.to_dict() or {})
+                if vec is not None and vec.size:
+                    self._received("upsert", key, vec, lag_s=lag)
+        if self._initial["templates"]:
+            self._initial["templates"] = False
+            present = set()
+            for doc in docs:
+                parent = doc.reference.parent.parent
+                if parent is not None:
+                    present.add(templates.row_key(parent.id, doc.id))
+            for key in set(loaded_keys()) - present:
+                if key != templates.owner(key):  # solo filas de plantilla
+                    self._received("remove", key, lag_s=lag)
+        self.lag_s = lag
+
+    def start(self):
+        from . import firebase_client as fb
+        # el primer snapshot trae toda la colección: cubre lo cambiado entre la
+        # carga de la galería y el alta del listener (upsert es idempotente, y
+        # lo que ya no está se quita)
+        self._initial = {"clients": True, "templates": True}
+        self._watch = fb.db().collection(fb.COLL).on_snapshot(self._on_snapshot)
+        if templates.mode() == "max":
+            self._templates_watch = fb.db().collection_group(fb.TEMPLATE_COLL).on_snapshot(self._on_templates)
+
+    def stop(self):
+        for w in (self._watch, self._templates_watch):
+            if w is not None:
+                w.unsubscribe()
+        self._watch = self._templates_watch = None
+
+    def healthy(self) -> bool:
+        watches = [self._watch] + ([self._templates_watch] if templates.mode() == "max" else [])
+        return all(w is not None and w.is_active for w in watches)
+
+
+class DeltaFeed(_Feed):
+    name = "delta"
+
+    def __init__(self):
+        super().__init__()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()  # el hilo de poll y catch_up() no leen a la vez
+        self.version: Optional[int] = None
+        self.offset = 0
+
+    def _follow_snapshot(self):
+        from . import gallery_snapshot
+        st = gallery_snapshot.stats()
+        self.version, self.offset = st.get("version"), st.get("delta_offset", 0)
+
+    def _poll(self):
+        from . import gallery_snapshot
+        from .gallery import resync
+        m = gallery_snapshot.read_manifest()
+        if m is None:
+            return
+        if m["version"] != self.version:
+            # se compactó en un snapshot nuevo: recargar desde él (milisegundos)
+            resync(from_storage=False)
+            self._follow_snapshot()
+            return
+        with gallery_snapshot.locked(exclusive=False):
+            entries, self.offset = gallery_snapshot.read_delta(self.version, self.offset)
+        for e in entries:
+            self._received(e["op"], e["id"], e.get("vector"))
+
+    def catch_up(self):
+        """Aplica lo que haya en el delta log hasta el final."""
+        with self._lock:
+            self._poll()
+
+    def _run(self):
+        while not self._stop.wait(settings.GALLERY_SYNC_POLL_SECONDS):
+            try:
+                self.catch_up()
+            except Exception as e:
+                log.warning("Gallery delta poll failed: %s", e)
+
+    def start(self):
+        self._follow_snapshot()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="gallery-delta-feed", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+
+    def healthy(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+
+_FEEDS = {"firestore": FirestoreFeed, "delta": DeltaFeed, "local": LocalFeed}
+
+_feed: Optional[_Feed] = None
+_watchdog: Optional[threading.Thread] = None
+_stopping = threading.Event()
+_stats: Dict[str, Any] = {"resyncs": 0, "last_resync_at": None, "last_resync_reason": None}
+
+
+def _resync(reason: str):
+    from .gallery import resync
+    log.warning("Gallery resync: %s", reason)
+    resync(from_storage=_mode() != "delta")
+    _stats.update(resyncs=_stats["resyncs"] + 1, last_resync_at=time.time(), last_resync_reason=reason)
+
+
+def _watch():
+    last_full = time.time()
+    while not _stopping.wait(settings.GALLERY_SYNC_CHECK_SECONDS):
+        feed = _feed
+        if feed is None:
+            continue
+        try:
+            if not feed.healthy():
+                feed.stop()
+                _resync("feed stopped")
+                feed.start()
+            elif feed.lag_s > settings.GALLERY_SYNC_MAX_LAG_SECONDS:
+                lag, feed.lag_s = feed.lag_s, 0.0
+                _resync(f"feed lag {lag:.1f}s")
+            elif settings.GALLERY_RESYNC_SECONDS and time.time() - last_full > settings.GALLERY_RESYNC_SECONDS:
+                _resync("periodic")
+            else:
+                continue
+            last_full = time.time()
+        except Exception as e:
+            log.warning("Gallery resync failed: %s", e)
+
+
+def start():
+    """Arranca el feed configurado (la galería ya debe estar cargada) y el watchdog."""
+    global _feed, _watchdog
+    mode = _mode()
+    if mode not in MODES:
+        raise ValueError(f"Unknown gallery sync mode: {mode}")
+    if mode == "none" or _feed is not None:
+        return
+    if mode == "delta" and not settings.GALLERY_SNAPSHOT_DIR:
+        raise ValueError("GALLERY_SYNC=delta needs GALLERY_SNAPSHOT_DIR")
+    feed = _FEEDS[mode]()
+    feed.start()
+    _feed = feed
+    _stopping.clear()
+    _watchdog = threading.Thread(target=_watch, name="gallery-sync-watchdog", daemon=True)
+    _watchdog.start()
+
+
+def shutdown():
+    global _feed, _watchdog
+    _stopping.set()
+    if _watchdog is not None:
+        _watchdog.join(5)
+        _watchdog = None
+    if _feed is not None:
+        _feed.stop()
+        _feed = None
+
+
+def stats() -> Dict[str, Any]:
+    feed = _feed
+    return {
+        "mode": _mode(),
+        "healthy": feed.healthy() if feed is not None else None,
+        "events": feed.events if feed is not None else 0,
+        "lag_s": feed.lag_s if feed is not None else 0.0,
+        "last_event_at": feed.last_event_at if feed is not None else None,
+        **_stats,
+    }
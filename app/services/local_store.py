@@ -0,0 +1,611 @@
+# app/services/local_store.py
+"""
+Backend local (STORAGE_BACKEND=local), sin red ni credenciales:
+
+- LOCAL_STORE_DIR/vectorai.sqlite3 (WAL): clientes, detecciones y rollups
+  diarios, con las mismas formas de datos que firebase_client.
+- LOCAL_STORE_DIR/vectors.f32: matriz float32 (filas x dim) mapeada en memoria;
+  cada cliente con vector tiene una fila (clients.vec_row). Las filas de
+  clientes borrados se reutilizan.
+
+Cada hilo usa su propia conexión SQLite; las escrituras van en una transacción
+(BEGIN IMMEDIATE), así que varios procesos pueden compartir el directorio.
+"""
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, date, time, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import uuid
+import numpy as np
+from ..core.config import settings
+from ..core.timeutil import as_utc, now_iso
+from .gallery import notify_upsert, notify_remove
+from .matcher import l2_normalize
+from . import templates, vector_codec
+
+DB_FILE = "vectorai.sqlite3"
+VECTOR_FILE = "vectors.f32"
+RECENT_MAX = 50
+FETCH_CHUNK = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS clients (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    meta TEXT NOT NULL DEFAULT '{}',
+    embedding_dim INTEGER,
+    detecciones_count INTEGER NOT NULL DEFAULT 0,
+    detecciones_recent TEXT NOT NULL DEFAULT '[]',
+    vec_row INTEGER,
+    templates_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS free_rows (row INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS templates (
+    id TEXT PRIMARY KEY,
+    client_id TEXT NOT NULL,
+    vector BLOB NOT NULL,
+    quality REAL,
+    captured_at TEXT NOT NULL,
+    meta TEXT NOT NULL DEFAULT '{}',
+    embedding_dim INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS templates_client ON templates (client_id);
+CREATE TABLE IF NOT EXISTS detections (
+    id TEXT PRIMARY KEY,
+    client_id TEXT NOT NULL,
+    ts TEXT NOT NULL,
+    at REAL NOT NULL,
+    day TEXT NOT NULL,
+    score REAL NOT NULL,
+    source TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS detections_at ON detections (at);
+CREATE TABLE IF NOT EXISTS rollups (
+    day TEXT NOT NULL,
+    client_id TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    count INTEGER NOT NULL,
+    best_score REAL,
+    name TEXT,
+    area TEXT,
+    PRIMARY KEY (day, client_id)
+);
+"""
+
+# columnas agregadas después de crear la tabla (bases existentes)
+_MIGRATIONS = [
+    ("clients", "templates_count", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+def _path(name: str) -> str:
+    return os.path.join(settings.LOCAL_STORE_DIR, name)
+
+
+def _connect() -> sqlite3.Connection:
+    global _schema_ready
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                os.makedirs(settings.LOCAL_STORE_DIR, exist_ok=True)
+                conn = sqlite3.connect(_path(DB_FILE), timeout=30)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA)
+                for table, column, decl in _MIGRATIONS:
+                    cols = {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+                    if column not in cols:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+                conn.commit()
+                conn.close()
+                _schema_ready = True
+    # autocommit: las transacciones se abren explícitamente en _tx()
+    conn = sqlite3.connect(_path(DB_FILE), timeout=30, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # con WAL, NORMAL no corrompe ante un crash (solo puede perder la última transacción)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _conn() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _connect()
+    return conn
+
+
+@contextmanager
+def _tx():
+    conn = _conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _iter_query(sql: str, params: tuple) -> Iterator[sqlite3.Row]:
+    # conexión propia: el consumidor (p. ej. StreamingResponse) puede pedir
+    # cada elemento desde un hilo distinto
+    conn = _connect()
+    try:
+        cur = conn.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(FETCH_CHUNK)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        conn.close()
+
+
+def _meta_get(conn: sqlite3.Connection, key: str) -> Optional[str]:
+    row = conn.execute("SELECT value FROM store_meta WHERE key = ?", (key,)).fetchone()
+    return row["value"] if row else None
+
+
+def _meta_set(conn: sqlite3.Connection, key: str, value: Any):
+    conn.execute("INSERT INTO store_meta (key, value) VALUES (?, ?) "
+                 "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, str(value)))
+
+
+# --------- archivo de vectores ---------
+
+class VectorFile:
+    """
+    Matriz float32 (capacidad x dim) en un archivo plano, leída y escrita con
+    np.memmap. Crece duplicando la capacidad; si otro proceso la hizo crecer,
+    se vuelve a mapear al pedir una fila fuera de rango.
+    """
+
+    MIN_ROWS = 1024
+
+    def __init__(self, path: str, dim: int):
+        self.path = path
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._mm: Optional[np.memmap] = None
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        self._map()
+
+    def _map(self):
+        rows = os.path.getsize(self.path) // (self.dim * 4)
+        # np.memmap no admite archivos vacíos
+        self._mm = np.memmap(self.path, dtype=np.float32, mode="r+", shape=(rows, self.dim)) if rows else None
+
+    @property
+    def capacity(self) -> int:
+        return len(self._mm) if self._mm is not None else 0
+
+    def _ensure(self, row: int, grow: bool):
+        if row < self.capacity:
+            return
+        self._map()
+        if row < self.capacity or not grow:
+            return
+        rows = max(row + 1, 2 * self.capacity, self.MIN_ROWS)
+        self._mm = None
+        with open(self.path, "r+b") as f:
+            f.truncate(rows * self.dim * 4)
+        self._map()
+
+    def write(self, row: int, vec: np.ndarray):
+        with self._lock:
+            self._ensure(row, grow=True)
+            self._mm[row] = vec
+            self._mm.flush()
+
+    def read(self, rows: List[int]) -> np.ndarray:
+        """Copia de las filas pedidas (no queda atada al mapeo)."""
+        with self._lock:
+            if rows:
+                self._ensure(max(rows), grow=False)
+            if self._mm is None:
+                return np.zeros((0, self.dim), dtype=np.float32)
+            return np.array(self._mm[rows])
+
+
+_vectors: Optional[VectorFile] = None
+_vectors_lock = threading.Lock()
+
+
+def _vector_file(conn: sqlite3.Connection, dim: Optional[int] = None) -> Optional[VectorFile]:
+    """El archivo de vectores; su dimensión se fija con el primer vector guardado."""
+    global _vectors
+    if _vectors is None:
+        stored = _meta_get(conn, "vector_dim")
+        if stored is None:
+            if dim is None:
+                return None
+            _meta_set(conn, "vector_dim", dim)
+            stored = str(dim)
+        with _vectors_lock:
+            if _vectors is None:
+                _vectors = VectorFile(_path(VECTOR_FILE), int(stored))
+    if dim is not None and dim != _vectors.dim:
+        raise ValueError(f"Vector dimension {dim} does not match stored dimension {_vectors.dim}")
+    return _vectors
+
+
+def _alloc_row(conn: sqlite3.Connection) -> int:
+    free = conn.execute("SELECT row FROM free_rows ORDER BY row LIMIT 1").fetchone()
+    if free is not None:
+        conn.execute("DELETE FROM free_rows WHERE row = ?", (free["row"],))
+        return int(free["row"])
+    row = int(_meta_get(conn, "next_row") or 0)
+    _meta_set(conn, "next_row", row + 1)
+    return row
+
+
+# --------- clientes ---------
+
+CLIENT_FIELDS = ["id", "name", "meta", "embedding_dim", "templates_count", "detecciones_count", "detecciones_recent"]
+
+
+def _client_from_row(row: sqlite3.Row, fields: Optional[List[str]], include_vector: bool) -> Dict[str, Any]:
+    data = {
+        "id": row["id"],
+        "name": row["name"],
+        "meta": json.loads(row["meta"] or "{}"),
+        "embedding_dim": row["embedding_dim"],
+        "templates_count": row["templates_count"],
+        "detecciones_count": row["detecciones_count"],
+        "detecciones_recent": json.loads(row["detecciones_recent"] or "[]"),
+    }
+    if fields is not None:
+        data = {k: v for k, v in data.items() if k in fields or k == "id"}
+    if include_vector and row["vec_row"] is not None:
+        vf = _vector_file(_conn())
+        if vf is not None:
+            data["vector"] = vf.read([row["vec_row"]])[0]
+    return data
+
+
+def create_client(client: Dict[str, Any]):
+    data = {
+        "id": client["id"],
+        "name": client.get("name"),
+        "meta": client.get("meta", {}),
+        "embedding_dim": client.get("embedding_dim"),
+        "detecciones_count": 0,
+        "detecciones_recent": [],
+    }
+    with _tx() as conn:
+        conn.execute(
+            "INSERT INTO clients (id, name, meta, embedding_dim, detecciones_count, detecciones_recent) "
+            "VALUES (?, ?, ?, ?, 0, '[]') ON CONFLICT(id) DO UPDATE SET name = excluded.name, "
+            "meta = excluded.meta, embedding_dim = excluded.embedding_dim, "
+            "detecciones_count = 0, detecciones_recent = '[]'",
+            (data["id"], data["name"], json.dumps(data["meta"]), data["embedding_dim"]),
+        )
+    return data
+
+
+def read_client(client_id: str, fields: Optional[List[str]] = None,
+                include_vector: bool = False) -> Optional[Dict[str, Any]]:
+    row = _conn().execute("SELECT * FROM clients WHERE id = ?", (client_id,)).fetchone()
+    if row is None:
+        return None
+    return _client_from_row(row, fields, include_vector)
+
+
+def read_clients(ids: List[str], fields: Optional[List[str]] = None,
+                 include_vector: bool = False) -> Dict[str, Dict[str, Any]]:
+    unique = list(dict.fromkeys(i for i in ids if i))
+    out: Dict[str, Dict[str, Any]] = {}
+    # SQLite limita los parámetros por consulta
+    for i in range(0, len(unique), 500):
+        chunk = unique[i:i + 500]
+        sql = f"SELECT * FROM clients WHERE id IN ({','.join('?' * len(chunk))})"
+        for row in _conn().execute(sql, chunk):
+            out[row["id"]] = _client_from_row(row, fields, include_vector)
+    return out
+
+
+def update_client(client_id: str, fields: Dict[str, Any]):
+    # misma semántica que set(merge=True): los campos de `meta` se combinan
+    with _tx() as conn:
+        row = conn.execute("SELECT meta FROM clients WHERE id = ?", (client_id,)).fetchone()
+        if row is None:
+            conn.execute("INSERT INTO clients (id) VALUES (?)", (client_id,))
+        if "name" in fields:
+            conn.execute("UPDATE clients SET name = ? WHERE id = ?", (fields["name"], client_id))
+        if "embedding_dim" in fields:
+            conn.execute("UPDATE clients SET embedding_dim = ? WHERE id = ?", (fields["embedding_dim"], client_id))
+        if "meta" in fields:
+            meta = json.loads(row["meta"]) if row is not None else {}
+            meta.update(fields["meta"] or {})
+            conn.execute("UPDATE clients SET meta = ? WHERE id = ?", (json.dumps(meta), client_id))
+
+
+def delete_client(client_id: str):
+    with _tx() as conn:
+        _free_vector(conn, client_id)
+        conn.execute("DELETE FROM clients WHERE id = ?", (client_id,))
+        conn.execute("DELETE FROM templates WHERE client_id = ?", (client_id,))
+    notify_remove(client_id)
+
+
+def list_clients(limit: int = 100, start_after: Optional[str] = None,
+                 fields: Optional[List[str]] = None, include_vector: bool = False) -> List[Dict[str, Any]]:
+    rows = _conn().execute(
+        "SELECT * FROM clients WHERE id > ? ORDER BY id LIMIT ?", (start_after or "", limit)
+    ).fetchall()
+    return [_client_from_row(r, fields, include_vector) for r in rows]
+
+
+# --------- vectores ---------
+
+def _store_vector(conn: sqlite3.Connection, client_id: str, v: np.ndarray, embedding_dim: int):
+    vf = _vector_file(conn, int(v.shape[0]))
+    row = conn.execute("SELECT vec_row FROM clients WHERE id = ?", (client_id,)).fetchone()
+    vec_row = row["vec_row"] if row is not None and row["vec_row"] is not None else _alloc_row(conn)
+    # la fila se escribe antes del COMMIT: un cliente confirmado siempre apunta a datos
+    vf.write(vec_row, v)
+    conn.execute(
+        "INSERT INTO clients (id, embedding_dim, vec_row) VALUES (?, ?, ?) "
+        "ON CONFLICT(id) DO UPDATE SET embedding_dim = excluded.embedding_dim, vec_row = excluded.vec_row",
+        (client_id, embedding_dim, vec_row),
+    )
+    _bump_gallery_generation(conn)
+
+
+def _free_vector(conn: sqlite3.Connection, client_id: str):
+    row = conn.execute("SELECT vec_row FROM clients WHERE id = ?", (client_id,)).fetchone()
+    if row is not None and row["vec_row"] is not None:
+        conn.execute("INSERT OR IGNORE INTO free_rows (row) VALUES (?)", (row["vec_row"],))
+        conn.execute("UPDATE clients SET vec_row = NULL WHERE id = ?", (client_id,))
+        _bump_gallery_generation(conn)
+
+
+def _bump_gallery_generation(conn: sqlite3.Connection):
+    # en la misma transacción que el cambio de vector (ver gallery_generation)
+    _meta_set(conn, "gallery_generation", int(_meta_get(conn, "gallery_generation") or 0) + 1)
+
+
+def gallery_generation() -> int:
+    """Sube con cada alta, cambio o baja de vectores, hecha por cualquier proceso."""
+    return int(_meta_get(_conn(), "gallery_generation") or 0)
+
+
+def set_client_vector(client_id: str, vector: List[float], embedding_dim: int):
+    v = np.asarray(vector, dtype=np.float32).ravel()
+    with _tx() as conn:
+        _store_vector(conn, client_id, v, embedding_dim)
+    notify_upsert(client_id, vector)
+
+
+# --------- plantillas ---------
+
+def _template_info(row: sqlite3.Row) -> Dict[str, Any]:
+    return {
+        "id": row["id"],
+        "quality": row["quality"],
+        "captured_at": row["captured_at"] or None,
+        "meta": json.loads(row["meta"] or "{}"),
+        "dim": row["embedding_dim"],
+    }
+
+
+def _recompute(conn: sqlite3.Connection, client_id: str, dim: Optional[int],
+               extra_drop: Optional[List[str]] = None) -> Tuple[Optional[np.ndarray], List[str], List[str]]:
+    """Elige las plantillas a conservar y reescribe el centroide del cliente (misma transacción)."""
+    rows = {r["id"]: r for r in conn.execute("SELECT * FROM templates WHERE client_id = ?", (client_id,))}
+    infos = [_template_info(r) for r in rows.values()]
+    keep, drop = templates.select(infos, dim) if dim else ([], list(rows))
+    drop = list(dict.fromkeys(drop + [i for i in (extra_drop or []) if i in rows]))
+    keep = [i for i in keep if i not in drop]
+    conn.executemany("DELETE FROM templates WHERE id = ?", [(i,) for i in drop])
+    centroid = None
+    if keep:
+        vecs = np.stack([vector_codec.unpack(rows[i]["vector"]) for i in keep])
+        centroid = templates.aggregate(vecs, [rows[i]["quality"] for i in keep])
+        _store_vector(conn, client_id, centroid, int(centroid.shape[0]))
+    else:
+        _free_vector(conn, client_id)
+    conn.execute("UPDATE clients SET templates_count = ? WHERE id = ?", (len(keep), client_id))
+    return centroid, keep, drop
+
+
+def _seed_legacy_template(conn: sqlite3.Connection, client_id: str) -> Tuple[Optional[str], Optional[np.ndarray]]:
+    """Vector de un cliente sin plantillas (enrolado antes de ellas) -> plantilla legacy."""
+    if conn.execute("SELECT 1 FROM templates WHERE client_id = ? LIMIT 1", (client_id,)).fetchone() is not None:
+        return None, None
+    row = conn.execute("SELECT embedding_dim, vec_row FROM clients WHERE id = ?", (client_id,)).fetchone()
+    vf = _vector_file(conn)
+    if row is None or row["vec_row"] is None or vf is None:
+        return None, None
+    vec = l2_normalize(vf.read([row["vec_row"]])[0])
+    tid = uuid.uuid4().hex
+    # sin fecha de captura conocida: queda como la más vieja a igual calidad
+    conn.execute(
+        "INSERT INTO templates (id, client_id, vector, quality, captured_at, meta, embedding_dim) "
+        "VALUES (?, ?, ?, NULL, '', ?, ?)",
+        (tid, client_id, vector_codec.pack(vec), json.dumps(templates.LEGACY_META), row["embedding_dim"] or int(vec.shape[0])),
+    )
+    return tid, vec
+
+
+def add_client_template(client_id: str, vector: List[float], embedding_dim: int, quality: Optional[float] = None,
+                        meta: Optional[Dict[str, Any]] = None, replace: bool = False) -> Dict[str, Any]:
+    v = l2_normalize(np.asarray(vector, dtype=np.float32).ravel())
+    tid = uuid.uuid4().hex
+    with _tx() as conn:
+        previous = [r["id"] for r in conn.execute("SELECT id FROM templates WHERE client_id = ?", (client_id,))] if replace else []
+        legacy_id, legacy = (None, None) if replace else _seed_legacy_template(conn, client_id)
+        conn.execute(
+            "INSERT INTO templates (id, client_id, vector, quality, captured_at, meta, embedding_dim) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (tid, client_id, vector_codec.pack(v), quality, now_iso(), json.dumps(meta or {}), embedding_dim),
+        )
+        centroid, keep, drop = _recompute(conn, client_id, embedding_dim, previous)
+    added = {i: vec for i, vec in ((tid, v), (legacy_id, legacy)) if vec is not None and i in keep}
+    templates.publish(client_id, centroid, added, drop, seeded=legacy is not None)
+    return {"template_id": tid, "templates": len(keep), "dropped": drop}
+
+
+def list_client_templates(client_id: str) -> List[Dict[str, Any]]:
+    rows = _conn().execute("SELECT * FROM templates WHERE client_id = ? ORDER BY captured_at", (client_id,))
+    return [_template_info(r) for r in rows]
+
+
+def delete_client_template(client_id: str, template_id: str) -> bool:
+    with _tx() as conn:
+        found = conn.execute("SELECT 1 FROM templates WHERE id = ? AND client_id = ?", (template_id, client_id)).fetchone()
+        if found is None:
+            return False
+        # la dimensión la fija la plantilla más reciente que queda
+        newest = conn.execute(
+            "SELECT embedding_dim FROM templates WHERE client_id = ? AND id != ? ORDER BY captured_at DESC LIMIT 1",
+            (client_id, template_id),
+        ).fetchone()
+        centroid, _, drop = _recompute(conn, client_id, newest["embedding_dim"] if newest else None, [template_id])
+    templates.publish(client_id, centroid, {}, drop)
+    return True
+
+
+def iter_client_templates() -> Iterator[Tuple[str, str, np.ndarray]]:
+    """(client_id, template_id, vector) de todas las plantillas, para la galería en modo max."""
+    for row in _iter_query("SELECT id, client_id, vector FROM templates", ()):
+        yield row["client_id"], row["id"], vector_codec.unpack(row["vector"])
+
+
+def iter_client_vectors() -> Iterator[Tuple[str, np.ndarray]]:
+    """Todos los vectores, leídos del archivo mapeado por bloques de filas."""
+    vf = _vector_file(_conn())
+    if vf is None:
+        return
+    batch: List[Tuple[str, int]] = []
+    for row in _iter_query("SELECT id, vec_row FROM clients WHERE vec_row IS NOT NULL ORDER BY vec_row", ()):
+        batch.append((row["id"], row["vec_row"]))
+        if len(batch) >= FETCH_CHUNK:
+            yield from _read_batch(vf, batch)
+            batch = []
+    yield from _read_batch(vf, batch)
+
+
+def _read_batch(vf: VectorFile, batch: List[Tuple[str, int]]) -> Iterator[Tuple[str, np.ndarray]]:
+    if not batch:
+        return
+    mat = vf.read([r for _, r in batch])
+    for (cid, _), vec in zip(batch, mat):
+        yield cid, vec
+
+
+# --------- detecciones ---------
+
+def write_detections(events: List[Dict[str, Any]]):
+    """
+    Una transacción por lote. INSERT OR IGNORE sobre el id del evento: un
+    re-envío del spool no se cuenta dos veces. Actualiza contador, recientes
+    y el rollup diario igual que firebase_client.write_detections.
+    """
+    with _tx() as conn:
+        inserted: Dict[str, List[Dict[str, Any]]] = {}
+        for ev in events:
+            at = as_utc(datetime.fromisoformat(ev["ts"]))
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO detections (id, client_id, ts, at, day, score, source) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (ev["id"], ev["client_id"], ev["ts"], at.timestamp(), at.date().isoformat(),
+                 float(ev["score"]), json.dumps(ev.get("source") or {})),
+            )
+            if cur.rowcount:
+                inserted.setdefault(ev["client_id"], []).append({**ev, "at": at})
+        for cid, evs in inserted.items():
+            row = conn.execute("SELECT name, meta, detecciones_recent FROM clients WHERE id = ?", (cid,)).fetchone()
+            if row is None:
+                conn.execute("INSERT INTO clients (id) VALUES (?)", (cid,))
+                name, area, recent = None, None, []
+            else:
+                name = row["name"]
+                area = json.loads(row["meta"] or "{}").get("area")
+                recent = json.loads(row["detecciones_recent"] or "[]")
+            recent = (recent + sorted(ev["ts"] for ev in evs))[-RECENT_MAX:]
+            conn.execute(
+                "UPDATE clients SET detecciones_count = detecciones_count + ?, detecciones_recent = ? WHERE id = ?",
+                (len(evs), json.dumps(recent), cid),
+            )
+            by_day: Dict[str, List[Dict[str, Any]]] = {}
+            for ev in evs:
+                by_day.setdefault(ev["at"].date().isoformat(), []).append(ev)
+            for day, day_evs in by_day.items():
+                epochs = [ev["at"].timestamp() for ev in day_evs]
+                conn.execute(
+                    "INSERT INTO rollups (day, client_id, first_seen, last_seen, count, best_score, name, area) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(day, client_id) DO UPDATE SET "
+                    "first_seen = min(first_seen, excluded.first_seen), "
+                    "last_seen = max(last_seen, excluded.last_seen), "
+                    "count = count + excluded.count, "
+                    "best_score = max(coalesce(best_score, excluded.best_score), excluded.best_score), "
+                    "name = excluded.name, area = excluded.area",
+                    (day, cid, min(epochs), max(epochs), len(day_evs),
+                     max(float(ev["score"]) for ev in day_evs), name, area),
+                )
+
+
+def log_detection(client_id: str, score: float, source: Optional[Dict[str, Any]] = None):
+    """Escritura síncrona de una detección (sin pasar por la cola write-behind)."""
+    from .detection_log import make_event
+    ev = make_event(client_id, score, source)
+    write_detections([ev])
+    return ev["ts"]
+
+
+def _naive_utc(epoch: float) -> datetime:
+    # naive UTC, como lo devuelve firebase_client
+    return datetime.fromtimestamp(epoch, tz=timezone.utc).replace(tzinfo=None)
+
+
+def iter_detections(start: datetime, end: datetime) -> Iterator[Dict[str, Any]]:
+    """Detecciones con start <= at < end (naive = UTC), en orden cronológico."""
+    sql = "SELECT * FROM detections WHERE at >= ? AND at < ? ORDER BY at"
+    for row in _iter_query(sql, (as_utc(start).timestamp(), as_utc(end).timestamp())):
+        yield {
+            "ts": row["ts"],
+            "at": datetime.fromtimestamp(row["at"], tz=timezone.utc),
+            "day": row["day"],
+            "score": row["score"],
+            "source": json.loads(row["source"] or "{}"),
+            "timestamp": _naive_utc(row["at"]),
+            "client_id": row["client_id"],
+        }
+
+
+def iter_detections_for_date(target_date: date) -> Iterator[Dict[str, Any]]:
+    start = datetime.combine(target_date, time.min)
+    return iter_detections(start, start + timedelta(days=1))
+
+
+def list_detections_for_date(target_date: date) -> List[Dict[str, Any]]:
+    return list(iter_detections_for_date(target_date))
+
+
+def rollup_coverage() -> Optional[date]:
+    """
+    Primer día desde el que los rollups cubren todas las detecciones: aquí
+    todos, porque las detecciones solo entran por write_detections, que
+    actualiza el rollup en la misma transacción.
+    """
+    return date.min
+
+
+def iter_rollups(first_day: date, last_day: date) -> Iterator[Dict[str, Any]]:
+    """Rollups de first_day a last_day (inclusive), ordenados por día."""
+    sql = "SELECT * FROM rollups WHERE day >= ? AND day <= ? ORDER BY day, client_id"
+    for row in _iter_query(sql, (first_day.isoformat(), last_day.isoformat())):
+        data = dict(row)
+        data["first_seen"] = _naive_utc(data["first_seen"])
+        data["last_seen"] = _naive_utc(data["last_seen"])
+        yield data
@@ -14,18 +14,89 @@ def cosine_similarity(a: List[float], b: List[float]) -> float:
 
 
 
+def l2_normalize(a: np.ndarray) -> np.ndarray:
+    a = np.asarray(a, dtype=np.float32)
+    if a.ndim == 1:
+        return a / (np.linalg.norm(a) + 1e-9)
+    return a / (np.linalg.norm(a, axis=1, keepdims=True) + 1e-9)
+
+
+
+
+def best_match_matrix(query: np.ndarray, matrix: np.ndarray) -> Tuple[int, float]:
+    """
+    query: vector (D,) L2-normalizado; matrix: (N, D) con filas L2-normalizadas.
+    Con ambos normalizados, el coseno es un único producto matriz-vector.
+    """
+    scores = matrix @ query
+    idx = int(np.argmax(scores))
+    return idx, float(scores[idx])
+
+
+
+
+def top_k_scores(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    scores: (Q, N). Devuelve (indices, scores) de forma (Q, k) ordenados de mayor a menor.
+    argpartition es O(N) por query; solo se ordenan los k elegidos.
+    """
+    n = scores.shape[1]
+    k = max(1, min(int(k), n))
+    if k < n:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(n), scores.shape)
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+
+
+
+def top_k_matrix(queries: np.ndarray, matrix: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Top-k por lotes. queries: (Q, D) o (D,); matrix: (N, D), ambos normalizados."""
+    return top_k_scores(np.atleast_2d(queries) @ matrix.T, k)
+
+
+
+
+def box_iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """IoU entre cajas [x1, y1, x2, y2]. a: (N, 4), b: (M, 4) -> (N, M)."""
+    a = np.asarray(a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-9)
+
+
+
+
+def margin(ranked: List[Tuple[str, float]]) -> Optional[float]:
+    """Diferencia entre el 1º y el 2º candidato (None si hay menos de dos)."""
+    if len(ranked) < 2:
+        return None
+    return float(ranked[0][1] - ranked[1][1])
+
+
+
+
 def best_match(query: List[float], candidates: List[Dict]) -> Optional[Tuple[str, float]]:
-    best_id = None
-    best_score = -1.0
+    ids = []
+    vecs = []
     for c in candidates:
         vec = c.get("vector")
         cid = c.get("id")
-        if not vec or not cid:
+        if vec is None or len(vec) == 0 or not cid:
             continue
-        s = cosine_similarity(query, vec)
-        if s > best_score:
-            best_score = s
-            best_id = cid
-    if best_id is None:
+        ids.append(cid)
+        vecs.append(vec)
+    if not ids:
         return None
-    return best_id, best_score
\ No newline at end of file
+    mat = l2_normalize(np.asarray(vecs, dtype=np.float32))
+    idx, score = best_match_matrix(l2_normalize(query), mat)
+    return ids[idx], score
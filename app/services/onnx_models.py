@@ -0,0 +1,131 @@
+# app/services/onnx_models.py
+"""
+Modelos ONNX de insightface con sesiones configurables (ver face_embedder).
+
+FaceAnalysis carga todos los modelos del paquete (landmarks 2D/3D,
+género/edad) con las opciones por defecto de onnxruntime. Acá se arman
+solo el detector y el reconocedor, cada uno con su InferenceSession:
+hilos (ONNX_INTRA_OP_THREADS / ONNX_INTER_OP_THREADS), nivel de
+optimización del grafo y providers. Con INSIGHTFACE_INT8 se cargan las
+variantes <modelo>.int8.onnx que genera app/scripts/quantize_models.py.
+"""
+import glob
+import os
+from typing import Any, Dict, List, Tuple
+from ..core.config import settings
+
+TASKS = ("detection", "recognition")
+INT8_SUFFIX = ".int8.onnx"
+
+GRAPH_LEVELS = ("disable", "basic", "extended", "all")
+
+
+def providers() -> List[str]:
+    return [p.strip() for p in settings.ONNX_PROVIDERS.split(",") if p.strip()]
+
+
+def intra_op_threads() -> int:
+    if settings.ONNX_INTRA_OP_THREADS > 0:
+        return settings.ONNX_INTRA_OP_THREADS
+    # cada worker de inferencia corre su propio forward: repartir los núcleos
+    return max(1, (os.cpu_count() or 1) // max(1, settings.INFERENCE_WORKERS))
+
+
+def session_options():
+    import onnxruntime as ort
+    level = settings.ONNX_GRAPH_OPTIMIZATION.lower().strip()
+    if level not in GRAPH_LEVELS:
+        raise ValueError(f"Unknown ONNX graph optimization level: {level}")
+    so = ort.SessionOptions()
+    so.intra_op_num_threads = intra_op_threads()
+    so.inter_op_num_threads = max(1, settings.ONNX_INTER_OP_THREADS)
+    so.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    so.graph_optimization_level = {
+        "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }[level]
+    return so
+
+
+def new_session(path: str):
+    import onnxruntime as ort
+    return ort.InferenceSession(path, sess_options=session_options(), providers=providers())
+
+
+def int8_path(path: str) -> str:
+    return path[:-len(".onnx")] + INT8_SUFFIX if path.endswith(".onnx") else path + INT8_SUFFIX
+
+
+def model_dir() -> str:
+    """Directorio del paquete INSIGHTFACE_MODEL (lo descarga la primera vez, como FaceAnalysis)."""
+    from insightface.utils.storage import ensure_available
+    return ensure_available("models", settings.INSIGHTFACE_MODEL, root=os.path.expanduser(settings.INSIGHTFACE_ROOT))
+
+
+def _task_of(path: str) -> str:
+    # mismo criterio que insightface.model_zoo.ModelRouter
+    sess = new_session(path)
+    inputs, outputs = sess.get_inputs(), sess.get_outputs()
+    shape = inputs[0].shape
+    if len(outputs) >= 5:
+        return "detection"
+    side = shape[2] if len(shape) == 4 and shape[2] == shape[3] and isinstance(shape[2], int) else 0
+    # 192 = landmarks 2D/3D; 96 = género/edad
+    if len(inputs) == 1 and side >= 112 and side % 16 == 0 and side != 192:
+        return "recognition"
+    return "other"
+
+
+def resolve(directory: str) -> Dict[str, str]:
+    """{"detection": ruta fp32, "recognition": ruta fp32} dentro del paquete."""
+    configured = {"detection": settings.INSIGHTFACE_DET_MODEL, "recognition": settings.INSIGHTFACE_REC_MODEL}
+    out = {task: os.path.join(directory, name) for task, name in configured.items() if name}
+    missing = [t for t in TASKS if t not in out or not os.path.exists(out[t])]
+    if missing:
+        # otro paquete (p. ej. buffalo_s): clasificar los .onnx como lo hace FaceAnalysis
+        for path in sorted(glob.glob(os.path.join(directory, "*.onnx"))):
+            if path.endswith(INT8_SUFFIX):
+                continue
+            task = _task_of(path)
+            if task in missing:
+                out[task] = path
+                missing.remove(task)
+    if missing:
+        raise FileNotFoundError(f"No {', '.join(missing)} model in {directory}")
+    return out
+
+
+def load_insightface() -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    (modelos, info): modelos = {"detection": RetinaFace, "recognition": ArcFaceONNX}
+    ya preparados; info describe archivos y sesión para /ready.
+    """
+    from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+    from insightface.model_zoo.retinaface import RetinaFace
+    paths = resolve(model_dir())
+    files: Dict[str, str] = {}
+    sessions = {}
+    for task, path in paths.items():
+        load = int8_path(path) if settings.INSIGHTFACE_INT8 else path
+        if not os.path.exists(load):
+            raise FileNotFoundError(f"{load} not found: run python -m app.scripts.quantize_models first")
+        sessions[task] = new_session(load)
+        files[task] = os.path.basename(load)
+    # model_file es siempre el fp32: ArcFaceONNX lo lee para deducir la normalización de entrada
+    det = RetinaFace(model_file=paths["detection"], session=sessions["detection"])
+    rec = ArcFaceONNX(model_file=paths["recognition"], session=sessions["recognition"])
+    size = settings.INSIGHTFACE_DET_SIZE
+    det.prepare(0, input_size=(size, size), det_thresh=settings.INSIGHTFACE_DET_THRESH)
+    rec.prepare(0)
+    info = {
+        "model": settings.INSIGHTFACE_MODEL,
+        "files": files,
+        "int8": settings.INSIGHTFACE_INT8,
+        "det_size": size,
+        "providers": sessions["recognition"].get_providers(),
+        "intra_op_threads": intra_op_threads(),
+        "graph_optimization": settings.ONNX_GRAPH_OPTIMIZATION,
+    }
+    return {"detection": det, "recognition": rec}, info
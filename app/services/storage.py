@@ -0,0 +1,145 @@
+# app/services/storage.py
+"""
+Backend de persistencia, elegido con STORAGE_BACKEND:
+
+- firestore: firebase_client (Firestore, vectores cifrables)
+- local:     local_store (SQLite para metadatos/detecciones/rollups y un
+             archivo float32 mapeado en memoria para los vectores)
+
+Los dos son módulos con las mismas funciones (ver Storage); el resto de la
+app llama a get_storage() en vez de importar uno directamente.
+"""
+import threading
+import time
+import types
+from datetime import date, datetime
+from typing import Any, Dict, Iterator, List, Optional, Protocol, Tuple
+import numpy as np
+from ..core.config import settings
+from ..core import metrics
+
+
+class Storage(Protocol):
+    # clientes
+    def create_client(self, client: Dict[str, Any]) -> Dict[str, Any]: ...
+    def read_client(self, client_id: str, fields: Optional[List[str]] = None,
+                    include_vector: bool = False) -> Optional[Dict[str, Any]]: ...
+    def read_clients(self, ids: List[str], fields: Optional[List[str]] = None,
+                     include_vector: bool = False) -> Dict[str, Dict[str, Any]]: ...
+    def update_client(self, client_id: str, fields: Dict[str, Any]) -> None: ...
+    def delete_client(self, client_id: str) -> None: ...
+    def list_clients(self, limit: int = 100, start_after: Optional[str] = None,
+                     fields: Optional[List[str]] = None, include_vector: bool = False) -> List[Dict[str, Any]]: ...
+
+    # vectores
+    def set_client_vector(self, client_id: str, vector: List[float], embedding_dim: int) -> None: ...
+    def iter_client_vectors(self) -> Iterator[Tuple[str, np.ndarray]]: ...
+    def gallery_generation(self) -> int: ...
+
+    # plantillas (varios embeddings por cliente, ver templates)
+    def add_client_template(self, client_id: str, vector: List[float], embedding_dim: int,
+                            quality: Optional[float] = None, meta: Optional[Dict[str, Any]] = None,
+                            replace: bool = False) -> Dict[str, Any]: ...
+    def list_client_templates(self, client_id: str) -> List[Dict[str, Any]]: ...
+    def delete_client_template(self, client_id: str, template_id: str) -> bool: ...
+    def iter_client_templates(self) -> Iterator[Tuple[str, str, np.ndarray]]: ...
+
+    # detecciones y reportes
+    def write_detections(self, events: List[Dict[str, Any]]) -> None: ...
+    def log_detection(self, client_id: str, score: float, source: Optional[Dict[str, Any]] = None) -> str: ...
+    def iter_detections(self, start: datetime, end: datetime) -> Iterator[Dict[str, Any]]: ...
+    def iter_detections_for_date(self, target_date: date) -> Iterator[Dict[str, Any]]: ...
+    def list_detections_for_date(self, target_date: date) -> List[Dict[str, Any]]: ...
+    def iter_rollups(self, first_day: date, last_day: date) -> Iterator[Dict[str, Any]]: ...
+    def rollup_coverage(self) -> Optional[date]: ...
+
+
+BACKENDS = ("firestore", "local")
+
+STORAGE_SECONDS = metrics.histogram("vectorai_storage_seconds", "Storage backend call latency", ("backend", "op"))
+STORAGE_ERRORS = metrics.counter("vectorai_storage_errors_total", "Storage backend calls that raised", ("backend", "op"))
+
+
+class _Timed:
+    """
+    Envuelve el módulo del backend: cada función pública mide su latencia
+    (vectorai_storage_seconds y la fase storage:<op>). De los iteradores se
+    suma el tiempo de cada next() hasta agotarse, que es cuando de verdad se
+    leen, sin lo que tarda el consumidor entre items (p. ej. una descarga CSV).
+    """
+
+    def __init__(self, backend, name: str):
+        self._backend = backend
+        self._name = name
+
+    def __getattr__(self, op: str):
+        attr = getattr(self._backend, op)
+        if op.startswith("_") or not isinstance(attr, types.FunctionType):
+            return attr
+        wrapped = self._wrap(op, attr)
+        setattr(self, op, wrapped)  # siguiente acceso: sin __getattr__
+        return wrapped
+
+    def _done(self, op: str, elapsed: float, failed: bool):
+        STORAGE_SECONDS.observe(elapsed, backend=self._name, op=op)
+        metrics.record_stage(f"storage:{op}", elapsed)
+        if failed:
+            STORAGE_ERRORS.inc(backend=self._name, op=op)
+
+    def _wrap(self, op: str, fn):
+        def call(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                self._done(op, time.perf_counter() - t, True)
+                raise
+            if isinstance(result, types.GeneratorType):
+                return self._drain(op, time.perf_counter() - t, result)
+            self._done(op, time.perf_counter() - t, False)
+            return result
+        call.__name__ = call.__qualname__ = op
+        call.__doc__ = fn.__doc__
+        return call
+
+    def _drain(self, op: str, elapsed: float, gen):
+        failed = False
+        try:
+            while True:
+                t = time.perf_counter()
+                try:
+                    item = next(gen)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - t
+                yield item
+        except GeneratorExit:
+            raise  # el consumidor cortó antes: no es un error
+        except Exception:
+            failed = True
+            raise
+        finally:
+            gen.close()
+            self._done(op, elapsed, failed)
+
+
+_storage: Optional[Storage] = None
+_storage_lock = threading.Lock()
+
+
+def get_storage() -> Storage:
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                name = settings.STORAGE_BACKEND.lower().strip()
+                if name not in BACKENDS:
+                    raise ValueError(f"Unknown storage backend: {name}")
+                # import perezoso: el backend local no necesita firebase_admin
+                if name == "local":
+                    from . import local_store as backend
+                else:
+                    from . import firebase_client as backend
+                _storage = _Timed(backend, name)  # type: ignore[assignment]
+    return _storage  # type: ignore[return-value]
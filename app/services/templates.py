@@ -0,0 +1,116 @@
+# app/services/templates.py
+"""
+Varias plantillas (embeddings) por cliente y cómo se agregan al buscar
+(TEMPLATE_AGGREGATION):
+
+- max:     cada plantilla es una fila de la galería ("<client_id>/<template_id>")
+           y el score del cliente es el de su mejor plantilla
+- mean:    una fila por cliente con el centroide de sus plantillas
+- quality: igual, con el centroide ponderado por la calidad de captura
+
+El centroide se precalcula al enrolar y se guarda como `vector` del cliente,
+así que con mean/quality el costo por query no depende de cuántas plantillas
+haya. Las plantillas crudas se guardan siempre para poder recalcular.
+
+Un cliente enrolado con un único vector (antes de las plantillas) lo conserva:
+la primera plantilla que se le agrega siembra antes una plantilla "legacy" con
+ese vector, así el centroide no lo pisa.
+"""
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+from ..core.config import settings
+from .matcher import l2_normalize
+
+MODES = ("max", "mean", "quality")
+# los ids de documento de Firestore no pueden contener "/"
+ROW_SEP = "/"
+# calidad de las plantillas sin calidad declarada (p. ej. las legacy): neutra,
+# ni gana ni pierde frente a una captura puntuada
+UNKNOWN_QUALITY = 0.5
+LEGACY_META = {"source": "legacy"}
+
+
+def mode() -> str:
+    m = settings.TEMPLATE_AGGREGATION.lower().strip()
+    if m not in MODES:
+        raise ValueError(f"Unknown template aggregation: {m}")
+    return m
+
+
+def row_key(client_id: str, template_id: str) -> str:
+    return f"{client_id}{ROW_SEP}{template_id}"
+
+
+def owner(key: str) -> str:
+    """Cliente dueño de una fila de la galería (la fila puede ser el cliente mismo)."""
+    return key.split(ROW_SEP, 1)[0]
+
+
+def search_width(k: int) -> int:
+    # con max un cliente puede ocupar hasta TEMPLATES_MAX_PER_CLIENT filas del top
+    return k * max(1, settings.TEMPLATES_MAX_PER_CLIENT) if mode() == "max" else k
+
+
+def quality(q: Optional[float]) -> float:
+    return UNKNOWN_QUALITY if q is None else float(q)
+
+
+def select(templates: Sequence[Dict[str, Any]], dim: int, limit: Optional[int] = None) -> Tuple[List[str], List[str]]:
+    """
+    Elige qué plantillas conservar: solo las de dimensión `dim` y, si sobran,
+    las de mayor calidad (a igual calidad, las más nuevas; sin calidad cuenta
+    como UNKNOWN_QUALITY).
+    Cada plantilla trae id, quality, captured_at y dim. Devuelve (keep, drop).
+    """
+    limit = limit or settings.TEMPLATES_MAX_PER_CLIENT
+    same = [t for t in templates if t["dim"] == dim]
+    ranked = sorted(same, key=lambda t: (quality(t.get("quality")), t.get("captured_at") or ""), reverse=True)
+    keep = [t["id"] for t in ranked[:limit]]
+    kept = set(keep)
+    return keep, [t["id"] for t in templates if t["id"] not in kept]
+
+
+def aggregate(vectors: np.ndarray, qualities: Optional[Sequence[Optional[float]]] = None,
+              how: Optional[str] = None) -> np.ndarray:
+    """Centroide L2-normalizado de las plantillas (mean o ponderado por calidad)."""
+    x = l2_normalize(np.atleast_2d(np.asarray(vectors, dtype=np.float32)))
+    if (how or mode()) == "quality" and qualities is not None:
+        w = np.asarray([quality(q) for q in qualities], dtype=np.float32).clip(min=0.0)
+        if w.sum() > 0:
+            return l2_normalize(w @ x)
+    return l2_normalize(x.mean(axis=0))
+
+
+def publish(client_id: str, centroid: Optional[np.ndarray], added: Dict[str, np.ndarray], removed: Sequence[str],
+            seeded: bool = False):
+    """
+    Lleva a la galería un cambio de plantillas ya persistido. seeded=True si
+    el vector suelto del cliente pasó a ser una plantilla legacy.
+    """
+    from .gallery import notify_remove, notify_upsert
+    if mode() == "max":
+        if seeded:
+            notify_remove(client_id)  # la fila suelta ahora es una plantilla
+        for tid in removed:
+            notify_remove(row_key(client_id, tid))
+        for tid, vec in added.items():
+            notify_upsert(row_key(client_id, tid), vec)
+    elif centroid is None:
+        notify_remove(client_id)
+    else:
+        notify_upsert(client_id, centroid)
+
+
+def gallery_items(store) -> Iterator[Tuple[str, np.ndarray]]:
+    """Filas de la galería según el modo: centroides, o plantillas + vectores sueltos."""
+    if mode() != "max":
+        yield from store.iter_client_vectors()
+        return
+    with_templates = set()
+    for cid, tid, vec in store.iter_client_templates():
+        with_templates.add(cid)
+        yield row_key(cid, tid), vec
+    # clientes enrolados con un único vector, sin plantillas
+    for cid, vec in store.iter_client_vectors():
+        if cid not in with_templates:
+            yield cid, vec
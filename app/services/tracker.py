@@ -0,0 +1,161 @@
+# app/services/tracker.py
+"""
+Seguimiento de caras entre los frames de un stream (/detect/stream) y
+debounce de las detecciones que se registran.
+
+FaceTracker asocia las caras de cada frame a los tracks abiertos: por IoU de
+la bbox si el frame trae cajas (y, si hay embeddings, solo si además se
+parecen: otra persona en el mismo lugar abre un track nuevo), o por
+similitud coseno del embedding si solo trae vectores. Un track se compara
+contra la galería a lo sumo una vez cada STREAM_RETRY_SECONDS: si no se
+reconoció, se reintenta; si ya se reconoció, se re-verifica y pierde la
+identidad cuando deja de parecerse. Así una persona parada frente a la
+cámara no cuesta un reconocimiento por frame.
+
+Debouncer decide qué se registra: un cliente a lo sumo una vez cada
+STREAM_DEBOUNCE_SECONDS, aunque reaparezca en otro track o en otro stream.
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import numpy as np
+from ..core.config import settings
+from .matcher import box_iou, l2_normalize
+
+
+class Track:
+    __slots__ = ("id", "bbox", "embedding", "query", "client_id", "score",
+                 "first_seen", "last_seen", "frames", "tried_at")
+
+    def __init__(self, track_id: int, now: float):
+        self.id = track_id
+        self.bbox: Optional[np.ndarray] = None
+        self.embedding: Optional[np.ndarray] = None  # último embedding visto
+        self.query: Optional[np.ndarray] = None      # embedding de este frame (None si no se calculó)
+        self.client_id: Optional[str] = None
+        self.score: Optional[float] = None
+        self.first_seen = now
+        self.last_seen = now
+        self.frames = 0
+        self.tried_at: Optional[float] = None        # última comparación contra la galería
+
+    @property
+    def identified(self) -> bool:
+        return self.client_id is not None
+
+    def needs_match(self, now: float) -> bool:
+        # reconocido o no: cada STREAM_RETRY_SECONDS, si este frame trae embedding
+        if self.query is None:
+            return False
+        return self.tried_at is None or now - self.tried_at >= settings.STREAM_RETRY_SECONDS
+
+
+class FaceTracker:
+    """Tracks de un stream; no es thread-safe (un tracker por conexión)."""
+
+    def __init__(self):
+        self._tracks: Dict[int, Track] = {}
+        self._next_id = 1
+
+    def __len__(self) -> int:
+        return len(self._tracks)
+
+    def _expire(self, now: float):
+        ttl = settings.STREAM_TRACK_TTL_SECONDS
+        for tid in [t.id for t in self._tracks.values() if now - t.last_seen > ttl]:
+            del self._tracks[tid]
+
+    def skip_boxes(self, now: float) -> List[List[float]]:
+        """Cajas de los tracks que no necesitan un embedding nuevo en este frame."""
+        self._expire(now)
+        retry = settings.STREAM_RETRY_SECONDS
+        return [t.bbox.tolist() for t in self._tracks.values()
+                if t.bbox is not None and t.tried_at is not None and now - t.tried_at < retry]
+
+    @staticmethod
+    def _similarity(q: Optional[np.ndarray], t: Track) -> Optional[float]:
+        if q is None or t.embedding is None or q.shape != t.embedding.shape:
+            return None
+        return float(t.embedding @ q)
+
+    def _affinity(self, faces: List[Dict[str, Any]], tracks: List[Track]) -> np.ndarray:
+        # (caras x tracks); -inf = no asociables
+        aff = np.full((len(faces), len(tracks)), -np.inf, dtype=np.float32)
+        if not faces or not tracks:
+            return aff
+        for i, face in enumerate(faces):
+            box, emb = face.get("bbox"), face.get("embedding")
+            q = l2_normalize(emb) if emb is not None else None
+            for j, t in enumerate(tracks):
+                sim = self._similarity(q, t)
+                if box is not None and t.bbox is not None:
+                    iou = float(box_iou(np.asarray(box), t.bbox)[0, 0])
+                    if iou >= settings.STREAM_TRACK_IOU and (sim is None or sim >= settings.STREAM_TRACK_MIN_SIM):
+                        aff[i, j] = iou
+                elif sim is not None and sim >= settings.STREAM_TRACK_MIN_SIM:
+                    aff[i, j] = sim
+        return aff
+
+    def update(self, faces: List[Dict[str, Any]], now: float) -> List[Track]:
+        """
+        Asocia las caras del frame ({bbox?, embedding?}) a tracks, abriendo
+        tracks nuevos para las que no se asocian. Devuelve un track por cara.
+        """
+        self._expire(now)
+        tracks = list(self._tracks.values())
+        aff = self._affinity(faces, tracks)
+        assigned: Dict[int, Track] = {}
+        taken = set()
+        # greedy: primero los pares más parecidos
+        for flat in np.argsort(-aff, axis=None):
+            i, j = (int(x) for x in np.unravel_index(flat, aff.shape))
+            if not np.isfinite(aff[i, j]):
+                break
+            if i in assigned or j in taken:
+                continue
+            assigned[i] = tracks[j]
+            taken.add(j)
+        out: List[Track] = []
+        for i, face in enumerate(faces):
+            t = assigned.get(i)
+            if t is None:
+                t = self._tracks[self._next_id] = Track(self._next_id, now)
+                self._next_id += 1
+            if face.get("bbox") is not None:
+                t.bbox = np.asarray(face["bbox"], dtype=np.float32)
+            emb = face.get("embedding")
+            t.query = l2_normalize(emb) if emb is not None else None
+            if t.query is not None:
+                t.embedding = t.query
+            t.last_seen = now
+            t.frames += 1
+            out.append(t)
+        return out
+
+
+class Debouncer:
+    """Último registro por cliente, compartido por todos los streams del proceso."""
+
+    MAX_ENTRIES = 100_000
+
+    def __init__(self):
+        self._last: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    def allow(self, client_id: str, now: float) -> bool:
+        window = settings.STREAM_DEBOUNCE_SECONDS
+        with self._lock:
+            last = self._last.get(client_id)
+            if last is not None and now - last < window:
+                self.suppressed += 1
+                return False
+            self._last[client_id] = now
+            self._last.move_to_end(client_id)
+            # los más viejos salen primero; pasada la ventana ya no importan
+            while len(self._last) > self.MAX_ENTRIES:
+                self._last.popitem(last=False)
+            return True
+
+
+debouncer = Debouncer()
@@ -0,0 +1,266 @@
+# app/services/vector_codec.py
+"""
+Codecs compactos para embeddings.
+
+- float32: referencia (4 bytes/dim)
+- float16: 2 bytes/dim
+- int8:    1 byte/dim + 4 bytes de escala por vector (cuantización simétrica)
+- pq:      product quantization, M bytes por vector; el score se calcula con
+           asymmetric distance computation (query float32 vs códigos)
+
+Todos los scores son productos punto (los vectores van L2-normalizados).
+"""
+import json
+import struct
+from typing import Any, Dict, Optional, Tuple
+import numpy as np
+
+# Filas por bloque al descomprimir para puntuar: acota la memoria temporal
+SCORE_CHUNK = 16384
+
+
+class Float32Codec:
+    name = "float32"
+    dtype = np.float32
+
+    def code_width(self, dim: int) -> int:
+        return dim
+
+    def encode(self, x: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        return np.asarray(x, dtype=np.float32), None
+
+    def decode(self, codes: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+        return np.asarray(codes, dtype=np.float32)
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+        return queries @ codes.T
+
+
+class Float16Codec(Float32Codec):
+    name = "float16"
+    dtype = np.float16
+
+    def encode(self, x: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        return np.asarray(x, dtype=np.float32).astype(np.float16), None
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+        # NumPy no tiene BLAS para float16: se convierte por bloques
+        out = np.empty((queries.shape[0], codes.shape[0]), dtype=np.float32)
+        for i in range(0, codes.shape[0], SCORE_CHUNK):
+            out[:, i:i + SCORE_CHUNK] = queries @ codes[i:i + SCORE_CHUNK].astype(np.float32).T
+        return out
+
+
+class Int8Codec(Float32Codec):
+    name = "int8"
+    dtype = np.int8
+
+    def encode(self, x: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        x = np.atleast_2d(np.asarray(x, dtype=np.float32))
+        scales = np.abs(x).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(x / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def decode(self, codes: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+        return codes.astype(np.float32) * np.asarray(scales, dtype=np.float32)[:, None]
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+        out = np.empty((queries.shape[0], codes.shape[0]), dtype=np.float32)
+        for i in range(0, codes.shape[0], SCORE_CHUNK):
+            block = codes[i:i + SCORE_CHUNK].astype(np.float32)
+            out[:, i:i + SCORE_CHUNK] = (queries @ block.T) * scales[i:i + SCORE_CHUNK]
+        return out
+
+
+def _kmeans_l2(x: np.ndarray, k: int, iters: int = 15, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=len(x) < k)].copy()
+    for _ in range(iters):
+        # argmin ||x - c||² == argmax (x·c - ||c||²/2)
+        assign = np.argmax(x @ centroids.T - 0.5 * (centroids ** 2).sum(axis=1), axis=1)
+        onehot = np.zeros((k, len(x)), dtype=np.float32)
+        onehot[assign, np.arange(len(x))] = 1.0
+        counts = onehot.sum(axis=1)
+        sums = onehot @ x
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), size=int(empty.sum()))]
+    return centroids
+
+
+class ProductQuantizer:
+    """
+    Divide cada vector en m sub-vectores y cuantiza cada uno con su propio
+    codebook de 256 centroides: un vector se guarda en m bytes (uint8).
+    """
+
+    name = "pq"
+    dtype = np.uint8
+    ksub = 256
+
+    def __init__(self, dim: int, m: int):
+        # m debe dividir la dimensión: se baja al divisor más cercano
+        m = max(1, min(m, dim))
+        while dim % m:
+            m -= 1
+        self.dim = dim
+        self.m = m
+        self.dsub = dim // m
+        self.codebooks: Optional[np.ndarray] = None  # (m, 256, dsub)
+
+    @property
+    def trained(self) -> bool:
+        return self.codebooks is not None
+
+    def code_width(self, dim: int) -> int:
+        return self.m
+
+    def train(self, x: np.ndarray, max_points: int = 256 * 64):
+        x = np.asarray(x, dtype=np.float32)
+        if len(x) > max_points:
+            x = x[np.random.default_rng(0).choice(len(x), size=max_points, replace=False)]
+        sub = x.reshape(len(x), self.m, self.dsub)
+        self.codebooks = np.stack([_kmeans_l2(sub[:, j, :], self.ksub, seed=j) for j in range(self.m)])
+
+    def encode(self, x: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        x = np.atleast_2d(np.asarray(x, dtype=np.float32))
+        sub = x.reshape(len(x), self.m, self.dsub)
+        codes = np.empty((len(x), self.m), dtype=np.uint8)
+        half_norms = 0.5 * (self.codebooks ** 2).sum(axis=2)
+        for j in range(self.m):
+            codes[:, j] = np.argmax(sub[:, j, :] @ self.codebooks[j].T - half_norms[j], axis=1)
+        return codes, None
+
+    def decode(self, codes: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+        parts = [self.codebooks[j][codes[:, j]] for j in range(self.m)]
+        return np.concatenate(parts, axis=1).astype(np.float32)
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+        # ADC: una tabla (Q, m, 256) de productos parciales y luego m gathers
+        q = np.atleast_2d(queries).reshape(-1, self.m, self.dsub)
+        tables = np.einsum("qmd,mkd->qmk", q, self.codebooks)
+        out = np.zeros((q.shape[0], codes.shape[0]), dtype=np.float32)
+        for j in range(self.m):
+            out += tables[:, j, codes[:, j]]
+        return out
+
+
+_CODECS = {
+    "float32": Float32Codec,
+    "float16": Float16Codec,
+    "int8": Int8Codec,
+}
+
+
+def get_codec(name: str):
+    """Codecs sin entrenamiento (float32/float16/int8). PQ se crea con ProductQuantizer."""
+    name = (name or "float32").lower().strip()
+    if name not in _CODECS:
+        raise ValueError(f"Unknown vector codec: {name}")
+    return _CODECS[name]()
+
+
+def bytes_per_vector(codec, dim: int) -> int:
+    size = codec.code_width(dim) * np.dtype(codec.dtype).itemsize
+    return size + (4 if codec.name == "int8" else 0)
+
+
+# --------- forma persistida (Firestore) ---------
+#
+# Formato binario versionado, little-endian:
+#   magic "VEC" | version u8 | dtype u8 | reservado u8 | dim u32 | scale f32 | payload
+# El payload son los dim elementos crudos (float32 / float16 / int8); scale solo
+# se usa con int8. Se guarda tal cual como bytes en Firestore, o cifrado con Fernet.
+
+PACK_MAGIC = b"VEC"
+PACK_VERSION = 1
+_HEADER = struct.Struct("<3sBBxIf")
+_PACK_DTYPES = {1: ("float32", "<f4"), 2: ("float16", "<f2"), 3: ("int8", "i1")}
+_PACK_CODES = {name: (code, dt) for code, (name, dt) in _PACK_DTYPES.items()}
+
+
+def is_packed(blob: bytes) -> bool:
+    return isinstance(blob, (bytes, bytearray, memoryview)) and bytes(blob[:3]) == PACK_MAGIC
+
+
+def pack(vec, codec_name: str = "float32") -> bytes:
+    name = (codec_name or "float32").lower().strip()
+    if name not in _PACK_CODES:
+        raise ValueError(f"Codec {name} cannot be persisted")
+    code, dt = _PACK_CODES[name]
+    v = np.asarray(vec, dtype=np.float32).ravel()
+    scale = 1.0
+    if name == "int8":
+        codes, scales = Int8Codec().encode(v)
+        payload, scale = codes[0], float(scales[0])
+    else:
+        payload = v.astype(dt, copy=False)
+    return _HEADER.pack(PACK_MAGIC, PACK_VERSION, code, v.shape[0], scale) + payload.tobytes()
+
+
+def unpack(blob: bytes) -> np.ndarray:
+    magic, version, code, dim, scale = _HEADER.unpack_from(blob)
+    if magic != PACK_MAGIC:
+        raise ValueError("Not a packed vector")
+    if version != PACK_VERSION or code not in _PACK_DTYPES:
+        raise ValueError(f"Unsupported packed vector (version={version}, dtype={code})")
+    name, dt = _PACK_DTYPES[code]
+    arr = np.frombuffer(blob, dtype=dt, count=dim, offset=_HEADER.size)
+    if name == "float32":
+        return arr
+    if name == "int8":
+        return arr.astype(np.float32) * np.float32(scale)
+    return arr.astype(np.float32)
+
+
+def from_document(doc: Dict[str, Any], data: Optional[bytes] = None) -> np.ndarray:
+    """Lee la forma {"codec", "scale", "data"} escrita antes del formato binario."""
+    codec = get_codec(doc["codec"])
+    codes = np.frombuffer(data if data is not None else doc["data"], dtype=codec.dtype).reshape(1, -1)
+    scales = np.asarray([doc["scale"]], dtype=np.float32) if "scale" in doc else None
+    return codec.decode(codes, scales)[0]
+
+
+# --------- evaluación ---------
+
+def evaluate_codec(base: np.ndarray, queries: np.ndarray, codec_name: str, k: int = 1, pq_m: int = 64) -> Dict[str, Any]:
+    """
+    Recall@k del codec contra la búsqueda exacta float32 sobre la misma base.
+    base y queries deben venir L2-normalizados.
+    """
+    base = np.asarray(base, dtype=np.float32)
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    if codec_name == "pq":
+        codec = ProductQuantizer(base.shape[1], pq_m)
+        codec.train(base)
+    else:
+        codec = get_codec(codec_name)
+    codes, scales = codec.encode(base)
+    exact = np.argsort(-(queries @ base.T), axis=1)[:, :k]
+    approx = np.argsort(-codec.scores(queries, codes, scales), axis=1)[:, :k]
+    recall = float(np.mean([len(set(a) & set(e)) / k for a, e in zip(approx, exact)]))
+    bpv = bytes_per_vector(codec, base.shape[1])
+    return {
+        "codec": codec.name,
+        "k": k,
+        "recall": recall,
+        "recall_delta": recall - 1.0,
+        "bytes_per_vector": bpv,
+        "compression_vs_float32": (4 * base.shape[1]) / bpv,
+    }
+
+
+if __name__ == "__main__":  # pragma: no cover
+    # python -m app.services.vector_codec [dim] [n]  -> informe de recall en JSON
+    import sys
+    dim = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((max(1, n // 20), dim)).astype(np.float32)
+    base = centers[rng.integers(0, len(centers), n)] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+    base /= np.linalg.norm(base, axis=1, keepdims=True)
+    queries = base[:200] + (0.3 / np.sqrt(dim)) * rng.standard_normal((200, dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    print(json.dumps([evaluate_codec(base, queries, c, k=10) for c in ("float16", "int8", "pq")], indent=2))
@@ -0,0 +1,517 @@
+# app/services/vector_index.py
+import heapq
+import math
+import random
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from ..core.config import settings
+from .matcher import l2_normalize, top_k_scores
+from .vector_codec import ProductQuantizer, get_codec
+
+# Todos los índices reciben vectores float32 ya L2-normalizados y
+# devuelven, por query, una lista [(key, score)] ordenada de mayor a menor.
+# add()/remove() no entrenan ni reconstruyen: maintenance_due() avisa cuándo
+# hace falta y la galería construye el reemplazo en segundo plano (build_index).
+Results = List[List[Tuple[str, float]]]
+
+
+class FlatIndex:
+    """
+    Búsqueda exacta sobre una matriz contigua de códigos.
+    Con codec float16/int8 la galería ocupa 2x/4x menos que en float32 y el
+    score se calcula descomprimiendo por bloques.
+    """
+
+    kind = "flat"
+
+    def __init__(self, dim: int, codec: str = "float32"):
+        self.dim = dim
+        self.codec = get_codec(codec)
+        self.codec_name = self.codec.name
+        self._ids: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._codes = np.zeros((0, self.codec.code_width(dim)), dtype=self.codec.dtype)
+        self._scales = np.zeros((0,), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._rows
+
+    def items(self) -> Tuple[List[str], np.ndarray]:
+        n = len(self._ids)
+        return list(self._ids), self.codec.decode(self._codes[:n], self._scales[:n])
+
+    def nbytes(self) -> int:
+        n = len(self._ids)
+        return int(self._codes[:n].nbytes + (self._scales[:n].nbytes if self.codec.name == "int8" else 0))
+
+    def attach(self, ids: List[str], matrix: np.ndarray):
+        """
+        Usa `matrix` (float32, filas ya normalizadas, posiblemente con filas
+        libres al final) como almacenamiento sin copiarla, p. ej. un np.memmap
+        del snapshot de la galería.
+        """
+        if self.codec.name != "float32" or len(self._ids):
+            raise ValueError("attach() needs an empty float32 index")
+        self._ids = list(ids)
+        self._rows = {k: i for i, k in enumerate(self._ids)}
+        self._codes = matrix
+        self._scales = np.ones((matrix.shape[0],), dtype=np.float32)
+
+    def _ensure_capacity(self, need: int):
+        cap = self._codes.shape[0]
+        if need <= cap:
+            return
+        n = len(self._ids)
+        new_cap = max(need, cap * 2, 64)
+        codes = np.zeros((new_cap, self._codes.shape[1]), dtype=self._codes.dtype)
+        codes[:n] = self._codes[:n]
+        scales = np.ones((new_cap,), dtype=np.float32)
+        scales[:n] = self._scales[:n]
+        self._codes, self._scales = codes, scales
+
+    def add(self, key: str, vec: np.ndarray):
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self._ids)
+            self._ensure_capacity(row + 1)
+            self._ids.append(key)
+            self._rows[key] = row
+        codes, scales = self.codec.encode(vec.reshape(1, -1))
+        self._codes[row] = codes[0]
+        if scales is not None:
+            self._scales[row] = scales[0]
+
+    def maintenance_due(self) -> bool:
+        return False
+
+    def maintain(self):
+        pass
+
+    def remove(self, key: str) -> bool:
+        row = self._rows.pop(key, None)
+        if row is None:
+            return False
+        # swap-with-last para mantener la matriz contigua
+        last = len(self._ids) - 1
+        if row != last:
+            last_id = self._ids[last]
+            self._codes[row] = self._codes[last]
+            self._scales[row] = self._scales[last]
+            self._ids[row] = last_id
+            self._rows[last_id] = row
+        self._ids.pop()
+        return True
+
+    def search_batch(self, queries: np.ndarray, k: int) -> Results:
+        n = len(self._ids)
+        if n == 0:
+            return [[] for _ in range(queries.shape[0])]
+        idx, scores = top_k_scores(self.codec.scores(queries, self._codes[:n], self._scales[:n]), k)
+        return [
+            [(self._ids[i], float(s)) for i, s in zip(row_idx, row_scores)]
+            for row_idx, row_scores in zip(idx, scores)
+        ]
+
+
+class PQIndex:
+    """
+    Búsqueda exhaustiva sobre códigos PQ (m bytes por vector) con ADC.
+    Hasta tener suficientes vectores para entrenar los codebooks guarda
+    los vectores en float32 (FlatIndex); luego los codifica y descarta.
+    """
+
+    kind = "pq"
+    codec_name = "pq"
+    TRAIN_SIZE = 256 * 4
+
+    def __init__(self, dim: int, m: int):
+        self.dim = dim
+        self.pq = ProductQuantizer(dim, m)
+        self._pending: Optional[FlatIndex] = FlatIndex(dim)
+        self._ids: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._codes = np.zeros((0, self.pq.m), dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self._pending) if self._pending is not None else len(self._ids)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._pending if self._pending is not None else key in self._rows
+
+    def items(self) -> Tuple[List[str], np.ndarray]:
+        if self._pending is not None:
+            return self._pending.items()
+        n = len(self._ids)
+        return list(self._ids), self.pq.decode(self._codes[:n])
+
+    def nbytes(self) -> int:
+        if self._pending is not None:
+            return self._pending.nbytes()
+        return int(self._codes[:len(self._ids)].nbytes)
+
+    def train(self):
+        ids, vecs = self._pending.items()
+        self.pq.train(vecs)
+        codes, _ = self.pq.encode(vecs)
+        self._ids = list(ids)
+        self._rows = {k: i for i, k in enumerate(ids)}
+        self._codes = codes
+        self._pending = None
+
+    def maintenance_due(self) -> bool:
+        return self._pending is not None and len(self._pending) >= self.TRAIN_SIZE
+
+    def maintain(self):
+        self.train()
+
+    def add(self, key: str, vec: np.ndarray):
+        if self._pending is not None:
+            self._pending.add(key, vec)
+            return
+        code, _ = self.pq.encode(vec.reshape(1, -1))
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self._ids)
+            if row >= self._codes.shape[0]:
+                grown = np.zeros((max(64, 2 * self._codes.shape[0]), self.pq.m), dtype=np.uint8)
+                grown[:row] = self._codes[:row]
+                self._codes = grown
+            self._ids.append(key)
+            self._rows[key] = row
+        self._codes[row] = code[0]
+
+    def remove(self, key: str) -> bool:
+        if self._pending is not None:
+            return self._pending.remove(key)
+        row = self._rows.pop(key, None)
+        if row is None:
+            return False
+        last = len(self._ids) - 1
+        if row != last:
+            last_id = self._ids[last]
+            self._codes[row] = self._codes[last]
+            self._ids[row] = last_id
+            self._rows[last_id] = row
+        self._ids.pop()
+        return True
+
+    def search_batch(self, queries: np.ndarray, k: int) -> Results:
+        if self._pending is not None:
+            return self._pending.search_batch(queries, k)
+        n = len(self._ids)
+        if n == 0:
+            return [[] for _ in range(queries.shape[0])]
+        idx, scores = top_k_scores(self.pq.scores(queries, self._codes[:n]), k)
+        return [
+            [(self._ids[i], float(s)) for i, s in zip(row_idx, row_scores)]
+            for row_idx, row_scores in zip(idx, scores)
+        ]
+
+
+def _kmeans(x: np.ndarray, k: int, iters: int = 20, seed: int = 0) -> np.ndarray:
+    """k-means esférico (coseno) en NumPy; devuelve k centroides normalizados."""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        onehot = np.zeros((k, len(x)), dtype=np.float32)
+        onehot[assign, np.arange(len(x))] = 1.0
+        sums = onehot @ x
+        empty = onehot.sum(axis=1) == 0
+        if empty.any():
+            # re-sembrar clusters vacíos con puntos al azar
+            sums[empty] = x[rng.choice(len(x), size=int(empty.sum()), replace=False)]
+        centroids = l2_normalize(sums)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted file: un cuantizador grueso (k-means con nlist centroides) reparte
+    los vectores en listas; cada query solo recorre las nprobe listas más cercanas.
+    Hasta juntar suficientes vectores para entrenar se comporta como FlatIndex.
+    """
+
+    kind = "ivf"
+    TRAIN_FACTOR = 16      # vectores por lista necesarios para entrenar
+    RETRAIN_GROWTH = 4     # re-entrena cuando la galería crece 4x
+
+    def __init__(self, dim: int, nlist: int, nprobe: int, codec: str = "float32"):
+        self.dim = dim
+        self.codec = codec
+        self.codec_name = get_codec(codec).name
+        self.nlist = max(1, nlist)
+        self.nprobe = max(1, nprobe)
+        self._pending = FlatIndex(dim, codec)
+        self._lists: List[FlatIndex] = []
+        self._centroids: Optional[np.ndarray] = None
+        self._where: Dict[str, int] = {}
+        self._trained_size = 0
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._where
+
+    def items(self) -> Tuple[List[str], np.ndarray]:
+        parts = [self._pending.items()] + [lst.items() for lst in self._lists]
+        ids = [i for p_ids, _ in parts for i in p_ids]
+        mats = [m for _, m in parts if len(m)]
+        return ids, (np.concatenate(mats) if mats else np.zeros((0, self.dim), dtype=np.float32))
+
+    def nbytes(self) -> int:
+        return self._pending.nbytes() + sum(lst.nbytes() for lst in self._lists)
+
+    def add(self, key: str, vec: np.ndarray):
+        self.remove(key)
+        if self._centroids is None:
+            self._pending.add(key, vec)
+            self._where[key] = -1
+            return
+        li = int(np.argmax(self._centroids @ vec))
+        self._lists[li].add(key, vec)
+        self._where[key] = li
+
+    def maintenance_due(self) -> bool:
+        if self._centroids is None:
+            return len(self._pending) >= self.nlist * self.TRAIN_FACTOR
+        return len(self._where) >= self.RETRAIN_GROWTH * self._trained_size
+
+    def maintain(self):
+        self.train()
+
+    def remove(self, key: str) -> bool:
+        li = self._where.pop(key, None)
+        if li is None:
+            return False
+        (self._pending if li < 0 else self._lists[li]).remove(key)
+        return True
+
+    def train(self):
+        ids, vecs = self.items()
+        if len(ids) < self.nlist:
+            return
+        rng = np.random.default_rng(0)
+        sample = vecs
+        if len(vecs) > self.nlist * 64:
+            sample = vecs[rng.choice(len(vecs), size=self.nlist * 64, replace=False)]
+        centroids = _kmeans(sample, self.nlist)
+        lists = [FlatIndex(self.dim, self.codec) for _ in range(self.nlist)]
+        where: Dict[str, int] = {}
+        for start in range(0, len(ids), 8192):
+            chunk = vecs[start:start + 8192]
+            assign = np.argmax(chunk @ centroids.T, axis=1)
+            for key, vec, li in zip(ids[start:start + 8192], chunk, assign):
+                lists[int(li)].add(key, vec)
+                where[key] = int(li)
+        self._centroids, self._lists, self._where = centroids, lists, where
+        self._pending = FlatIndex(self.dim, self.codec)
+        self._trained_size = len(ids)
+
+    def search_batch(self, queries: np.ndarray, k: int) -> Results:
+        if self._centroids is None:
+            return self._pending.search_batch(queries, k)
+        nprobe = min(self.nprobe, self.nlist)
+        coarse = queries @ self._centroids.T
+        probe = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe] if nprobe < self.nlist \
+            else np.broadcast_to(np.arange(self.nlist), coarse.shape)
+        out: Results = []
+        for q, lists in zip(queries, probe):
+            merged: List[Tuple[str, float]] = []
+            for li in lists:
+                merged.extend(self._lists[li].search_batch(q[None, :], k)[0])
+            merged.sort(key=lambda t: -t[1])
+            out.append(merged[:k])
+        return out
+
+
+class HNSWIndex:
+    """
+    Hierarchical Navigable Small World en Python/NumPy.
+    - M: vecinos por nodo (2*M en la capa 0)
+    - ef_construction / ef_search: tamaño de la lista dinámica al insertar / buscar
+    Los borrados se marcan como tombstones (siguen sirviendo para navegar) y el
+    grafo se reconstruye cuando superan el 30% de los nodos (maintenance_due).
+    """
+
+    kind = "hnsw"
+    codec_name = "float32"
+    REBUILD_DELETED_RATIO = 0.3
+
+    def __init__(self, dim: int, m: int, ef_construction: int, ef_search: int, seed: int = 0):
+        self.dim = dim
+        self.m = max(2, m)
+        self.m0 = 2 * self.m
+        self.ef_construction = max(ef_construction, self.m)
+        self.ef_search = max(1, ef_search)
+        self._ml = 1.0 / math.log(self.m)
+        self._rng = random.Random(seed)
+        self._reset()
+
+    def _reset(self):
+        self._vecs = np.zeros((0, self.dim), dtype=np.float32)
+        self._keys: List[Optional[str]] = []          # None = borrado
+        self._node: Dict[str, int] = {}
+        self._links: List[List[List[int]]] = []       # nodo -> capa -> vecinos
+        self._entry: Optional[int] = None
+        self._max_level = -1
+
+    def __len__(self) -> int:
+        return len(self._node)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._node
+
+    def items(self) -> Tuple[List[str], np.ndarray]:
+        nodes = sorted(self._node.values())
+        return [self._keys[n] for n in nodes], self._vecs[nodes]
+
+    def nbytes(self) -> int:
+        return int(self._vecs[:len(self._keys)].nbytes)
+
+    def _search_layer(self, q: np.ndarray, entry_points: List[int], ef: int, level: int) -> List[Tuple[float, int]]:
+        visited = set(entry_points)
+        sims = (self._vecs[entry_points] @ q).tolist()
+        cand = [(-s, e) for s, e in zip(sims, entry_points)]
+        best = [(s, e) for s, e in zip(sims, entry_points)]
+        heapq.heapify(cand)
+        heapq.heapify(best)
+        while cand:
+            neg_s, c = heapq.heappop(cand)
+            if len(best) >= ef and -neg_s < best[0][0]:
+                break
+            nbrs = [n for n in self._links[c][level] if n not in visited]
+            if not nbrs:
+                continue
+            visited.update(nbrs)
+            for s, n in zip((self._vecs[nbrs] @ q).tolist(), nbrs):
+                if len(best) < ef or s > best[0][0]:
+                    heapq.heappush(cand, (-s, n))
+                    heapq.heappush(best, (s, n))
+                    if len(best) > ef:
+                        heapq.heappop(best)
+        return best
+
+    def _greedy(self, q: np.ndarray, target_level: int) -> List[int]:
+        ep = [self._entry]
+        for lv in range(self._max_level, target_level, -1):
+            ep = [max(self._search_layer(q, ep, 1, lv))[1]]
+        return ep
+
+    def _select(self, found: List[Tuple[float, int]], m: int) -> List[int]:
+        """
+        Heurística de selección de vecinos del paper de HNSW: descarta un
+        candidato si está más cerca de un vecino ya elegido que del nodo base,
+        lo que mantiene conexiones entre clusters. Se completa hasta m con los
+        descartados más cercanos.
+        """
+        found = sorted(found, reverse=True)
+        nodes = [n for _, n in found]
+        pair = (self._vecs[nodes] @ self._vecs[nodes].T).tolist()
+        selected: List[int] = []
+        skipped: List[int] = []
+        for i, (s, _) in enumerate(found):
+            if len(selected) >= m:
+                break
+            row = pair[i]
+            if any(row[j] > s for j in selected):
+                skipped.append(i)
+                continue
+            selected.append(i)
+        return [nodes[i] for i in selected + skipped[:m - len(selected)]]
+
+    def _prune(self, node: int, level: int, cap: int):
+        nl = self._links[node][level]
+        sims = (self._vecs[nl] @ self._vecs[node]).tolist()
+        self._links[node][level] = self._select(list(zip(sims, nl)), cap)
+
+    def add(self, key: str, vec: np.ndarray):
+        self.remove(key)
+        node = len(self._keys)
+        if node >= self._vecs.shape[0]:
+            grown = np.zeros((max(64, 2 * self._vecs.shape[0]), self.dim), dtype=np.float32)
+            grown[:node] = self._vecs[:node]
+            self._vecs = grown
+        self._vecs[node] = vec
+        self._keys.append(key)
+        self._node[key] = node
+        level = int(-math.log(1.0 - self._rng.random()) * self._ml)
+        self._links.append([[] for _ in range(level + 1)])
+        if self._entry is None:
+            self._entry, self._max_level = node, level
+            return
+        ep = self._greedy(vec, level)
+        for lv in range(min(level, self._max_level), -1, -1):
+            found = self._search_layer(vec, ep, self.ef_construction, lv)
+            neighbors = self._select(found, self.m)
+            self._links[node][lv] = neighbors
+            cap = self.m0 if lv == 0 else self.m
+            for n in neighbors:
+                self._links[n][lv].append(node)
+                if len(self._links[n][lv]) > cap:
+                    self._prune(n, lv, cap)
+            ep = [n for _, n in found]
+        if level > self._max_level:
+            self._entry, self._max_level = node, level
+
+    def remove(self, key: str) -> bool:
+        node = self._node.pop(key, None)
+        if node is None:
+            return False
+        self._keys[node] = None
+        return True
+
+    def maintenance_due(self) -> bool:
+        deleted = len(self._keys) - len(self._node)
+        return deleted > self.REBUILD_DELETED_RATIO * len(self._keys)
+
+    def maintain(self):
+        self._rebuild()
+
+    def _rebuild(self):
+        ids, vecs = self.items()
+        self._reset()
+        for key, vec in zip(ids, vecs):
+            self.add(key, vec)
+
+    def search_batch(self, queries: np.ndarray, k: int) -> Results:
+        if self._entry is None or not self._node:
+            return [[] for _ in range(queries.shape[0])]
+        out: Results = []
+        for q in queries:
+            found = self._search_layer(q, self._greedy(q, 0), max(self.ef_search, k), 0)
+            found.sort(reverse=True)
+            out.append([(self._keys[n], float(s)) for s, n in found if self._keys[n] is not None][:k])
+        return out
+
+
+def make_index(dim: int, backend: Optional[str] = None, codec: Optional[str] = None):
+    """
+    backend: flat | ivf | hnsw. codec (GALLERY_CODEC): float32 | float16 | int8 | pq.
+    HNSW navega el grafo con float32, así que ignora el codec; pq implica búsqueda
+    exhaustiva con ADC.
+    """
+    backend = (backend or settings.INDEX_BACKEND).lower().strip()
+    codec = (codec or settings.GALLERY_CODEC).lower().strip()
+    if backend == "hnsw":
+        return HNSWIndex(dim, m=settings.HNSW_M, ef_construction=settings.HNSW_EF_CONSTRUCTION,
+                         ef_search=settings.HNSW_EF_SEARCH)
+    if codec == "pq":
+        return PQIndex(dim, m=settings.PQ_M)
+    if backend == "ivf":
+        return IVFIndex(dim, nlist=settings.IVF_NLIST, nprobe=settings.IVF_NPROBE, codec=codec)
+    return FlatIndex(dim, codec)
+
+
+def build_index(dim: int, backend: Optional[str], ids: List[str], vecs: np.ndarray):
+    """Índice nuevo con (ids, vecs), ya entrenado si corresponde."""
+    index = make_index(dim, backend)
+    for key, vec in zip(ids, vecs):
+        index.add(key, vec)
+    if index.maintenance_due():
+        index.maintain()
+    return index
@@ -0,0 +1,13 @@
+"""Benchmarks offline de la API: ver benchmarks/run.py y benchmarks/quantization.py."""
+import os
+import subprocess
+from typing import Optional
+
+
+def git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, timeout=5,
+                             cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        return out.stdout.strip() or None
+    except Exception:
+        return None
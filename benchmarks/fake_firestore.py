@@ -0,0 +1,327 @@
+# benchmarks/fake_firestore.py
+"""
+Firestore en memoria con el subconjunto de la API que usa firebase_client:
+colecciones y subcolecciones, collection_group, get_all con máscara de
+campos, select / where(FieldFilter) / order_by / limit / start_after,
+batches atómicos (create/set/update/delete) y los transforms Increment /
+Minimum / Maximum / DELETE_FIELD.
+
+No modela latencia de red ni índices: mide el costo de nuestro código
+(codificación, descifrado, agregación), no el de Firestore. Se instala con
+install(), que deja el cliente en firebase_client._db y así _init_app()
+nunca arma credenciales.
+"""
+import copy
+import threading
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from google.api_core.exceptions import AlreadyExists, InvalidArgument
+from google.cloud.firestore_v1 import transforms
+
+Path = Tuple[str, ...]
+
+_OPS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "in": lambda a, b: a in b,
+    "not-in": lambda a, b: a not in b,
+    "array_contains": lambda a, b: isinstance(a, list) and b in a,
+}
+
+
+def _apply_fields(target: Dict[str, Any], fields: Dict[str, Any], merge: bool):
+    for key, value in fields.items():
+        old = target.get(key)
+        if value is transforms.DELETE_FIELD:
+            target.pop(key, None)
+        elif value is transforms.SERVER_TIMESTAMP:
+            target[key] = datetime.now(timezone.utc)
+        elif isinstance(value, transforms.Increment):
+            target[key] = (old if isinstance(old, (int, float)) else 0) + value.value
+        elif isinstance(value, transforms.Maximum):
+            target[key] = value.value if not isinstance(old, (int, float)) else max(old, value.value)
+        elif isinstance(value, transforms.Minimum):
+            target[key] = value.value if not isinstance(old, (int, float)) else min(old, value.value)
+        elif isinstance(value, transforms.ArrayUnion):
+            base = list(old) if isinstance(old, list) else []
+            target[key] = base + [v for v in value.values if v not in base]
+        elif isinstance(value, transforms.ArrayRemove):
+            target[key] = [v for v in (old or []) if v not in value.values]
+        elif merge and isinstance(value, dict) and isinstance(old, dict):
+            _apply_fields(old, value, True)  # merge=True mezcla los maps en profundidad
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+def _masked(data: Dict[str, Any], field_paths: Optional[List[str]]) -> Dict[str, Any]:
+    if field_paths is None:
+        return copy.deepcopy(data)
+    return {k: copy.deepcopy(data[k]) for k in field_paths if k in data}
+
+
+class DocumentSnapshot:
+    def __init__(self, reference: "DocumentReference", data: Optional[Dict[str, Any]]):
+        self.reference = reference
+        self._data = data
+
+    @property
+    def id(self) -> str:
+        return self.reference.id
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return self._data
+
+    def get(self, field: str) -> Any:
+        return (self._data or {}).get(field)
+
+
+class DocumentReference:
+    def __init__(self, db: "FakeFirestore", path: Path):
+        self._db = db
+        self._path = path
+
+    @property
+    def id(self) -> str:
+        return self._path[-1]
+
+    @property
+    def path(self) -> str:
+        return "/".join(self._path)
+
+    @property
+    def parent(self) -> "CollectionReference":
+        return CollectionReference(self._db, self._path[:-1])
+
+    def collection(self, name: str) -> "CollectionReference":
+        return CollectionReference(self._db, self._path + (name,))
+
+    def get(self, field_paths: Optional[List[str]] = None) -> DocumentSnapshot:
+        with self._db._lock:
+            data = self._db._docs.get(self._path)
+            return DocumentSnapshot(self, _masked(data, field_paths) if data is not None else None)
+
+    def create(self, data: Dict[str, Any]):
+        self._db._write([("create", self._path, data, False)])
+
+    def set(self, data: Dict[str, Any], merge: bool = False):
+        self._db._write([("set", self._path, data, merge)])
+
+    def update(self, data: Dict[str, Any]):
+        self._db._write([("update", self._path, data, True)])
+
+    def delete(self):
+        self._db._write([("delete", self._path, None, False)])
+
+
+class Query:
+    def __init__(self, db: "FakeFirestore", path: Path, group: bool = False):
+        self._db = db
+        self._path = path          # colección, o (id,) de un collection_group
+        self._group = group
+        self._fields: Optional[List[str]] = None
+        self._filters: List[Tuple[str, str, Any]] = []
+        self._orders: List[Tuple[str, bool]] = []
+        self._limit: Optional[int] = None
+        self._after: Optional[Any] = None
+
+    def _copy(self, **changes) -> "Query":
+        q = copy.copy(self)
+        q._filters, q._orders = list(self._filters), list(self._orders)
+        for k, v in changes.items():
+            setattr(q, k, v)
+        return q
+
+    def select(self, field_paths: List[str]) -> "Query":
+        return self._copy(_fields=list(field_paths))
+
+    def where(self, field_path: Optional[str] = None, op_string: Optional[str] = None,
+              value: Any = None, *, filter: Any = None) -> "Query":
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        q = self._copy()
+        q._filters.append((field_path, op_string, value))
+        return q
+
+    def order_by(self, field_path: str, direction: str = "ASCENDING") -> "Query":
+        q = self._copy()
+        q._orders.append((field_path, direction == "DESCENDING"))
+        return q
+
+    def limit(self, count: int) -> "Query":
+        return self._copy(_limit=count)
+
+    def start_after(self, values: Any) -> "Query":
+        return self._copy(_after=values)
+
+    def _matches(self, path: Path) -> bool:
+        if self._group:
+            return len(path) % 2 == 0 and path[-2] == self._path[0]
+        return len(path) == len(self._path) + 1 and path[:-1] == self._path
+
+    def _sort_key(self, path: Path, data: Dict[str, Any]):
+        # los documentos sin el campo de orden no entran en la consulta (como en Firestore)
+        key = []
+        for field, desc in self._orders:
+            v = "/".join(path) if field == "__name__" else data.get(field)
+            key.append(_Desc(v) if desc else v)
+        key.append("/".join(path))
+        return key
+
+    def _cursor(self) -> Optional[list]:
+        if self._after is None:
+            return None
+        if isinstance(self._after, DocumentSnapshot):
+            ref = self._after.reference
+            return self._sort_key(ref._path, self._db._docs.get(ref._path) or {})
+        if isinstance(self._after, dict):
+            name = self._after.get("__name__")
+            path = self._path + (name,) if name is not None and not self._group else None
+            data = dict(self._after)
+            return self._sort_key(path or (str(name),), data)
+        return None
+
+    def stream(self) -> Iterator[DocumentSnapshot]:
+        with self._db._lock:
+            rows = []
+            for path, data in self._db._docs.items():
+                if not self._matches(path):
+                    continue
+                if any(f not in data or not _OPS[op](data[f], v) for f, op, v in self._filters):
+                    continue
+                if any(f != "__name__" and f not in data for f, _ in self._orders):
+                    continue
+                rows.append((self._sort_key(path, data), path, data))
+            rows.sort(key=lambda r: r[0])
+            cursor = self._cursor()
+            if cursor is not None:
+                rows = [r for r in rows if r[0] > cursor]
+            if self._limit is not None:
+                rows = rows[:self._limit]
+            out = [DocumentSnapshot(DocumentReference(self._db, path), _masked(data, self._fields))
+                   for _, path, data in rows]
+        yield from out
+
+    def get(self) -> List[DocumentSnapshot]:
+        return list(self.stream())
+
+
+class _Desc:
+    """Invierte la comparación para order_by(..., DESCENDING)."""
+
+    __slots__ = ("v",)
+
+    def __init__(self, v):
+        self.v = v
+
+    def __lt__(self, other):
+        return other.v < self.v
+
+    def __gt__(self, other):
+        return other.v > self.v
+
+    def __eq__(self, other):
+        return self.v == other.v
+
+
+class CollectionReference(Query):
+    def __init__(self, db: "FakeFirestore", path: Path):
+        super().__init__(db, path)
+
+    @property
+    def id(self) -> str:
+        return self._path[-1]
+
+    @property
+    def parent(self) -> Optional[DocumentReference]:
+        return DocumentReference(self._db, self._path[:-1]) if len(self._path) > 1 else None
+
+    def document(self, document_id: Optional[str] = None) -> DocumentReference:
+        return DocumentReference(self._db, self._path + (document_id or uuid.uuid4().hex,))
+
+
+class WriteBatch:
+    def __init__(self, db: "FakeFirestore"):
+        self._db = db
+        self._ops: List[Tuple[str, Path, Any, bool]] = []
+
+    def create(self, ref: DocumentReference, data: Dict[str, Any]):
+        self._ops.append(("create", ref._path, data, False))
+
+    def set(self, ref: DocumentReference, data: Dict[str, Any], merge: bool = False):
+        self._ops.append(("set", ref._path, data, merge))
+
+    def update(self, ref: DocumentReference, data: Dict[str, Any]):
+        self._ops.append(("update", ref._path, data, True))
+
+    def delete(self, ref: DocumentReference):
+        self._ops.append(("delete", ref._path, None, False))
+
+    def commit(self):
+        if len(self._ops) > 500:
+            raise InvalidArgument("maximum 500 writes allowed per request")
+        self._db._write(self._ops)
+        self._ops = []
+
+
+class FakeFirestore:
+    def __init__(self):
+        self._docs: Dict[Path, Dict[str, Any]] = {}
+        self._lock = threading.RLock()
+        self.writes = 0
+        self.reads = 0
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def collection(self, name: str) -> CollectionReference:
+        return CollectionReference(self, (name,))
+
+    def collection_group(self, collection_id: str) -> Query:
+        return Query(self, (collection_id,), group=True)
+
+    def document(self, path: str) -> DocumentReference:
+        return DocumentReference(self, tuple(path.split("/")))
+
+    def batch(self) -> WriteBatch:
+        return WriteBatch(self)
+
+    def get_all(self, references: List[DocumentReference],
+                field_paths: Optional[List[str]] = None) -> Iterator[DocumentSnapshot]:
+        for ref in references:
+            self.reads += 1
+            yield ref.get(field_paths=field_paths)
+
+    def _write(self, ops: List[Tuple[str, Path, Any, bool]]):
+        with self._lock:
+            # atómico como un batch: se valida todo antes de aplicar nada
+            for op, path, _, _ in ops:
+                if op == "create" and path in self._docs:
+                    raise AlreadyExists(f"Document already exists: {'/'.join(path)}")
+                if op == "update" and path not in self._docs:
+                    raise KeyError(f"No document to update: {'/'.join(path)}")
+            for op, path, data, merge in ops:
+                self.writes += 1
+                if op == "delete":
+                    self._docs.pop(path, None)
+                    continue
+                target = self._docs.get(path) if merge else None
+                if target is None:
+                    target = self._docs[path] = {}
+                _apply_fields(target, data, merge)
+
+
+def install(db: Optional[FakeFirestore] = None) -> FakeFirestore:
+    """Reemplaza el cliente de Firestore de firebase_client por uno en memoria."""
+    from app.services import firebase_client
+    db = db or FakeFirestore()
+    firebase_client._db = db
+    return db
@@ -0,0 +1,183 @@
+# benchmarks/quantization.py
+"""
+Precisión y latencia del backend insightface por variante: fp32 contra
+int8 (app/scripts/quantize_models.py) y por tamaño de entrada del detector.
+
+    python -m benchmarks.quantization --images fotos/ --det-sizes 640,320 --out quant.json
+
+Con imágenes reales (las sintéticas no tienen caras). Si --images tiene una
+subcarpeta por persona, además se mide identificación (rank-1, dejando
+afuera la propia imagen) y verificación al MATCH_THRESHOLD (TAR / FAR).
+
+Por variante: latencia por fase (decode, detect, recognize) y, contra la
+primera variante (la referencia, fp32): imágenes con cara que coinciden y
+similitud coseno entre los embeddings de la misma imagen.
+"""
+import os
+
+os.environ.setdefault("INTERNAL_SECRET", "bench")
+os.environ.setdefault("EMBEDDER_PRELOAD", "false")
+
+import argparse  # noqa: E402
+import json  # noqa: E402
+import platform  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+from datetime import datetime, timezone  # noqa: E402
+from typing import Any, Dict, List, Optional, Tuple  # noqa: E402
+import numpy as np  # noqa: E402
+
+from app.core.config import settings  # noqa: E402
+from app.core import metrics  # noqa: E402
+from app.scripts.quantize_models import list_images  # noqa: E402
+from app.services import onnx_models  # noqa: E402
+from . import git_commit  # noqa: E402
+
+
+def _stats(ms: List[float]) -> Dict[str, float]:
+    if not ms:
+        return {}
+    a = np.asarray(ms)
+    return {"mean_ms": float(a.mean()), "p50_ms": float(np.percentile(a, 50)), "p95_ms": float(np.percentile(a, 95))}
+
+
+def run_variant(contents: List[bytes], int8: bool, det_size: int, repeat: int) -> Tuple[Dict[str, Any], List[Optional[np.ndarray]]]:
+    from app.services.face_embedder import FaceEmbedder
+    settings.EMBEDDER_BACKEND = "insightface"
+    settings.INSIGHTFACE_INT8 = int8
+    settings.INSIGHTFACE_DET_SIZE = det_size
+    t = time.perf_counter()
+    emb = FaceEmbedder()
+    load_ms = (time.perf_counter() - t) * 1000.0
+    emb.warm_up()
+    stages: Dict[str, List[float]] = {"decode": [], "detect": [], "recognize": [], "total": []}
+    out: List[Optional[np.ndarray]] = []
+    for content in contents:
+        vec = None
+        for _ in range(repeat):
+            t = time.perf_counter()
+            with metrics.collect() as measured:
+                vec = emb.embed_images([content])[0]
+            stages["total"].append((time.perf_counter() - t) * 1000.0)
+            for name, seconds in measured:
+                if name in stages:
+                    stages[name].append(seconds * 1000.0)
+        out.append(np.asarray(vec, dtype=np.float32) if vec is not None else None)
+    row = {
+        "precision": "int8" if int8 else "fp32",
+        "det_size": det_size,
+        "files": emb.info.get("files"),
+        "intra_op_threads": emb.info.get("intra_op_threads"),
+        "load_ms": load_ms,
+        "faces_found": sum(v is not None for v in out),
+        "latency": {name: _stats(ms) for name, ms in stages.items()},
+    }
+    return row, out
+
+
+def agreement(ref: List[Optional[np.ndarray]], embs: List[Optional[np.ndarray]]) -> Dict[str, Any]:
+    """Misma imagen, dos variantes: ¿encuentran cara las dos y dan el mismo embedding?"""
+    same_found = sum((a is None) == (b is None) for a, b in zip(ref, embs))
+    sims = [float(a @ b) for a, b in zip(ref, embs) if a is not None and b is not None]
+    out: Dict[str, Any] = {"same_found": same_found / len(ref) if ref else 0.0}
+    if sims:
+        out.update(cosine_mean=float(np.mean(sims)), cosine_min=float(np.min(sims)),
+                   cosine_p5=float(np.percentile(sims, 5)))
+    return out
+
+
+def identity_metrics(labels: List[str], embs: List[Optional[np.ndarray]], threshold: float) -> Dict[str, Any]:
+    keep = [i for i, e in enumerate(embs) if e is not None]
+    if len(keep) < 2:
+        return {}
+    mat = np.stack([embs[i] for i in keep])
+    lab = np.asarray([labels[i] for i in keep])
+    sims = mat @ mat.T
+    np.fill_diagonal(sims, -np.inf)
+    same = lab[:, None] == lab[None, :]
+    np.fill_diagonal(same, False)
+    has_pair = same.any(axis=1)
+    nearest = sims.argmax(axis=1)
+    upper = np.triu(np.ones_like(same, dtype=bool), k=1)
+    genuine, impostor = sims[same & upper], sims[~same & upper]
+    return {
+        "rank1": float((lab[nearest] == lab)[has_pair].mean()) if has_pair.any() else None,
+        "tar": float((genuine >= threshold).mean()) if genuine.size else None,
+        "far": float((impostor >= threshold).mean()) if impostor.size else None,
+        "threshold": threshold,
+        "genuine_pairs": int(genuine.size),
+        "impostor_pairs": int(impostor.size),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Accuracy/latency of fp32 vs int8 insightface models")
+    parser.add_argument("--images", required=True, help="face images; one subfolder per person enables rank-1/TAR/FAR")
+    parser.add_argument("--det-sizes", default=str(settings.INSIGHTFACE_DET_SIZE), help="detector input sizes to try")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per image (latency)")
+    parser.add_argument("--threshold", type=float, default=settings.MATCH_THRESHOLD)
+    parser.add_argument("--no-int8", action="store_true", help="only fp32 (e.g. to compare det sizes)")
+    parser.add_argument("--out", help="write JSON here (default: stdout)")
+    args = parser.parse_args(argv)
+
+    paths = list_images(args.images)
+    if not paths:
+        print(f"No images in {args.images}", file=sys.stderr)
+        return 2
+    contents = []
+    for p in paths:
+        with open(p, "rb") as f:
+            contents.append(f.read())
+    labels = [os.path.relpath(os.path.dirname(p), args.images) for p in paths]
+    labelled = len(set(labels)) > 1
+
+    precisions = [False]
+    if not args.no_int8:
+        det = onnx_models.resolve(onnx_models.model_dir())
+        if all(os.path.exists(onnx_models.int8_path(p)) for p in det.values()):
+            precisions.append(True)
+        else:
+            print("int8 models not found (python -m app.scripts.quantize_models): fp32 only", file=sys.stderr)
+
+    variants: List[Dict[str, Any]] = []
+    ref: Optional[List[Optional[np.ndarray]]] = None
+    for int8 in precisions:
+        for size in [int(s) for s in args.det_sizes.split(",") if s.strip()]:
+            row, embs = run_variant(contents, int8, size, args.repeat)
+            if ref is None:
+                ref = embs
+            row["vs_reference"] = agreement(ref, embs)
+            if labelled:
+                row["identity"] = identity_metrics(labels, embs, args.threshold)
+            variants.append(row)
+            total = row["latency"]["total"].get("mean_ms", 0.0)
+            print(f"  {row['precision']:5s} det={size:4d} faces={row['faces_found']:4d}/{len(paths)} "
+                  f"{total:8.2f} ms/img  cos={row['vs_reference'].get('cosine_mean', float('nan')):.4f}",
+                  file=sys.stderr)
+
+    out = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "images": len(paths),
+            "identities": len(set(labels)) if labelled else None,
+            "settings": {k: getattr(settings, k) for k in (
+                "INSIGHTFACE_MODEL", "IMAGE_MAX_SIDE", "ONNX_PROVIDERS", "ONNX_INTRA_OP_THREADS",
+                "ONNX_INTER_OP_THREADS", "ONNX_GRAPH_OPTIMIZATION", "INFERENCE_WORKERS")},
+        },
+        "variants": variants,
+    }
+    text = json.dumps(out, indent=2, default=str)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
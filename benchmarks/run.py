@@ -0,0 +1,353 @@
+# benchmarks/run.py
+"""
+Benchmarks reproducibles, sin red ni proyecto de Firebase: Firestore se
+reemplaza por uno en memoria (fake_firestore) y el embedder es el mock.
+
+    python -m benchmarks.run                                  # todas las suites
+    python -m benchmarks.run --suite matching --sizes 1000,100000,1000000 --dims 128,512
+    python -m benchmarks.run --out bench.json --baseline bench-prev.json --max-regression 1.25
+
+Suites:
+  matching   matcher.best_match / best_match_matrix y Gallery.search_batch
+  codec      firebase_client._enc_vector / _dec_vector por codec, con y sin Fernet
+  embedding  face_embedder.embed_image (backend mock) por tamaño de imagen
+  reports    list_detections_for_date sobre un historial sintético (Firestore en memoria y local)
+  http       requests de punta a punta con el cliente ASGI de prueba
+
+La salida es JSON: `meta` (versión, commit, settings) y `results`, una
+entrada por medición con runs, mean/p50/p95/min en ms y ops/s. Con
+--baseline cada resultado trae la razón contra la corrida anterior y
+--max-regression hace fallar la corrida si alguna empeora más que eso.
+"""
+import os
+import tempfile
+
+# antes de importar app: settings se leen al importar. Lo que tenga efectos
+# fuera del proceso (store local, snapshot, spool, bus) se fuerza.
+os.environ.setdefault("INTERNAL_SECRET", "bench")
+os.environ.setdefault("EMBEDDER_BACKEND", "mock")
+os.environ.setdefault("EMBEDDER_PRELOAD", "false")
+os.environ.setdefault("STORAGE_BACKEND", "firestore")
+os.environ.setdefault("RATE_LIMIT_PER_MINUTE", "1000000000")
+os.environ["LOCAL_STORE_DIR"] = tempfile.mkdtemp(prefix="vectorai-bench-")
+os.environ["GALLERY_SNAPSHOT_DIR"] = ""
+os.environ["GALLERY_SYNC"] = "none"
+os.environ["DETECTION_LOG_SPOOL"] = ""
+
+import argparse  # noqa: E402
+import gc  # noqa: E402
+import json  # noqa: E402
+import platform  # noqa: E402
+import shutil  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+from datetime import date, datetime, timedelta, timezone  # noqa: E402
+from typing import Any, Callable, Dict, List, Optional  # noqa: E402
+import numpy as np  # noqa: E402
+
+from app.core.config import settings  # noqa: E402
+from . import fake_firestore, git_commit, synthetic  # noqa: E402
+
+SUITES = ("matching", "codec", "embedding", "reports", "http")
+
+
+# --------- medición ---------
+
+def measure(fn: Callable[[], Any], min_time: float = 0.2, min_runs: int = 5,
+            max_runs: int = 10_000, warmup: int = 1, items: int = 1) -> Dict[str, float]:
+    """
+    Corre fn hasta juntar min_time segundos y al menos min_runs corridas.
+    `items` es cuántas unidades procesa cada llamada (para ops/s en batch).
+    """
+    for _ in range(warmup):
+        fn()
+    times: List[float] = []
+    total = 0.0
+    while len(times) < max_runs and (len(times) < min_runs or total < min_time):
+        t = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t
+        times.append(dt)
+        total += dt
+    ms = np.asarray(times) * 1000.0
+    mean = float(ms.mean())
+    return {
+        "runs": len(times),
+        "mean_ms": mean,
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "min_ms": float(ms.min()),
+        "ops_per_s": items * 1000.0 / mean if mean > 0 else float("inf"),
+    }
+
+
+class Results:
+    def __init__(self, min_time: float):
+        self.min_time = min_time
+        self.rows: List[Dict[str, Any]] = []
+
+    def add(self, suite: str, name: str, params: Dict[str, Any], stats: Dict[str, Any]):
+        row = {"suite": suite, "name": name, "params": params, **stats}
+        self.rows.append(row)
+        shown = ", ".join(f"{k}={v}" for k, v in params.items())
+        print(f"  {suite:9s} {name:36s} {shown:40s} {stats.get('mean_ms', 0.0):10.3f} ms", file=sys.stderr)
+
+    def time(self, suite: str, name: str, params: Dict[str, Any], fn: Callable[[], Any], **kw):
+        self.add(suite, name, params, measure(fn, min_time=self.min_time, **kw))
+
+    def once(self, suite: str, name: str, params: Dict[str, Any], fn: Callable[[], Any]):
+        """Operaciones caras que no se repiten (carga, ingesta): una corrida."""
+        t = time.perf_counter()
+        fn()
+        ms = (time.perf_counter() - t) * 1000.0
+        self.add(suite, name, params, {"runs": 1, "mean_ms": ms, "p50_ms": ms, "p95_ms": ms, "min_ms": ms,
+                                       "ops_per_s": params.get("items", 1) * 1000.0 / ms if ms > 0 else float("inf")})
+
+
+# --------- suites ---------
+
+def bench_matching(res: Results, sizes: List[int], dims: List[int], indexes: List[str],
+                   best_match_max: int, seed: int):
+    from app.services.gallery import Gallery
+    from app.services.matcher import best_match, best_match_matrix
+    for dim in dims:
+        for n in sizes:
+            ids, matrix = synthetic.gallery(n, dim, seed)
+            qs, _ = synthetic.queries(matrix, 32, seed=seed + 1)
+            p = {"n": n, "dim": dim}
+            if n <= best_match_max:
+                # la API de listas arma la matriz en cada llamada
+                candidates = [{"id": cid, "vector": row} for cid, row in zip(ids, matrix)]
+                res.time("matching", "matcher.best_match", p, lambda: best_match(qs[0], candidates))
+                del candidates
+            res.time("matching", "matcher.best_match_matrix", p, lambda: best_match_matrix(qs[0], matrix))
+            for kind in indexes:
+                g = Gallery(dim, kind)
+                res.once("matching", "gallery.load", {**p, "index": kind, "items": n},
+                         lambda: g.load_matrix(ids, matrix) if kind == "flat" else g.load(zip(ids, matrix)))
+                res.time("matching", "gallery.search_batch", {**p, "index": kind, "batch": 1},
+                         lambda: g.search_batch(qs[:1]))
+                res.time("matching", "gallery.search_batch", {**p, "index": kind, "batch": 32},
+                         lambda: g.search_batch(qs), items=32)
+                del g
+            del ids, matrix
+            gc.collect()
+
+
+def bench_codec(res: Results, dims: List[int], seed: int):
+    from app.services import firebase_client as fb
+    try:
+        from cryptography.fernet import Fernet
+    except Exception:  # pragma: no cover
+        Fernet = None  # type: ignore
+    rng = np.random.default_rng(seed)
+    ciphers = [("none", None)] + ([("fernet", Fernet(Fernet.generate_key()))] if Fernet is not None else [])
+    saved = (fb._cipher, settings.VECTOR_STORAGE_CODEC)
+    try:
+        for dim in dims:
+            vec = rng.standard_normal(dim).astype(np.float32)
+            vec /= np.linalg.norm(vec)
+            as_list = vec.tolist()
+            for codec in ("float32", "float16", "int8"):
+                for cipher_name, cipher in ciphers:
+                    fb._cipher = cipher
+                    settings.VECTOR_STORAGE_CODEC = codec
+                    p = {"dim": dim, "codec": codec, "cipher": cipher_name}
+                    res.time("codec", "firebase_client._enc_vector", p, lambda: fb._enc_vector(as_list))
+                    raw = fb._enc_vector(as_list)
+                    res.time("codec", "firebase_client._dec_vector", p, lambda: fb._dec_vector(raw))
+    finally:
+        fb._cipher, settings.VECTOR_STORAGE_CODEC = saved
+
+
+IMAGE_SIZES = ((320, 240), (640, 480), (1920, 1080), (4000, 3000))
+
+
+def bench_embedding(res: Results, seed: int):
+    from app.services.face_embedder import get_embedder
+    emb = get_embedder()
+    for w, h in IMAGE_SIZES:
+        content = synthetic.jpeg(w, h, seed)
+        p = {"backend": emb.backend, "width": w, "height": h, "bytes": len(content)}
+        res.time("embedding", "face_embedder.embed_image", p, lambda: emb.embed_image(content))
+    batch = [synthetic.jpeg(640, 480, seed + i) for i in range(8)]
+    res.time("embedding", "face_embedder.embed_images", {"backend": emb.backend, "width": 640, "height": 480,
+                                                         "batch": len(batch)},
+             lambda: emb.embed_images(batch), items=len(batch))
+
+
+def _ingest(write: Callable[[List[Dict[str, Any]]], None], events, chunk: int = 400) -> int:
+    n, buf = 0, []
+    for ev in events:
+        buf.append(ev)
+        if len(buf) >= chunk:
+            write(buf)
+            n, buf = n + len(buf), []
+    if buf:
+        write(buf)
+        n += len(buf)
+    return n
+
+
+def bench_reports(res: Results, clients: int, days: int, per_day: int, seed: int):
+    from app.services import firebase_client as fb
+    from app.services import local_store
+    ids = synthetic.client_ids(clients)
+    first = date(2024, 1, 1)
+    target = first + timedelta(days=days // 2)
+    backends = (("firestore-memory", fb), ("local", local_store))
+    fake_firestore.install()
+    for name, store in backends:
+        for cid in ids:
+            store.create_client({"id": cid, "name": f"Client {cid}", "meta": {"area": f"area-{int(cid[1:]) % 8}"}})
+        p = {"storage": name, "clients": clients, "days": days, "per_day": per_day}
+        res.once("reports", "write_detections", {**p, "items": days * per_day},
+                 lambda: _ingest(store.write_detections, synthetic.detection_history(ids, first, days, per_day, seed)))
+        res.time("reports", "list_detections_for_date", p, lambda: store.list_detections_for_date(target),
+                 items=per_day)
+        res.time("reports", "iter_rollups", {**p, "range_days": days},
+                 lambda: list(store.iter_rollups(first, first + timedelta(days=days - 1))))
+
+
+def bench_http(res: Results, clients: int, dim: int, seed: int):
+    from fastapi.testclient import TestClient
+    from app.main import app
+    from app.services.storage import get_storage
+    if settings.STORAGE_BACKEND.lower().strip() == "firestore":
+        fake_firestore.install()
+    storage = get_storage()
+    ids, matrix = synthetic.gallery(clients, dim, seed)
+    for cid, row in zip(ids, matrix):
+        storage.create_client({"id": cid, "name": f"Client {cid}", "meta": {}})
+        storage.set_client_vector(cid, row.tolist(), dim)
+    today = datetime.now(timezone.utc).date()
+    _ingest(storage.write_detections, synthetic.detection_history(ids, today, 1, 2000, seed))
+    if settings.STORAGE_BACKEND.lower().strip() == "firestore":
+        # historial sintético escrito entero con rollups: /reports/daily los puede leer
+        from app.services import firebase_client as fb
+        fb.set_rollup_coverage(today)
+    qs, _ = synthetic.queries(matrix, 1, seed=seed + 1)
+    vector_body = {"vector": qs[0].tolist()}
+    image = synthetic.jpeg(640, 480, seed)
+    headers = {"X-API-Key": settings.INTERNAL_SECRET}
+    api = settings.API_PREFIX
+    p = {"storage": settings.STORAGE_BACKEND, "clients": clients, "dim": dim}
+
+    with TestClient(app) as client:
+        def call(method: str, url: str, **kw):
+            r = client.request(method, url, headers=headers, **kw)
+            if r.status_code >= 400:
+                raise RuntimeError(f"{method} {url} -> {r.status_code}: {r.text[:200]}")
+            return r
+
+        requests = [
+            ("GET /health", lambda: call("GET", "/health")),
+            ("POST /detect/vector", lambda: call("POST", f"{api}/detect/vector/", json=vector_body)),
+            ("POST /detect/image", lambda: call("POST", f"{api}/detect/image/",
+                                                files={"file": ("face.jpg", image, "image/jpeg")})),
+            ("GET /clients/{id}", lambda: call("GET", f"{api}/clients/{ids[0]}")),
+            ("GET /reports/daily", lambda: call("GET", f"{api}/reports/daily", params={"day": today.isoformat()})),
+            ("GET /reports/range", lambda: call("GET", f"{api}/reports/range", params={
+                "from": today.isoformat(), "to": today.isoformat(), "source": "detections"})),
+        ]
+        for name, fn in requests:
+            res.time("http", name, p, fn)
+
+
+# --------- salida ---------
+
+def meta(args: argparse.Namespace) -> Dict[str, Any]:
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": {k: v for k, v in vars(args).items() if k not in ("out", "baseline")},
+        "settings": {k: getattr(settings, k) for k in (
+            "STORAGE_BACKEND", "EMBEDDER_BACKEND", "EMBEDDING_DIM", "INDEX_BACKEND", "GALLERY_CODEC",
+            "VECTOR_STORAGE_CODEC", "TEMPLATE_AGGREGATION", "INFERENCE_MODE", "IMAGE_MAX_SIDE")},
+    }
+
+
+def _key(row: Dict[str, Any]) -> str:
+    return json.dumps([row["suite"], row["name"], row["params"]], sort_keys=True)
+
+
+def compare(rows: List[Dict[str, Any]], baseline: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Agrega baseline_mean_ms y ratio (>1 = más lento) a los resultados que existían antes."""
+    before = {_key(r): r for r in baseline.get("results", [])}
+    worse = []
+    for row in rows:
+        old = before.get(_key(row))
+        if old is None or not old.get("mean_ms"):
+            continue
+        row["baseline_mean_ms"] = old["mean_ms"]
+        row["ratio"] = row["mean_ms"] / old["mean_ms"]
+        worse.append(row)
+    return sorted(worse, key=lambda r: r["ratio"], reverse=True)
+
+
+def _ints(raw: str) -> List[int]:
+    return [int(float(x)) for x in raw.split(",") if x.strip()]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmarks (in-memory Firestore, mock embedder)")
+    parser.add_argument("--suite", action="append", choices=SUITES, help="repeatable; default: all")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="gallery sizes (up to 1000000)")
+    parser.add_argument("--dims", default="128,512")
+    parser.add_argument("--indexes", default="flat", help="gallery indexes: flat,ivf,hnsw")
+    parser.add_argument("--best-match-max", type=int, default=100_000,
+                        help="largest gallery for the list-based matcher.best_match")
+    parser.add_argument("--clients", type=int, default=1000, help="clients in the reports/http suites")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--per-day", type=int, default=2000, help="detections per day")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds measured per benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write JSON here (default: stdout)")
+    parser.add_argument("--baseline", help="previous JSON output to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.0,
+                        help="fail if any mean is this many times slower than the baseline (0 = never)")
+    args = parser.parse_args(argv)
+
+    suites = args.suite or list(SUITES)
+    res = Results(args.min_time)
+    try:
+        if "matching" in suites:
+            bench_matching(res, _ints(args.sizes), _ints(args.dims), args.indexes.split(","),
+                           args.best_match_max, args.seed)
+        if "codec" in suites:
+            bench_codec(res, _ints(args.dims), args.seed)
+        if "embedding" in suites:
+            bench_embedding(res, args.seed)
+        if "reports" in suites:
+            bench_reports(res, args.clients, args.days, args.per_day, args.seed)
+        if "http" in suites:
+            bench_http(res, args.clients, settings.EMBEDDING_DIM, args.seed)
+    finally:
+        shutil.rmtree(os.environ["LOCAL_STORE_DIR"], ignore_errors=True)
+
+    out: Dict[str, Any] = {"meta": meta(args), "results": res.rows}
+    status = 0
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        compared = compare(res.rows, baseline)
+        out["meta"]["baseline_commit"] = baseline.get("meta", {}).get("git_commit")
+        for row in compared[:10]:
+            print(f"  {row['ratio']:6.2f}x  {row['suite']} {row['name']} {row['params']}", file=sys.stderr)
+        if args.max_regression and any(r["ratio"] > args.max_regression for r in compared):
+            status = 1
+    text = json.dumps(out, indent=2, default=str)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
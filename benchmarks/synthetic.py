@@ -0,0 +1,76 @@
+# benchmarks/synthetic.py
+"""
+Datos sintéticos reproducibles (misma semilla = mismos datos) para los
+benchmarks: galerías de embeddings, queries cercanas a un cliente,
+historiales de detecciones e imágenes JPEG.
+"""
+import io
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Tuple
+import numpy as np
+from PIL import Image
+
+CHUNK = 65536  # filas generadas por vez: 1M x 512 no necesita el doble de memoria
+
+
+def client_ids(n: int) -> List[str]:
+    return [f"c{i:07d}" for i in range(n)]
+
+
+def gallery(n: int, dim: int, seed: int = 0) -> Tuple[List[str], np.ndarray]:
+    """n embeddings float32 L2-normalizados (gaussianos: casi ortogonales entre sí)."""
+    rng = np.random.default_rng(seed)
+    matrix = np.empty((n, dim), dtype=np.float32)
+    for i in range(0, n, CHUNK):
+        block = rng.standard_normal((min(CHUNK, n - i), dim), dtype=np.float32)
+        block /= np.linalg.norm(block, axis=1, keepdims=True)
+        matrix[i:i + len(block)] = block
+    return client_ids(n), matrix
+
+
+def queries(matrix: np.ndarray, n: int, noise: float = 0.05, seed: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    n queries, cada una un cliente de la galería con ruido (otra foto de la
+    misma persona). Devuelve (queries normalizadas, fila de origen).
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(matrix), size=n)
+    q = matrix[rows] + rng.standard_normal((n, matrix.shape[1]), dtype=np.float32) * noise
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+    return q.astype(np.float32), rows
+
+
+def detection_history(ids: List[str], first_day: date, days: int, per_day: int,
+                      seed: int = 2) -> Iterator[Dict[str, Any]]:
+    """
+    Eventos con el formato de detection_log.make_event: per_day detecciones
+    por día entre las 7:00 y las 19:00 UTC, repartidas entre `ids`, en orden
+    cronológico.
+    """
+    rng = np.random.default_rng(seed)
+    for d in range(days):
+        start = datetime.combine(first_day + timedelta(days=d), time(7), tzinfo=timezone.utc)
+        offsets = np.sort(rng.uniform(0, 12 * 3600, size=per_day))
+        who = rng.integers(0, len(ids), size=per_day)
+        scores = rng.uniform(0.6, 0.99, size=per_day)
+        for k in range(per_day):
+            ts = start + timedelta(seconds=float(offsets[k]))
+            yield {
+                "id": f"{ts.strftime('%Y%m%d')}-{k:07d}",
+                "client_id": ids[int(who[k])],
+                "ts": ts.isoformat(),
+                "score": float(scores[k]),
+                "source": {"mode": "vector", "device": "bench"},
+            }
+
+
+def jpeg(width: int, height: int, seed: int = 3, quality: int = 90) -> bytes:
+    """Gradiente con ruido: comprime como una foto, no como un color plano."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // max(1, width - 1), y * 255 // max(1, height - 1),
+                     (x + y) * 255 // max(1, width + height - 2)], axis=-1)
+    noisy = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(noisy, "RGB").save(buf, "JPEG", quality=quality)
+    return buf.getvalue()